@@ -0,0 +1,72 @@
+"""
+    Micro-benchmark of message codecs on our message shapes
+
+    For every available codec it measures:
+    - publish: encode message
+    - consume: decode payload and build `processed_message` (extend JSON payload or re-encode)
+    "legacy" row is the old path: json.loads(bytes.decode()) + json.dumps(enriched message)
+
+    No Redis is needed:
+
+        python -m benchmarks.bench_codecs
+"""
+
+import argparse
+import json
+import random
+import timeit
+import uuid
+
+from src.codec import available_codecs, get_codec, encode_json, extend_json
+
+SHAPES = {
+    # What publisher.py sends
+    "id": {"message_id": str(uuid.uuid4())},
+    "small": {"message_id": str(uuid.uuid4()), "user": 12345, "event": "click", "ts": 1727370000.123,
+              "tags": ["a", "b", "c"]},
+    "large": {"message_id": str(uuid.uuid4()), "items": [{"sku": f"sku-{i}", "qty": i, "price": i * 1.5}
+                                                         for i in range(20)], "note": "x" * 300},
+}
+
+
+def legacy_consume(raw: bytes) -> str:
+    message = json.loads(raw.decode('utf-8'))
+    message['processed_by'] = "consumer"
+    message['random_property'] = random.random()
+    return json.dumps(message)
+
+
+def make_consume(codec):
+    def consume(raw: bytes) -> bytes:
+        message = codec.loads(raw)
+        extra = {'processed_by': "consumer", 'random_property': random.random()}
+        if codec.is_json:
+            return extend_json(raw, extra)
+        message.update(extra)
+        return encode_json(message)
+    return consume
+
+
+def measure(func, arg, number: int) -> float:
+    """
+    :return: nanoseconds per call
+    """
+    return min(timeit.repeat(lambda: func(arg), number=number, repeat=3)) / number * 1e9
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Codecs micro-benchmark")
+    parser.add_argument('--number', type=int, default=20000, help="Calls per measurement")
+    args = parser.parse_args()
+
+    print(f"{'shape':<8} {'codec':<8} {'bytes':>7} {'publish ns':>12} {'consume ns':>12}")
+    for shape, message in SHAPES.items():
+        raw = json.dumps(message).encode('utf-8')
+        print(f"{shape:<8} {'legacy':<8} {len(raw):>7} "
+              f"{measure(lambda m: json.dumps(m).encode('utf-8'), message, args.number):>12.0f} "
+              f"{measure(legacy_consume, raw, args.number):>12.0f}")
+        for name in available_codecs():
+            codec = get_codec(name)
+            payload = codec.dumps(message)
+            print(f"{shape:<8} {name:<8} {len(payload):>7} {measure(codec.dumps, message, args.number):>12.0f} "
+                  f"{measure(make_consume(codec), payload, args.number):>12.0f}")
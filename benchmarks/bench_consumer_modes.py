@@ -0,0 +1,92 @@
+"""
+    Benchmark of consumer execution modes
+
+    Pushes the same amount of encoded messages through ConsumerEngine.on_message
+    (ConsumerEngine.handle_batch for batch mode) in every mode
+    and reports Redis round-trips per message and msgs/sec.
+
+    Needs running Redis (REDIS_HOST / REDIS_PORT):
+
+        python -m benchmarks.bench_consumer_modes --messages 20000
+"""
+
+import argparse
+import time
+import uuid
+
+from src.config import redis_host, redis_port, batch_size
+from src.consumer import ConsumerEngine
+
+
+def count_calls(engine: ConsumerEngine) -> dict:
+    """
+    Count round-trips of engine's connection
+
+    :param engine:
+    :return: mutable counter {"calls": int}
+    """
+    counter = {"calls": 0}
+    execute_command = engine.r.execute_command
+
+    def counting_execute_command(*args, **kwargs):
+        counter["calls"] += 1
+        return execute_command(*args, **kwargs)
+
+    # Pipeline is sent by its own execute, so i count it as one round-trip
+    pipeline = engine.r.pipeline
+
+    def counting_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def counting_execute(*execute_args, **execute_kwargs):
+            counter["calls"] += 1
+            return execute(*execute_args, **execute_kwargs)
+
+        pipe.execute = counting_execute
+        return pipe
+
+    engine.r.execute_command = counting_execute_command
+    engine.r.pipeline = counting_pipeline
+    return counter
+
+
+def run(mode: str, messages: int) -> dict:
+    """
+    Run one mode
+
+    :param mode: consumer mode
+    :param messages: count of messages
+    :return: result row
+    """
+    engine = ConsumerEngine(f"bench-{mode}-{uuid.uuid4()}", redis_host, redis_port, mode=mode)
+    payloads = [engine.codec.dumps({"message_id": str(uuid.uuid4())}) for _ in range(messages)]
+    counter = count_calls(engine)
+
+    started = time.perf_counter()
+    if mode == "batch":
+        pairs = [(engine.codec.loads(payload), payload) for payload in payloads]
+        processed = sum(engine.handle_batch(pairs[i:i + batch_size]) for i in range(0, messages, batch_size))
+    else:
+        processed = sum(1 for payload in payloads if engine.on_message(payload))
+    engine.leave()
+    elapsed = time.perf_counter() - started
+
+    return {
+        "mode": mode,
+        "processed": processed,
+        "calls_per_message": counter["calls"] / messages,
+        "msgs_per_sec": messages / elapsed,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Consumer modes benchmark")
+    parser.add_argument('--messages', type=int, default=10000, help="Messages per mode")
+    parser.add_argument('--modes', nargs='+', default=["simple", "script", "batch"], help="Modes to compare")
+    args = parser.parse_args()
+
+    print(f"{'mode':<10} {'processed':>10} {'calls/msg':>10} {'msgs/sec':>12}")
+    for mode in args.modes:
+        row = run(mode, args.messages)
+        print(f"{row['mode']:<10} {row['processed']:>10} {row['calls_per_message']:>10.3f} {row['msgs_per_sec']:>12.0f}")
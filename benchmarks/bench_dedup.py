@@ -0,0 +1,97 @@
+"""
+    Benchmark of dedup stores (see src/dedup.py)
+
+    Claims messages in real time at `--rate` msgs/sec for `--duration` seconds by pipelines (as batch mode does)
+    and reports Redis `used_memory` (peak and mean over the run, above the empty database),
+    then waits until all claims are expired and reports expire cycle CPU (`expire_cycle_cpu_milliseconds`)
+    and expired keys of every store.
+
+    Needs a real Redis with INFO: redis-server on PATH is spawned, otherwise database 15 of REDIS_HOST / REDIS_PORT
+    is used (it's flushed, and other load of that Redis spoils the numbers).
+
+        python -m benchmarks.bench_dedup --rate 20000 --duration 20
+"""
+
+import argparse
+import shutil
+import time
+import uuid
+
+import redis
+
+from src.config import redis_host, redis_port, lock_name, dedup_name, lock_ttl, dedup_window
+from src.dedup import get_dedup
+from benchmarks.bench_e2e import LocalRedis
+
+
+def info_stats(r: redis.Redis) -> dict:
+    stats = r.info("stats")
+    return {"expired_keys": stats.get("expired_keys", 0),
+            "expire_cycle_cpu_ms": stats.get("expire_cycle_cpu_milliseconds", 0)}
+
+
+def run(r: redis.Redis, backend: str, rate: int, duration: float, tick: float = 0.01) -> dict:
+    """
+    Claim messages by one dedup store in real time
+
+    :return: result row
+    """
+    r.flushdb()
+    dedup = get_dedup(backend, lock_name, dedup_name, lock_ttl, dedup_window)
+    baseline_memory = r.info("memory")["used_memory"]
+    before = info_stats(r)
+
+    samples = []
+    claimed = 0
+    started = time.time()
+    while time.time() - started < duration:
+        due = int((time.time() - started) * rate) - claimed
+        if due > 0:
+            pipe = r.pipeline(transaction=False)
+            now = time.time()
+            for _ in range(due):
+                dedup.claim(pipe, "bench", str(uuid.uuid4()), now)
+            dedup.expire(pipe)
+            pipe.execute()
+            claimed += due
+            samples.append(r.info("memory")["used_memory"] - baseline_memory)
+        time.sleep(tick)
+
+    # Everything is gone after the longest life of a claim
+    deadline = time.time() + max(lock_ttl, 2 * dedup_window) + 30
+    while r.dbsize() and time.time() < deadline:
+        time.sleep(0.5)
+    after = info_stats(r)
+    return {
+        "backend": backend,
+        "claimed": claimed,
+        "peak_memory_mb": max(samples) / 1024 / 1024,
+        "mean_memory_mb": sum(samples) / len(samples) / 1024 / 1024,
+        "expired_keys": after["expired_keys"] - before["expired_keys"],
+        "expire_cycle_cpu_ms": after["expire_cycle_cpu_ms"] - before["expire_cycle_cpu_ms"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dedup stores benchmark")
+    parser.add_argument('--rate', type=int, default=20000, help="Claims per second")
+    parser.add_argument('--duration', type=float, default=20, help="Seconds")
+    parser.add_argument('--backends', nargs='+', default=["key", "bucket"], help="Dedup stores to compare")
+    args = parser.parse_args()
+
+    server = LocalRedis() if shutil.which("redis-server") else None
+    r = server.r if server else redis.Redis(host=redis_host, port=redis_port, db=15)
+    try:
+        r.info("memory")
+    except redis.ResponseError:
+        raise SystemExit("Redis without INFO (fakeredis?) can't be measured")
+
+    print(f"{'backend':<8} {'claimed':>9} {'peak MB':>9} {'mean MB':>9} {'expired keys':>13} {'expire cpu ms':>14}")
+    try:
+        for backend in args.backends:
+            row = run(r, backend, args.rate, args.duration)
+            print(f"{row['backend']:<8} {row['claimed']:>9} {row['peak_memory_mb']:>9.2f} {row['mean_memory_mb']:>9.2f} "
+                  f"{row['expired_keys']:>13} {row['expire_cycle_cpu_ms']:>14}")
+    finally:
+        if server:
+            server.stop()
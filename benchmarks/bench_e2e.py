@@ -0,0 +1,346 @@
+"""
+    End-to-end benchmark of the consumer group
+
+    Every scenario runs the real processes against a local Redis:
+    - `main.py --group_size N` (create_consumer_group) with CONSUMER_MODE / INGEST_BACKEND of the scenario
+    - `src/publisher.py --rate R --duration D` (open loop load generator) as the fixed workload
+    and records msgs/sec, p50/p99 end-to-end latency (consumers' histograms), Redis commands per processed
+    message (consumer side: INFO commandstats without the publisher's commands - its PUBLISH, and with the stream
+    ingest its XADD to the input stream, counted by `entries-added` of the input stream) and consumer CPU / peak RSS.
+    commandstats of redis-server counts the commands which a Lua script runs as well as its EVALSHA, so commands
+    per message of script mode (and of the index, STREAM_AND_INDEX) are commands Redis executed, not round trips:
+    its EVALSHA is counted together with the SET / HSETNX / EXPIREAT / XADD / HSET inside it.
+
+    Redis is spawned from `redis-server` on PATH, otherwise fakeredis TCP server is started in process
+    (much slower, no INFO - commands per message are not available; good only to compare runs on fakeredis).
+
+        python -m benchmarks.bench_e2e --modes simple script batch --group_sizes 1 4 --output results.json
+        python -m benchmarks.bench_e2e --baseline benchmarks/baseline.json   # exit code 1 on regression
+
+    Results are compared only with a baseline measured on the same kind of server (exit code 2 otherwise), numbers
+    of fakeredis say nothing about redis-server. benchmarks/baseline.json is the result of
+    `python -m benchmarks.bench_e2e --backends pubsub stream` on fakeredis ("meta" tells where it was measured,
+    it has no commands per message) - produce your own baseline with redis-server on your machine to compare with.
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import redis
+
+from src.config import stats_name, consumer_heartbeats, stream_name, processed_stream_shards, input_stream
+from src.histogram import Histogram, histograms_from_hash
+from src.stats import group_stats_key
+from src.shards import shard_names, entries_added
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Metrics compared with baseline: name -> True if higher is better
+METRICS = {"msgs_per_sec": True, "latency_p50_ms": False, "latency_p99_ms": False,
+           "commands_per_message": False, "cpu_seconds": False, "peak_rss_mb": False}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LocalRedis:
+    """
+    redis-server spawned on a free port (and unix socket), or fakeredis TCP server if redis-server is not installed
+    """
+
+    def __init__(self) -> None:
+        self.port = free_port()
+        self.process = None
+        self.fake = None
+        self.socket_path = None
+        if shutil.which("redis-server"):
+            self.kind = "redis-server"
+            self.socket_path = os.path.join(tempfile.mkdtemp(prefix="bench-redis-"), "redis.sock")
+            self.process = subprocess.Popen(["redis-server", "--port", str(self.port), "--save", "",
+                                             "--appendonly", "no", "--unixsocket", self.socket_path,
+                                             "--unixsocketperm", "700"], stdout=subprocess.DEVNULL)
+        else:
+            from fakeredis import TcpFakeServer
+            self.kind = "fakeredis"
+            self.fake = TcpFakeServer(("127.0.0.1", self.port), server_type="redis")
+            threading.Thread(target=self.fake.serve_forever, daemon=True).start()
+        self.r = redis.Redis(host="127.0.0.1", port=self.port)
+        deadline = time.time() + 10
+        while True:
+            try:
+                self.r.ping()
+                break
+            except redis.ConnectionError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def command_calls(self):
+        """
+        Calls of every command since start, None if server has no INFO (fakeredis)
+
+        :return: {command: calls}
+        """
+        try:
+            return {name.removeprefix("cmdstat_"): stats["calls"]
+                    for name, stats in self.r.info("commandstats").items()}
+        except redis.ResponseError:
+            # fakeredis TCP server breaks the connection after an error reply
+            self.r.connection_pool.disconnect()
+            return None
+
+    def stop(self) -> None:
+        self.r.close()
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        if self.fake is not None:
+            self.fake.shutdown()
+            self.fake.server_close()
+
+
+def descendants(pid: int) -> list:
+    """
+    PIDs of all child processes (Linux /proc)
+
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    # Name of process is in brackets and may contain spaces
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    found, queue = [], [pid]
+    while queue:
+        for child in children.get(queue.pop(), []):
+            found.append(child)
+            queue.append(child)
+    return found
+
+
+def cpu_seconds(pids: list) -> float:
+    """
+    User + system CPU time of processes
+
+    """
+    ticks = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            ticks += int(fields[11]) + int(fields[12])
+        except (OSError, IndexError):
+            continue
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+def rss_mb(pids: list) -> float:
+    """
+    Resident memory of processes
+
+    """
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        except (OSError, StopIteration):
+            continue
+    return total / 1024
+
+
+def processed_total(r: redis.Redis) -> int:
+    total = 0
+    for name in shard_names(stream_name, processed_stream_shards):
+        try:
+            total += r.xinfo_stream(name).get("entries-added", 0)
+        except redis.ResponseError:
+            continue
+    return total
+
+
+def input_added(r: redis.Redis, backend: str) -> int:
+    """
+    Entries the publisher added to the input stream (its XADD calls)
+
+    """
+    # No error reply for a missing stream, it breaks the connection of fakeredis
+    return entries_added(r, [input_stream]) if backend == "stream" and r.exists(input_stream) else 0
+
+
+def run_scenario(server: LocalRedis, scenario: dict, settle: float = 3.0, timeout: float = 120.0) -> dict:
+    """
+    Run one scenario on clean Redis
+
+    :param server: local Redis
+    :param scenario: name, mode, backend, group_size, rate, duration, payload_size
+    :param settle: consider processing finished when nothing was processed for so many seconds
+    :param timeout: of every waiting
+    :return: scenario with metrics
+    """
+    r = server.r
+    r.flushall()
+    env = dict(os.environ, REDIS_HOST="127.0.0.1", REDIS_PORT=str(server.port), CONSUMER_MODE=scenario["mode"],
+               INGEST_BACKEND=scenario["backend"], PYTHONPATH=ROOT)
+    group = subprocess.Popen([sys.executable, "main.py", "--group_size", str(scenario["group_size"])],
+                             cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    result = dict(scenario)
+    try:
+        deadline = time.time() + timeout
+        while r.zcard(consumer_heartbeats) < scenario["group_size"]:
+            if time.time() > deadline or group.poll() is not None:
+                raise RuntimeError("consumer group did not start")
+            time.sleep(0.2)
+        # Subscriptions are done right after registration, i give them a moment
+        time.sleep(1)
+
+        input_before = input_added(r, scenario["backend"])
+        calls_before = server.command_calls()
+        started = time.time()
+        publisher = subprocess.Popen([sys.executable, "src/publisher.py", "--rate", str(scenario["rate"]),
+                                      "--duration", str(scenario["duration"]),
+                                      "--payload_size", str(scenario["payload_size"])],
+                                     cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        peak_rss = 0.0
+        while publisher.poll() is None:
+            peak_rss = max(peak_rss, rss_mb(descendants(group.pid)))
+            time.sleep(0.5)
+        match = re.search(r"Total messages published: (\d+)", publisher.stdout.read())
+        if match is None:
+            raise RuntimeError("publisher failed")
+        published = int(match.group(1))
+
+        # Wait until everything is processed or nothing happens anymore
+        processed, last_change = processed_total(r), time.time()
+        while processed < published and time.time() - last_change < settle and time.time() < deadline + timeout:
+            time.sleep(0.2)
+            peak_rss = max(peak_rss, rss_mb(descendants(group.pid)))
+            current = processed_total(r)
+            if current != processed:
+                processed, last_change = current, time.time()
+        elapsed = last_change - started
+        calls_after = server.command_calls()
+        input_after = input_added(r, scenario["backend"])
+        cpu = cpu_seconds(descendants(group.pid))
+    finally:
+        group.send_signal(signal.SIGTERM)
+        try:
+            group.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            group.kill()
+
+    # Consumers flush their stats on exit (to the group hash too, Redis was flushed before the run)
+    latency = histograms_from_hash(r.hgetall(group_stats_key(stats_name))).get("end_to_end", Histogram())
+
+    commands = None
+    if calls_before is not None and calls_after is not None and processed:
+        consumer_calls = sum(calls_after.values()) - sum(calls_before.values())
+        # Publisher's commands and my own polling are not the consumers' cost
+        for name in ("publish", "xinfo|stream", "xinfo", "info"):
+            consumer_calls -= calls_after.get(name, 0) - calls_before.get(name, 0)
+        # XADD is the publisher's to the input stream and the consumers' to the processed one
+        consumer_calls -= input_after - input_before
+        commands = consumer_calls / processed
+
+    result.update({
+        "published": published,
+        "processed": processed,
+        "msgs_per_sec": processed / elapsed if elapsed > 0 else 0.0,
+        "latency_p50_ms": latency.quantile(0.5) * 1000,
+        "latency_p99_ms": latency.quantile(0.99) * 1000,
+        "commands_per_message": commands,
+        "cpu_seconds": cpu,
+        "peak_rss_mb": peak_rss,
+    })
+    return result
+
+
+def compare(results: list, baseline: list, tolerance: float) -> list:
+    """
+    Compare results with baseline by scenario name
+
+    :param tolerance: allowed relative change to the worse side (0.1 - 10%)
+    :return: list of regressions (text)
+    """
+    baseline = {row["name"]: row for row in baseline}
+    regressions = []
+    for row in results:
+        base = baseline.get(row["name"])
+        if base is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            value, base_value = row.get(metric), base.get(metric)
+            if value is None or not base_value:
+                continue
+            change = (value - base_value) / base_value
+            print(f"{row['name']:<24} {metric:<22} {base_value:>12.3f} -> {value:>12.3f} ({change:+.1%})")
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{row['name']} {metric}: {base_value:.3f} -> {value:.3f} ({change:+.1%})")
+    return regressions
+
+
+def scenarios(args) -> list:
+    return [{"name": f"{backend}-{mode}-{group_size}", "mode": mode, "backend": backend, "group_size": group_size,
+             "rate": args.rate, "duration": args.duration, "payload_size": args.payload_size}
+            for backend in args.backends for mode in args.modes for group_size in args.group_sizes]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of consumer group")
+    parser.add_argument('--modes', nargs='+', default=["simple", "script", "batch"], help="Consumer modes")
+    parser.add_argument('--backends', nargs='+', default=["pubsub"], help="Ingest backends")
+    parser.add_argument('--group_sizes', nargs='+', type=int, default=[1, 4], help="Consumer group sizes")
+    parser.add_argument('--rate', type=float, default=500, help="Publisher msgs/sec")
+    parser.add_argument('--duration', type=float, default=10, help="Publisher seconds")
+    parser.add_argument('--payload_size', type=int, default=0, help="Message size (bytes)")
+    parser.add_argument('--output', default=os.path.join(ROOT, "benchmarks", "results.json"), help="Results file")
+    parser.add_argument('--baseline', help="Results file to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Allowed regression (0.1 - 10%%)")
+    args = parser.parse_args()
+
+    server = LocalRedis()
+    results = []
+    try:
+        for scenario in scenarios(args):
+            row = run_scenario(server, scenario)
+            results.append(row)
+            print(f"{row['name']:<24} {row['msgs_per_sec']:>10.0f} msg/s  p50 {row['latency_p50_ms']:>8.2f} ms  "
+                  f"p99 {row['latency_p99_ms']:>8.2f} ms  cmd/msg {row['commands_per_message'] or float('nan'):>6.2f}  "
+                  f"cpu {row['cpu_seconds']:>6.2f} s  rss {row['peak_rss_mb']:>7.1f} MB  "
+                  f"processed {row['processed']}/{row['published']}")
+    finally:
+        server.stop()
+
+    with open(args.output, "w") as f:
+        json.dump({"meta": {"server": server.kind, "python": platform.python_version(), "platform": platform.platform(),
+                            "finished_at": time.time()},
+                   "results": results}, f, indent=2)
+    print(f"Results are written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["meta"]["server"] != server.kind:
+            print(f"Baseline was measured on {baseline['meta']['server']}, not on {server.kind} - nothing to compare")
+            sys.exit(2)
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            print("Regressions:\n" + "\n".join(regressions))
+            sys.exit(1)
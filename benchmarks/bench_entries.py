@@ -0,0 +1,91 @@
+"""
+    Benchmark of processed stream entry layouts (see src/entries.py)
+
+    For every message shape and layout it reports:
+    - bytes    - field names + values of the entry (what the stream keeps per entry, listpack overhead aside)
+    - build ns - stream entry from the decoded message and its JSON payload (as consumer does it)
+    - read ns  - decode_entry of the entry as it comes from Redis
+
+    Layouts: legacy, compact, compact + zlib, compact + zlib with preset dictionary trained on other messages
+    of the same shape. No Redis is needed:
+
+        python -m benchmarks.bench_entries
+"""
+
+import argparse
+import json
+import random
+import time
+import timeit
+import uuid
+
+from src.codec import extend_json
+from src.entries import CompactLayout, decode_entry, train_dictionary
+
+
+def make_message(shape: str) -> dict:
+    message = {"message_id": str(uuid.uuid4()), "published_at": time.time()}
+    if shape == "flat":
+        message.update(user=random.randint(1, 100000), event=random.choice(["click", "view", "buy"]),
+                       amount=round(random.uniform(1, 100), 2), tags=["a", "b", "c"])
+    elif shape == "nested":
+        message["items"] = [{"sku": f"sku-{random.randint(1, 500)}", "qty": random.randint(1, 9),
+                             "price": round(random.uniform(1, 50), 2)} for _ in range(10)]
+        message["note"] = "delivery to the door, call before " * 3
+    return message
+
+
+def legacy_entry(message: dict, raw: bytes) -> dict:
+    # What make_entry does with legacy layout
+    extra = {"processed_by": "consumer-" + "0" * 27, "random_property": random.random()}
+    return {"message_id": message["message_id"], "processed_by": extra["processed_by"],
+            "processed_message": extend_json(raw, extra), "created_at": time.time()}
+
+
+def as_stored(fields: dict) -> dict:
+    """
+    Entry as it comes back from Redis: bytes names and values
+    """
+    def to_bytes(value):
+        return value if isinstance(value, bytes) else str(value).encode()
+    return {name.encode(): to_bytes(value) for name, value in fields.items()}
+
+
+def measure(func, number: int) -> float:
+    """
+    :return: nanoseconds per call
+    """
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e9
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream entry layouts benchmark")
+    parser.add_argument('--number', type=int, default=20000, help="Calls per measurement")
+    parser.add_argument('--compress_min', type=int, default=128, help="Compress messages of so many bytes")
+    parser.add_argument('--train', type=int, default=2000, help="Messages to train dictionary on")
+    args = parser.parse_args()
+
+    print(f"{'shape':<8} {'layout':<14} {'payload':>8} {'bytes':>7} {'ratio':>6} {'build ns':>9} {'read ns':>9}")
+    for shape in ("id", "flat", "nested"):
+        dictionary = train_dictionary(json.dumps(make_message(shape)).encode() for _ in range(args.train))
+        message = make_message(shape)
+        raw = json.dumps(message).encode()
+        layouts = {
+            "legacy": lambda: legacy_entry(message, raw),
+            "compact": (lambda layout: lambda: layout.build(raw, "consumer-" + "0" * 27, random.random(),
+                                                           time.time()))(CompactLayout(0)),
+            "compact+zlib": (lambda layout: lambda: layout.build(raw, "consumer-" + "0" * 27, random.random(),
+                                                                time.time()))(CompactLayout(args.compress_min)),
+            "compact+dict": (lambda layout: lambda: layout.build(raw, "consumer-" + "0" * 27, random.random(),
+                                                                time.time()))(CompactLayout(args.compress_min,
+                                                                                            dictionary)),
+        }
+        legacy_bytes = None
+        for name, build in layouts.items():
+            stored = as_stored(build())
+            size = sum(len(field) + len(value) for field, value in stored.items())
+            legacy_bytes = legacy_bytes or size
+            read_dictionary = dictionary if name == "compact+dict" else None
+            print(f"{shape:<8} {name:<14} {len(raw):>8} {size:>7} {size / legacy_bytes:>6.2f} "
+                  f"{measure(build, args.number):>9.0f} "
+                  f"{measure(lambda: decode_entry(stored, read_dictionary), args.number):>9.0f}")
@@ -0,0 +1,80 @@
+"""
+    Benchmark of Redis transports (see src/transport.py)
+
+    Per-command latency of every transport (TCP, unix socket) and RESP parser (python, hiredis if installed)
+    for small commands (round trip dominates) and big replies (parsing dominates). Commands are sent one by
+    one by a single connection, as consumers do in simple mode.
+
+    Redis is spawned from `redis-server` on PATH (TCP + unix socket), otherwise fakeredis TCP server is used
+    (TCP only, good only to compare parsers). REDIS_SOCKET_PATH is not needed, the spawned server has its own socket.
+
+        python -m benchmarks.bench_transport --count 20000
+"""
+
+import argparse
+import time
+
+from redis.utils import HIREDIS_AVAILABLE
+
+from src.histogram import Histogram
+from src.transport import connect
+from benchmarks.bench_e2e import LocalRedis
+
+# name -> (setup, command)
+COMMANDS = {
+    "PING": (lambda r: None, lambda r: r.ping()),
+    "SET": (lambda r: None, lambda r: r.set("bench:key", "x" * 64)),
+    "GET": (lambda r: r.set("bench:key", "x" * 64), lambda r: r.get("bench:key")),
+    "HGETALL(100)": (lambda r: r.hset("bench:hash", mapping={f"field{i}": i for i in range(100)}),
+                     lambda r: r.hgetall("bench:hash")),
+    "XRANGE(100)": (lambda r: [r.xadd("bench:stream", {"processed_message": "x" * 100}) for _ in range(100)],
+                    lambda r: r.xrange("bench:stream", count=100)),
+}
+
+
+def measure(r, command, count: int, warmup: int = 100) -> Histogram:
+    """
+    Latency of `count` calls of command
+
+    """
+    for _ in range(warmup):
+        command(r)
+    latency = Histogram()
+    for _ in range(count):
+        started = time.perf_counter()
+        command(r)
+        latency.record(time.perf_counter() - started)
+    return latency
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transport benchmark: TCP vs unix socket, python vs hiredis parser")
+    parser.add_argument('--count', type=int, default=10000, help="Calls of every command")
+    parser.add_argument('--commands', nargs='+', default=list(COMMANDS), help="Commands to measure")
+    args = parser.parse_args()
+
+    server = LocalRedis()
+    transports = {"tcp": None}
+    if server.socket_path:
+        transports["uds"] = server.socket_path
+    parsers = ["python", "hiredis"] if HIREDIS_AVAILABLE else ["python"]
+    if not HIREDIS_AVAILABLE:
+        print("hiredis is not installed, only python parser is measured")
+
+    print(f"{'transport':<10} {'parser':<8} {'command':<14} {'p50 us':>8} {'p99 us':>8} {'calls/s':>9}")
+    try:
+        server.r.flushall()
+        for name in args.commands:
+            COMMANDS[name][0](server.r)
+        for transport_name, socket_path in transports.items():
+            for parser_name in parsers:
+                r = connect("127.0.0.1", server.port, socket_path=socket_path, parser=parser_name, max_connections=1)
+                for name in args.commands:
+                    started = time.perf_counter()
+                    latency = measure(r, COMMANDS[name][1], args.count)
+                    elapsed = time.perf_counter() - started
+                    print(f"{transport_name:<10} {parser_name:<8} {name:<14} {latency.quantile(0.5) * 1e6:>8.0f} "
+                          f"{latency.quantile(0.99) * 1e6:>8.0f} {args.count / elapsed:>9.0f}")
+                r.close()
+    finally:
+        server.stop()
@@ -2,27 +2,73 @@ import sys
 import signal
 import argparse
 import logging
+import multiprocessing
+import threading
+import time
 import uuid
 
-from multiprocessing import Process
 from src.consumer import ConsumerEngine
-from src.config import consumers_group_size, redis_host, redis_port
+from src.async_consumer import AsyncConsumerEngine
+from src.supervisor import ConsumerSupervisor, ScalingPolicy
+from src.startup import StartupReporter, GroupStartup, stagger
+from src.config import consumers_group_size, consumers_per_process, redis_host, redis_port, autoscale_min, \
+    autoscale_max, consumer_mode, pipeline_transform, pipeline_transform_executor, consumer_start_method, \
+    startup_connect_rate, startup_ready_timeout
 
 logging.basicConfig(level=logging.DEBUG)
 
 # Running section
 
 processes = []
-def start_consumer(consumer_id):
+# Start method of consumer processes, it's chosen once by process_context()
+context = None
+def start_consumer(consumer_id, delay=0.0, events=None):
     '''
     Start consumer
 
     :param consumer_id:
+    :param delay: seconds to wait before connect (ramp-up of the group)
+    :param events: queue of startup events (see startup.py)
     :return:
     '''
+    time.sleep(delay)
     consumer = ConsumerEngine(consumer_id, redis_host, redis_port)
+    if events is not None:
+        consumer.startup = StartupReporter(events, [consumer_id])
     consumer.listen_and_process()
 
+def start_async_consumers(consumer_id_list, delay=0.0, events=None):
+    '''
+    Start many logical consumers in one process
+
+    :param consumer_id_list:
+    :param delay: seconds to wait before connect (ramp-up of the group)
+    :param events: queue of startup events (see startup.py)
+    :return:
+    '''
+    time.sleep(delay)
+    consumer = AsyncConsumerEngine(consumer_id_list, redis_host, redis_port)
+    if events is not None:
+        consumer.startup = StartupReporter(events, consumer_id_list)
+    consumer.listen_and_process()
+
+def process_context(start_method=None):
+    '''
+    Multiprocessing context of consumer processes
+
+    forkserver preloads consumer modules once in the fork server, every consumer is forked from it
+    (no interpreter start and imports, no threads and connections of main inherited)
+
+    :param start_method: fork, forkserver, spawn or None (default of the platform)
+    :return: context
+    '''
+    global context
+    if context is None:
+        context = multiprocessing.get_context(start_method or None)
+        if context.get_start_method() == "forkserver":
+            context.set_forkserver_preload(["__main__", "src.consumer", "src.async_consumer"])
+    return context
+
 def consumer_cleanup(signum, frame):
     """
     Cleanup function to stop all consumers
@@ -35,18 +81,72 @@ def consumer_cleanup(signum, frame):
         process.terminate()
     sys.exit(0)
 
-def create_consumer_group(group_size):
+def spawn_consumer_process(per_process=1, delay=0.0, events=None):
+    """
+    Start one consumer process
+
+    :param per_process: consumers in the process
+    :param delay: seconds the process waits before connect
+    :param events: queue of startup events
+    :return: started process
+    """
+    Process = process_context().Process
+    if per_process == 1:
+        consumer_id = str(uuid.uuid4())  # Уникальный ID для каждого потребителя
+        process = Process(target=start_consumer, args=(consumer_id, delay, events))
+    else:
+        consumer_id_list = [str(uuid.uuid4()) for _ in range(per_process)]
+        process = Process(target=start_async_consumers, args=(consumer_id_list, delay, events))
+    process.daemon = True  # Делаем процесс демоном, чтобы он корректно завершался
+    # Daemonic process can't start process pool of pipeline mode, it's terminated by consumer_cleanup anyway
+    if per_process == 1 and consumer_mode == "pipeline" and pipeline_transform \
+            and pipeline_transform_executor == "process":
+        process.daemon = False
+    process.start()
+    return process
+
+def supervise_consumer_group(min_size, max_size, per_process=1):
+    """
+    Run consumer group under autoscaling supervisor
+
+    :param min_size: min count of processes
+    :param max_size: max count of processes
+    :param per_process: consumers per process
+    """
+    supervisor = ConsumerSupervisor(redis_host, redis_port, spawn=lambda: spawn_consumer_process(per_process),
+                                    policy=ScalingPolicy(min_size=min_size, max_size=max_size))
+
+    def supervisor_cleanup(signum, frame):
+        logging.info("Stopping supervisor and all consumers...")
+        supervisor.stop()
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, supervisor_cleanup)
+    signal.signal(signal.SIGTERM, supervisor_cleanup)
+    supervisor.run()
+
+def create_consumer_group(group_size, per_process=1):
     """
     Run consumer group in separated processes
 
+    With per_process > 1 every process runs `per_process` logical consumers in one event loop,
+    so group of `group_size` consumers needs only ceil(group_size / per_process) processes
+
+    Processes connect at most `startup_connect_rate` per second, the group is watched by readiness barrier:
+    time-to-full-group (all consumers subscribed) and time-to-first-message are logged
+
     :param group_size:
+    :param per_process: consumers per process
     """
-    for _ in range(int(group_size)):
-        consumer_id = str(uuid.uuid4())  # Уникальный ID для каждого потребителя
-        process = Process(target=start_consumer, args=(consumer_id,))
-        process.daemon = True  # Делаем процесс демоном, чтобы он корректно завершался
-        process.start()
-        processes.append(process)
+    group_size, per_process = int(group_size), int(per_process)
+    events = process_context().Queue()
+    startup = GroupStartup(events, group_size)
+    threading.Thread(target=startup.watch, args=(startup_ready_timeout,), daemon=True).start()
+    for index, first in enumerate(range(0, group_size, per_process)):
+        processes.append(spawn_consumer_process(min(per_process, group_size - first),
+                                                stagger(index, startup_connect_rate), events))
+    logging.info(f"{len(processes)} consumer processes are started in {time.time() - startup.started_at:.3f} s "
+                 f"({process_context().get_start_method()})")
 
     # Ждем завершения всех процессов
     for process in processes:
@@ -57,18 +157,35 @@ if __name__ == "__main__":
     # I will parse the command line arguments to allow the user to specify the number of consumers in the group
     parser = argparse.ArgumentParser(description="Конфигурация группы потребителей")
     parser.add_argument('--group_size', type=int, required=False, help="Количество потребителей в группе")
+    parser.add_argument('--processes', type=int, required=False, help="Количество процессов")
+    parser.add_argument('--consumers_per_process', type=int, required=False, help="Количество потребителей в процессе")
+    parser.add_argument('--start_method', default=consumer_start_method,
+                        choices=["", "fork", "forkserver", "spawn"], help="Способ запуска процессов")
+    parser.add_argument('--supervise', action='store_true', help="Автомасштабирование группы")
+    parser.add_argument('--min_size', type=int, default=autoscale_min, help="Минимум процессов (--supervise)")
+    parser.add_argument('--max_size', type=int, default=autoscale_max, help="Максимум процессов (--supervise)")
     args = parser.parse_args()
 
     # If it available in command line i will override default value
     if args.group_size:
         consumers_group_size = int(args.group_size)
+    if args.consumers_per_process:
+        consumers_per_process = int(args.consumers_per_process)
+    # processes x consumers_per_process layout wins over group_size
+    if args.processes:
+        consumers_group_size = int(args.processes) * consumers_per_process
+
+    process_context(args.start_method)
 
     # Registrate signals to correct shutdown
     signal.signal(signal.SIGINT, consumer_cleanup)
     signal.signal(signal.SIGTERM, consumer_cleanup)
 
     # I starting ...
-    create_consumer_group(consumers_group_size)
+    if args.supervise:
+        supervise_consumer_group(args.min_size, args.max_size, consumers_per_process)
+    else:
+        create_consumer_group(consumers_group_size, consumers_per_process)
 
 
 
@@ -0,0 +1,185 @@
+"""
+    On-disk archive of processed stream
+
+    Archive directory:
+        index                - one line per chunk: <segment> <offset> <length> <first id> <last id> <count>
+        <first id>.jsonl.gz  - segment, every chunk of entries is a separate gzip member appended to it
+
+    Segments and index are append-only. Chunk is written (and fsynced) to segment before its line is appended
+    to index, so index never points to a torn chunk: after a crash the torn tail of segment is never read.
+    Chunk is a JSON line per entry {"id": ..., "fields": {...}}, ids in index make it searchable by stream ID.
+"""
+
+import bisect
+import gzip
+import json
+import os
+
+INDEX = "index"
+MAX_ID = (2 ** 64 - 1, 2 ** 64 - 1)
+
+
+def parse_id(entry_id) -> tuple:
+    """
+    Stream ID as comparable tuple
+
+    :param entry_id: "ms-seq", "ms", "-" or "+" (str or bytes)
+    :return: (ms, seq)
+    """
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    if entry_id == "-":
+        return 0, 0
+    if entry_id == "+":
+        return MAX_ID
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+def _text(value) -> str:
+    # Values are not always UTF-8, surrogateescape keeps every byte
+    return value.decode("utf-8", "surrogateescape") if isinstance(value, bytes) else str(value)
+
+
+def _bytes(value: str) -> bytes:
+    return value.encode("utf-8", "surrogateescape")
+
+
+class Chunk:
+    __slots__ = ("segment", "offset", "length", "first_id", "last_id", "count")
+
+    def __init__(self, segment: str, offset: int, length: int, first_id: str, last_id: str, count: int) -> None:
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+        self.first_id = first_id
+        self.last_id = last_id
+        self.count = count
+
+    @classmethod
+    def parse(cls, line: str) -> "Chunk":
+        segment, offset, length, first_id, last_id, count = line.split()
+        return cls(segment, int(offset), int(length), first_id, last_id, int(count))
+
+    def __str__(self) -> str:
+        return f"{self.segment} {self.offset} {self.length} {self.first_id} {self.last_id} {self.count}"
+
+
+def read_index(directory: str) -> list:
+    """
+    Chunks of archive in stream order
+
+    :param directory: archive directory
+    :return: list of Chunk
+    """
+    try:
+        with open(os.path.join(directory, INDEX)) as f:
+            # Torn last line (crash while appending) has not all the columns, it's skipped
+            return [Chunk.parse(line) for line in f if len(line.split()) == 6]
+    except FileNotFoundError:
+        return []
+
+
+class ArchiveWriter:
+    """
+    Append chunks of stream entries to archive (one writer per archive directory)
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024) -> None:
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        chunks = read_index(directory)
+        self.segment = chunks[-1].segment if chunks else None
+        self.last_id = chunks[-1].last_id if chunks else None
+
+    def append(self, entries) -> None:
+        """
+        Write entries as one compressed chunk
+
+        :param entries: list of (entry id, fields) as XRANGE returns them, ids must be after last_id
+        """
+        if not entries:
+            return
+        first_id, last_id = _text(entries[0][0]), _text(entries[-1][0])
+        lines = "".join(json.dumps({"id": _text(entry_id),
+                                    "fields": {_text(k): _text(v) for k, v in fields.items()}}) + "\n"
+                        for entry_id, fields in entries)
+        data = gzip.compress(lines.encode("utf-8", "surrogateescape"))
+
+        if self.segment is None or os.path.getsize(os.path.join(self.directory, self.segment)) >= self.segment_bytes:
+            self.segment = f"{first_id}.jsonl.gz"
+        with open(os.path.join(self.directory, self.segment), "ab") as f:
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(os.path.join(self.directory, INDEX), "a") as f:
+            f.write(f"{Chunk(self.segment, offset, len(data), first_id, last_id, len(entries))}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.last_id = last_id
+
+
+class ArchiveReader:
+    """
+    Read archived entries by range of stream IDs
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def entries(self, start="-", end="+"):
+        """
+        Iterate archived entries in range (both ends inclusive, as XRANGE)
+
+        :param start: stream ID
+        :param end: stream ID
+        :return: iterator of (entry id (bytes), fields {bytes: bytes})
+        """
+        start, end = parse_id(start), parse_id(end)
+        # Index is re-read every time, archiver appends to it
+        chunks = read_index(self.directory)
+        # The first chunk which can contain start
+        first = bisect.bisect_left([parse_id(chunk.last_id) for chunk in chunks], start)
+        for chunk in chunks[first:]:
+            if parse_id(chunk.first_id) > end:
+                return
+            with open(os.path.join(self.directory, chunk.segment), "rb") as f:
+                f.seek(chunk.offset)
+                data = gzip.decompress(f.read(chunk.length))
+            for line in data.decode("utf-8", "surrogateescape").splitlines():
+                entry = json.loads(line)
+                entry_id = parse_id(entry["id"])
+                if entry_id < start:
+                    continue
+                if entry_id > end:
+                    return
+                yield _bytes(entry["id"]), {_bytes(k): _bytes(v) for k, v in entry["fields"].items()}
+
+
+def iter_entries(r, stream: str, reader: ArchiveReader, start="-", end="+", count: int = 1000):
+    """
+    Iterate archived and live entries of stream together
+
+    Entries which are both archived and not trimmed yet are returned once.
+
+    :param r: Redis connection
+    :param stream: stream name
+    :param reader: reader of the stream's archive
+    :param start: stream ID (inclusive)
+    :param end: stream ID (inclusive)
+    :param count: entries per XRANGE call
+    :return: iterator of (entry id (bytes), fields {bytes: bytes})
+    """
+    live_start = start
+    for entry_id, fields in reader.entries(start, end):
+        live_start = f"({entry_id.decode()}"
+        yield entry_id, fields
+
+    while True:
+        entries = r.xrange(stream, min=live_start, max=end, count=count)
+        yield from entries
+        if len(entries) < count:
+            return
+        live_start = f"({_text(entries[-1][0])}"
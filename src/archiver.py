@@ -0,0 +1,81 @@
+"""
+    I'm the Archiver, I move processed stream to disk before it's trimmed.
+
+    Consumers trim processed stream on every XADD (PROCESSED_STREAM_MAXLEN / PROCESSED_STREAM_RETENTION_MS),
+    i tail it by XRANGE in big chunks and write them to compressed append-only segments (see archive.py).
+    If i'm too slow, entries are trimmed before i see them - i will complain about it loudly.
+
+"""
+
+import logging
+import os
+import threading
+import time
+
+import redis
+
+from config import redis_host, redis_port, stream_name, archive_dir, archive_chunk, archive_segment_bytes, \
+    archive_interval, redis_transport, processed_stream_shards
+from archive import ArchiveWriter, parse_id
+from transport import connect
+from shards import shard_names
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class StreamArchiver:
+    def __init__(self, r: redis.Redis, stream: str, writer: ArchiveWriter, chunk: int = archive_chunk) -> None:
+        self.r = r
+        self.stream = stream
+        self.writer = writer
+        self.chunk = chunk
+
+    def archive_once(self) -> int:
+        """
+        Archive the next chunk of stream
+
+        :return: count of archived entries
+        """
+        last_id = self.writer.last_id
+        entries = self.r.xrange(self.stream, min=f"({last_id}" if last_id else "-", count=self.chunk)
+        if not entries:
+            return 0
+        if last_id is not None:
+            # Something after my cursor was trimmed (or deleted), so it's lost for the archive
+            deleted = self.r.xinfo_stream(self.stream).get("max-deleted-entry-id", b"0-0")
+            if parse_id(deleted) > parse_id(last_id):
+                logging.warning(f"Entries of {self.stream} after {last_id} up to {deleted.decode()} were trimmed "
+                                f"before archiving, increase retention of the stream")
+        self.writer.append(entries)
+        return len(entries)
+
+    def run(self) -> None:
+        """
+        Archive forever, sleep only when i caught up with the stream
+
+        """
+        while True:
+            try:
+                archived = self.archive_once()
+            except redis.ConnectionError as e:
+                logging.warning(f"Redis is not available: {e}")
+                archived = 0
+            if archived:
+                logging.info(f"Archived {archived} entries of {self.stream} up to {self.writer.last_id}")
+            if archived < self.chunk:
+                time.sleep(archive_interval)
+
+
+if __name__ == "__main__":
+    r = connect(redis_host, redis_port, **redis_transport)
+    names = shard_names(stream_name, processed_stream_shards)
+    # Every shard of the stream has its own archive (ARCHIVE_DIR/<shard>) and its own thread
+    archivers = [StreamArchiver(r, name, ArchiveWriter(archive_dir if len(names) == 1 else
+                                                       os.path.join(archive_dir, str(shard)), archive_segment_bytes))
+                 for shard, name in enumerate(names)]
+    for archiver in archivers[1:]:
+        threading.Thread(target=archiver.run, daemon=True).start()
+    try:
+        archivers[0].run()
+    except KeyboardInterrupt:
+        logging.info("Archiver stopped")
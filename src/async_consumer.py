@@ -0,0 +1,309 @@
+"""
+    Async Consumer Class
+
+    Many logical consumers in one process: every consumer is a task of one event loop
+    and all of them share one connection pool.
+
+    Every logical consumer keeps its own consumer_id, heartbeat and stats keys,
+    so for ConsumerManager and monitoring it looks exactly like ConsumerEngine.
+
+    Process has only one Pub/Sub subscription, messages from it are dispatched
+    to logical consumers by round-robin. Locks still protect from other processes.
+    Only Pub/Sub ingest backend, simple and script modes are supported; priority lanes, write-behind and
+    instrumentation are not - the engine refuses such config instead of running with other semantics.
+
+    Connectivity:
+
+    - Redis (redis.asyncio)
+    - Signal - SIGINT / SIGTERM cancel all tasks, consumers are unregistered on exit
+             - SIGUSR2 drains: stop listening, process queued messages and exit
+"""
+
+import asyncio
+import itertools
+import logging
+import signal
+import time
+
+from src.config import stream_name, pubsub_channel, stats_name, lock_name, consumer_heartbeats, consumer_mode, lock_ttl, \
+    async_queue_size, ingest_backend, message_codec, stats_flush_interval, stats_flush_count, dedup_backend, \
+    dedup_name, dedup_window, redis_transport, processed_stream_shards, pubsub_partitions, pubsub_rebalance_interval, \
+    pubsub_member_ttl, pubsub_rebalance_grace, priority_lanes, stats_retention, write_behind_queue, \
+    instrument_sample_every
+from src.consumer import make_entry, observe_latencies, stream_trim, trim_kwargs, message_index, indexed_entry
+from src.scripts import PROCESS_MESSAGE, STREAM_AND_INDEX
+from src.codec import get_codec, DecodeError
+from src.stats import StatsAccumulator, stats_key, group_stats_key
+from src.dedup import get_dedup
+from src.transport import connect
+from src.shards import shard_names, shard_for
+from src.partitions import assign, PartitionSubscription
+
+
+class AsyncConsumerEngine:
+    def __init__(self, consumer_id_list: list, redis_host: str, redis_port: str, mode: str = consumer_mode) -> None:
+        if ingest_backend != "pubsub":
+            raise ValueError(f"AsyncConsumerEngine supports only pubsub ingest backend, not {ingest_backend}")
+        if mode not in ("simple", "script"):
+            raise ValueError(f"AsyncConsumerEngine supports only simple and script modes, not {mode}")
+        if priority_lanes:
+            raise ValueError("AsyncConsumerEngine doesn't support priority lanes, use ConsumerEngine")
+        if write_behind_queue:
+            raise ValueError("AsyncConsumerEngine doesn't support write-behind (WRITE_BEHIND_QUEUE), use ConsumerEngine")
+        if instrument_sample_every:
+            raise ValueError("AsyncConsumerEngine doesn't support instrumentation (INSTRUMENT_SAMPLE_EVERY), "
+                             "use ConsumerEngine")
+        # One connection pool for all my logical consumers
+        self.r = connect(redis_host, redis_port, asyncio=True, **redis_transport)
+        self.logical_ids = list(consumer_id_list)
+        self.pubsub_channel = pubsub_channel
+        # Partitioned Pub/Sub: the process listens partitions of all its logical consumers (see partitions.py)
+        self.partitions = PartitionSubscription(shard_names(pubsub_channel, pubsub_partitions),
+                                                pubsub_rebalance_grace) if pubsub_partitions > 1 else None
+        self.rebalance_channel = f"{pubsub_channel}:rebalance"
+        self.next_rebalance = 0.0
+        self.stream_name = stream_name
+        self.stream_shards = shard_names(stream_name, processed_stream_shards)
+        self.stats_name = stats_name
+        self.stats = {consumer_id: StatsAccumulator(stats_key(stats_name, consumer_id), stats_flush_interval,
+                                                    stats_flush_count, group_stats_key(stats_name))
+                      for consumer_id in self.logical_ids}
+        self.lock_name = lock_name
+        self.dedup = get_dedup(dedup_backend, lock_name, dedup_name, lock_ttl, dedup_window,
+                               processed_stream_shards)
+        self.heartbeats = consumer_heartbeats
+        self.codec = get_codec(message_codec)
+        # "simple" or "script", same meaning as for ConsumerEngine
+        self.mode = mode
+        if self.mode == "script":
+            self.process_message_script = self.r.register_script(PROCESS_MESSAGE)
+        # Index of processed messages, written by the same Lua call as XADD (see index.py)
+        self.index = message_index()
+        if self.index is not None:
+            self.stream_and_index_script = self.r.register_script(STREAM_AND_INDEX)
+        # Every logical consumer has its own bounded queue - if it is full, dispatching waits
+        self.queues = [asyncio.Queue(maxsize=async_queue_size) for _ in self.logical_ids]
+        self.targets = itertools.cycle(range(len(self.queues)))
+        # Startup events for main.py (see startup.py), one subscription is shared by all my consumers
+        self.startup = None
+
+    async def process(self, consumer_id: str, data) -> bool:
+        """
+        Lock and stream message on behalf of one logical consumer
+
+        :param consumer_id: logical consumer ID
+        :param data: decoded message
+        :return: True if message was processed
+        """
+        message_id = data.get("message_id")
+
+        if self.mode == "script":
+            key, dedup_field, expire = self.dedup.script_target(message_id, data.get("published_at"))
+            args = [consumer_id, expire, dedup_field, *stream_trim()]
+            keys = [key, shard_for(self.stream_shards, message_id)]
+            if self.index is not None:
+                index_key, index_expire = self.index.target(message_id)
+                keys.append(index_key)
+                args.extend((str(message_id), index_expire))
+            for field, value in make_entry(data, consumer_id).items():
+                args.extend((field, value))
+            if await self.process_message_script(keys=keys, args=args) is None:
+                return False
+            observe_latencies(self.stats[consumer_id], data, done_at=time.time())
+            return True
+
+        locked = await self.dedup.claim(self.r, consumer_id, message_id, data.get("published_at"))
+        for expired in self.dedup.expire(self.r):
+            await expired
+        if not locked:
+            return False
+        locked_at = time.time()
+        stream = shard_for(self.stream_shards, message_id)
+        if self.index is None:
+            await self.r.xadd(stream, make_entry(data, consumer_id), **trim_kwargs())
+        else:
+            keys, args = indexed_entry(self.index, stream, message_id, consumer_id, make_entry(data, consumer_id))
+            await self.stream_and_index_script(keys=keys, args=args)
+        observe_latencies(self.stats[consumer_id], data, locked_at, time.time())
+        return True
+
+    async def consume(self, consumer_id: str, queue: asyncio.Queue) -> None:
+        """
+        Logical consumer: process messages from its queue
+
+        :param consumer_id: logical consumer ID
+        :param queue: queue of (decoded message, payload size)
+        """
+        stats = self.stats[consumer_id]
+        while True:
+            data, size = await queue.get()
+            try:
+                if await self.process(consumer_id, data):
+                    stats.add(processed_messages=1, bytes_processed=size)
+                else:
+                    stats.add(lock_misses=1)
+            finally:
+                queue.task_done()
+
+    async def dispatch(self, data, size: int = 0) -> None:
+        """
+        Put decoded message to the queue of the next logical consumer
+
+        :param data: decoded message
+        :param size: size of payload
+        """
+        await self.queues[next(self.targets)].put((data, size))
+
+    async def listen(self) -> None:
+        """
+        Single Pub/Sub subscription of the process
+
+        """
+        pubsub = self.r.pubsub()
+        if self.partitions is None:
+            await pubsub.subscribe(self.pubsub_channel)
+            logging.info(f"{len(self.logical_ids)} consumers subscribed {self.pubsub_channel}")
+            async for message in pubsub.listen():
+                await self.on_message(message)
+            return
+
+        await pubsub.subscribe(**{self.rebalance_channel: self.on_rebalance_notice})
+        await self.r.zadd(self.heartbeats, {consumer_id: time.time() for consumer_id in self.logical_ids})
+        await self.rebalance(pubsub)
+        await self.r.publish(self.rebalance_channel, ",".join(self.logical_ids))
+        while True:
+            # Reply to SUBSCRIBE tells me that i'm subscribed, on_message skips it
+            message = await pubsub.get_message(timeout=1.0)
+            if message is not None:
+                await self.on_message(message)
+            if time.monotonic() >= self.next_rebalance:
+                await self.rebalance(pubsub)
+
+    async def on_message(self, message) -> None:
+        """
+        Decode Pub/Sub message and dispatch it
+
+        """
+        if message['type'] != 'message':
+            if message['type'] == 'subscribe' and self.startup is not None:
+                self.startup.report("subscribed")
+            return
+        if self.startup is not None:
+            self.startup.report("first_message")
+            self.startup = None
+        try:
+            data = self.codec.loads(message['data'])
+        except DecodeError:
+            data = None
+        if not isinstance(data, dict) or "message_id" not in data:
+            # Nobody of my consumers took it, so i will blame the next one
+            self.stats[self.logical_ids[next(self.targets)]].add(decode_errors=1)
+            return
+        await self.dispatch(data, len(message['data']))
+
+    def on_rebalance_notice(self, message) -> None:
+        self.next_rebalance = 0.0
+
+    async def rebalance(self, pubsub) -> None:
+        """
+        Move subscriptions to partitions assigned to my logical consumers now
+
+        """
+        self.next_rebalance = time.monotonic() + pubsub_rebalance_interval
+        since = time.time() - pubsub_member_ttl
+        members = {member.decode() for member in await self.r.zrangebyscore(self.heartbeats, since, "+inf")}
+        assignment = assign(members | set(self.logical_ids), pubsub_partitions)
+        wanted = {partition for consumer_id in self.logical_ids for partition in assignment[consumer_id]}
+        subscribe, unsubscribe = self.partitions.update(wanted, time.time())
+        if subscribe:
+            await pubsub.subscribe(*subscribe)
+        if unsubscribe:
+            await pubsub.unsubscribe(*unsubscribe)
+        if subscribe or unsubscribe:
+            logging.info(f"Consumers {', '.join(self.logical_ids)} rebalanced: +{subscribe} -{unsubscribe}")
+
+    async def flush_stats(self, heartbeat: bool = False) -> None:
+        """
+        Flush stats of logical consumers by one pipeline
+
+        :param heartbeat: flush all of them and refresh their heartbeats, otherwise flush only those which are due
+        """
+        async with self.r.pipeline(transaction=False) as pipe:
+            for stats in self.stats.values():
+                if heartbeat or stats.due():
+                    stats.flush(pipe)
+            if heartbeat:
+                now = time.time()
+                pipe.zadd(self.heartbeats, {consumer_id: now for consumer_id in self.logical_ids})
+                for stats in self.stats.values():
+                    pipe.persist(stats.key)
+            if len(pipe):
+                await pipe.execute()
+
+    async def keep_alive(self) -> None:
+        """
+        Register all logical consumers, flush their stats and refresh their heartbeats each 10 seconds
+
+        """
+        await self.r.zadd(self.heartbeats, {consumer_id: time.time() for consumer_id in self.logical_ids})
+        logging.info(f"Consumers {', '.join(self.logical_ids)} were registered")
+        last_heartbeat = time.monotonic()
+        while True:
+            heartbeat = time.monotonic() - last_heartbeat >= 10
+            await self.flush_stats(heartbeat)
+            if heartbeat:
+                last_heartbeat = time.monotonic()
+            await asyncio.sleep(stats_flush_interval)
+
+    async def drain(self, main_task: asyncio.Task) -> None:
+        """
+        Stop listening, wait until all queued messages are processed and stop
+
+        :param main_task: task of run()
+        """
+        logging.info(f"Consumers {', '.join(self.logical_ids)} draining ...")
+        self.listen_task.cancel()
+        for queue in self.queues:
+            await queue.join()
+        main_task.cancel()
+
+    async def run(self) -> None:
+        """
+        Run all logical consumers until SIGINT / SIGTERM
+
+        """
+        loop = asyncio.get_running_loop()
+        main_task = asyncio.current_task()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, main_task.cancel)
+        loop.add_signal_handler(signal.SIGUSR2, lambda: loop.create_task(self.drain(main_task)))
+
+        # My scripts are loaded once, before all my consumers call them by sha
+        if self.index is not None:
+            await self.r.script_load(STREAM_AND_INDEX)
+        try:
+            async with asyncio.TaskGroup() as tasks:
+                tasks.create_task(self.keep_alive())
+                self.listen_task = tasks.create_task(self.listen())
+                for consumer_id, queue in zip(self.logical_ids, self.queues):
+                    tasks.create_task(self.consume(consumer_id, queue))
+        except asyncio.CancelledError:
+            logging.info(f"Consumers {', '.join(self.logical_ids)} stopping ...")
+        finally:
+            # I will remove all my consumers from the list of active consumers (with their last stats)
+            async with self.r.pipeline(transaction=False) as pipe:
+                for stats in self.stats.values():
+                    stats.flush(pipe)
+                    pipe.expire(stats.key, stats_retention)
+                pipe.zrem(self.heartbeats, *self.logical_ids)
+                if self.partitions is not None:
+                    pipe.publish(self.rebalance_channel, ",".join(self.logical_ids))
+                await pipe.execute()
+            await self.r.aclose()
+
+    def listen_and_process(self) -> None:
+        """
+        Same entrypoint as ConsumerEngine.listen_and_process
+
+        """
+        asyncio.run(self.run())
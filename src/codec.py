@@ -0,0 +1,131 @@
+"""
+    Message codecs
+
+    Wire codec is shared by publisher and consumer:
+    - json    - stdlib, always available
+    - orjson  - same wire format as json, much faster (if orjson is installed)
+    - msgpack - binary wire format, publisher and consumers must use it both (if msgpack is installed)
+    - auto    - orjson if it's installed, otherwise json
+
+    `processed_message` in the processed stream is always JSON, it's encoded by the fastest
+    available JSON encoder. When the payload came in JSON, it's extended with new fields
+    without decode -> re-encode round trip (see extend_json).
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class DecodeError(ValueError):
+    """
+    Payload can't be decoded by the codec
+    """
+
+
+def encode_json(obj) -> bytes:
+    """
+    Encode object to compact JSON by the fastest available encoder
+
+    orjson refuses what stdlib accepts - integers wider than 64 bits, keys which are not strings (msgpack) -
+    so such an object is encoded by stdlib
+
+    :param obj:
+    :return: JSON bytes
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass
+    return json.dumps(obj, separators=(",", ":")).encode('utf-8')
+
+
+def extend_json(raw: bytes, fields: dict) -> bytes:
+    """
+    Add fields to JSON object without decoding it
+
+    :param raw: JSON object (bytes), fields must not be in it yet
+    :param fields: new fields
+    :return: JSON bytes
+    """
+    raw = raw.rstrip()
+    if not fields:
+        return raw
+    extra = encode_json(fields)
+    # Empty object doesn't need a comma
+    if raw[:-1].rstrip().endswith(b"{"):
+        return raw[:-1].rstrip() + extra[1:]
+    return raw[:-1] + b"," + extra[1:]
+
+
+class JsonCodec:
+    name = "json"
+    # Payload is JSON, so it can be extended by extend_json
+    is_json = True
+
+    def loads(self, data: bytes):
+        try:
+            return json.loads(data)
+        except ValueError as e:
+            raise DecodeError(str(e)) from e
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode('utf-8')
+
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def loads(self, data: bytes):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError as e:
+            raise DecodeError(str(e)) from e
+
+    def dumps(self, obj) -> bytes:
+        return orjson.dumps(obj)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    is_json = False
+
+    def loads(self, data: bytes):
+        try:
+            return msgpack.unpackb(data)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise DecodeError(str(e)) from e
+
+    def dumps(self, obj) -> bytes:
+        return msgpack.packb(obj)
+
+
+def available_codecs() -> list:
+    """
+    Names of codecs which can be used in this environment
+
+    """
+    return ["json"] + (["orjson"] if orjson is not None else []) + (["msgpack"] if msgpack is not None else [])
+
+
+def get_codec(name: str = "auto"):
+    """
+    Get codec by name
+
+    :param name: json, orjson, msgpack or auto
+    :return: codec object
+    """
+    if name == "auto":
+        name = "orjson" if orjson is not None else "json"
+    if name not in available_codecs():
+        raise ValueError(f"Codec {name} is not available, available codecs: {', '.join(available_codecs())}")
+    return {"json": JsonCodec, "orjson": OrjsonCodec, "msgpack": MsgpackCodec}[name]()
@@ -3,17 +3,177 @@ import os
 # Redis settings
 redis_host = os.getenv("REDIS_HOST","localhost")
 redis_port = os.getenv("REDIS_PORT", 6379)
+# Transport of all services (see transport.py): unix socket of co-located Redis instead of host/port,
+# blocking pool of REDIS_MAX_CONNECTIONS per client (wait up to REDIS_POOL_TIMEOUT seconds for a free one),
+# RESP parser: auto (hiredis if installed), hiredis or python
+redis_socket_path = os.getenv("REDIS_SOCKET_PATH") or None
+redis_max_connections = int(os.getenv("REDIS_MAX_CONNECTIONS", 16))
+redis_pool_timeout = float(os.getenv("REDIS_POOL_TIMEOUT", 20))
+redis_parser = os.getenv("REDIS_PARSER", "auto")
+# Command timeout is off by default (blocking reads), it must be longer than STREAM_BLOCK_MS if it's set
+redis_socket_timeout = float(os.getenv("REDIS_SOCKET_TIMEOUT")) if os.getenv("REDIS_SOCKET_TIMEOUT") else None
+redis_connect_timeout = float(os.getenv("REDIS_CONNECT_TIMEOUT", 5))
+redis_health_check_interval = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30))
+redis_transport = dict(socket_path=redis_socket_path, max_connections=redis_max_connections,
+                       pool_timeout=redis_pool_timeout, parser=redis_parser, socket_timeout=redis_socket_timeout,
+                       connect_timeout=redis_connect_timeout, health_check_interval=redis_health_check_interval)
 
 # Channels, streams, and key names
 pubsub_channel = os.getenv("PUBSUB_CHANNEL","messages:published")
 stream_name = os.getenv("STREAM_NAME","messages:processed")
+# Retention of processed stream, applied by XADD with approximate trimming (~):
+# by age (MINID, milliseconds) if it's set, otherwise by length (MAXLEN), 0 - unbounded (default).
+# Trimmed entries are gone, so set them only together with the archiver (archiver.py)
+processed_stream_retention_ms = int(os.getenv("PROCESSED_STREAM_RETENTION_MS", 0))
+processed_stream_maxlen = int(os.getenv("PROCESSED_STREAM_MAXLEN", 0))
+# Processed stream is split into so many shards by hash of message_id (see shards.py), 1 - single STREAM_NAME key.
+# Retention (MAXLEN) is applied to every shard
+processed_stream_shards = int(os.getenv("PROCESSED_STREAM_SHARDS", 1))
+# Layout of processed stream entries (see entries.py): "legacy" - message_id, processed_by, processed_message (JSON),
+# created_at; "compact" - every field once, integer milliseconds, messages of ENTRY_COMPRESS_MIN_BYTES and longer
+# are compressed by zlib (0 - never) with preset dictionary from ENTRY_DICTIONARY file (python -m src.entries train)
+processed_entry_format = os.getenv("PROCESSED_ENTRY_FORMAT", "legacy")
+entry_compress_min_bytes = int(os.getenv("ENTRY_COMPRESS_MIN_BYTES", 256))
+entry_dictionary = os.getenv("ENTRY_DICTIONARY", "")
+# Index of processed messages (see index.py): message_id -> stream entry ID and consumer, kept in hashes
+# INDEX_NAME:<bucket> (INDEX_NAME:{shard}:<bucket> with sharded stream) of INDEX_BUCKET_SECONDS, written by the same
+# call as XADD. Every message is found at least INDEX_RETENTION seconds, 0 - no index
+index_name = os.getenv("INDEX_NAME", "consumer:index")
+index_retention = int(os.getenv("INDEX_RETENTION", 0))
+index_bucket_seconds = int(os.getenv("INDEX_BUCKET_SECONDS", 3600))
 stats_name = os.getenv("STATS_NAME","consumer:stats")
+# Stats hash of a consumer which left (or was removed as inactive) expires after so many seconds,
+# its counters are in the group stats hash (STATS_NAME:group) already
+stats_retention = int(os.getenv("STATS_RETENTION", 3600))
 lock_name = os.getenv("LOCK_NAME","consumer:lock")
+# Dedup store of consumers: "key" - lock key per message (LOCK_NAME:<id>, lock_ttl),
+# "bucket" - time-bucketed hashes (DEDUP_NAME:<bucket>) remembering claims at least DEDUP_WINDOW seconds
+dedup_backend = os.getenv("DEDUP_BACKEND", "key")
+dedup_name = os.getenv("DEDUP_NAME", "consumer:dedup")
+# Legacy registry (set of ids + last_activity keys), ConsumerManager migrates it to heartbeats sorted set
 consumer_ids = os.getenv("CONSUMER_IDS","consumer:ids")
+# Registry of consumers: member - consumer id, score - unix time of the last heartbeat
+consumer_heartbeats = os.getenv("CONSUMER_HEARTBEATS", "consumer:heartbeats")
+input_stream = os.getenv("INPUT_STREAM", "messages:input")
+input_group = os.getenv("INPUT_GROUP", "consumers")
+
+# Partitioned Pub/Sub (see partitions.py): publisher routes every message to one of PUBSUB_PARTITIONS channels
+# PUBSUB_CHANNEL:{i} by hash of message_id, consumers subscribe only to partitions assigned to them
+# (1 - one channel for everybody). Assignment is checked each PUBSUB_REBALANCE_INTERVAL seconds and at once when
+# a consumer joins or leaves; consumer is a member while its heartbeat is younger than PUBSUB_MEMBER_TTL seconds.
+# Partition moved to another consumer is kept PUBSUB_REBALANCE_GRACE seconds more (locks drop duplicates).
+# Messages of a partition nobody hears are lost: partitions of a crashed consumer until PUBSUB_MEMBER_TTL and
+# a moved partition while its new owner learns about the move later than the grace period of the old one ends
+pubsub_partitions = int(os.getenv("PUBSUB_PARTITIONS", 1))
+pubsub_rebalance_interval = float(os.getenv("PUBSUB_REBALANCE_INTERVAL", 5))
+pubsub_member_ttl = float(os.getenv("PUBSUB_MEMBER_TTL", 30))
+pubsub_rebalance_grace = float(os.getenv("PUBSUB_REBALANCE_GRACE", 10))
+
+# Wire codec of messages (publisher and consumers): auto (orjson if installed, otherwise json), json, orjson, msgpack
+message_codec = os.getenv("MESSAGE_CODEC", "auto")
 
 # Consumer settings
 consumers_group_size = os.getenv("GROUP_SIZE",100)
+# More than one consumer per process runs them as tasks of AsyncConsumerEngine
+consumers_per_process = int(os.getenv("CONSUMERS_PER_PROCESS", 1))
+async_queue_size = int(os.getenv("ASYNC_QUEUE_SIZE", 1000))
+# Execution mode: "simple" - separated round-trips per message, "script" - one Lua call per message,
+# "batch" - messages are collected to batches and locked/streamed by pipelines,
+# "pipeline" - staged pipeline with queues and thread/process pools (PIPELINE_* settings)
+consumer_mode = os.getenv("CONSUMER_MODE", "simple")
+lock_ttl = int(os.getenv("LOCK_TTL", 5))
+dedup_window = int(os.getenv("DEDUP_WINDOW", lock_ttl))
+# Consumer stats are flushed to its hash after so many events or seconds (and on every heartbeat)
+stats_flush_count = int(os.getenv("STATS_FLUSH_COUNT", 1000))
+stats_flush_interval = float(os.getenv("STATS_FLUSH_INTERVAL", 1))
+# Batch mode: batch is flushed when it has batch_size messages or batch_linger_ms passed since its first message
+batch_size = int(os.getenv("BATCH_SIZE", 500))
+batch_linger_ms = float(os.getenv("BATCH_LINGER_MS", 5))
+batch_report_interval = float(os.getenv("BATCH_REPORT_INTERVAL", 30))
+# Pipeline mode (see pipeline.py): decode -> filter -> transform -> sink (lock + XADD by batches of batch mode),
+# stages are connected by bounded queues of PIPELINE_QUEUE_SIZE. PIPELINE_FILTER / PIPELINE_TRANSFORM are
+# "module:function" of decoded message (filter returns bool, transform returns the new message), empty - no stage.
+# PIPELINE_TRANSFORM_EXECUTOR: thread or process (CPU bound transform, process pool of PIPELINE_TRANSFORM_WORKERS)
+pipeline_filter = os.getenv("PIPELINE_FILTER", "")
+pipeline_transform = os.getenv("PIPELINE_TRANSFORM", "")
+pipeline_transform_executor = os.getenv("PIPELINE_TRANSFORM_EXECUTOR", "thread")
+pipeline_transform_workers = int(os.getenv("PIPELINE_TRANSFORM_WORKERS", 2))
+pipeline_decode_workers = int(os.getenv("PIPELINE_DECODE_WORKERS", 1))
+pipeline_queue_size = int(os.getenv("PIPELINE_QUEUE_SIZE", 1000))
+# Stage counters go to stats hash and log so often (seconds)
+pipeline_report_interval = float(os.getenv("PIPELINE_REPORT_INTERVAL", 5))
+# Write-behind of processed messages (see writebehind.py), simple / batch / pipeline modes with Pub/Sub ingest:
+# the loop queues messages and goes on, a thread claims and streams them by pipelines of WRITE_BEHIND_BATCH. Over
+# WRITE_BEHIND_QUEUE entries in memory (0 - off) they are spilled to WRITE_BEHIND_DIR and replayed when Redis is back,
+# failed writes are retried with backoff up to WRITE_BEHIND_RETRY_MAX seconds. On exit queued entries are written for
+# WRITE_BEHIND_CLOSE_TIMEOUT seconds, the rest stays spilled for the next consumer on the host
+write_behind_queue = int(os.getenv("WRITE_BEHIND_QUEUE", 0))
+write_behind_batch = int(os.getenv("WRITE_BEHIND_BATCH", 500))
+write_behind_dir = os.getenv("WRITE_BEHIND_DIR", "spill")
+write_behind_retry_max = float(os.getenv("WRITE_BEHIND_RETRY_MAX", 5))
+write_behind_close_timeout = float(os.getenv("WRITE_BEHIND_CLOSE_TIMEOUT", 5))
+# Priority lanes (see lanes.py), Pub/Sub ingest without partitions, simple / script / batch modes:
+# "name:weight,..." in priority order, e.g. "high:8,bulk:1" (empty - off). Every lane is the channel
+# PUBSUB_CHANNEL:lane:<name> (publisher --lane <name>). Consumer keeps up to LANE_QUEUE_SIZE messages in local lane
+# queues and serves them by LANE_POLICY: "weighted" - fair share by weights, "priority" - strict order, but a lane
+# which waits LANE_STARVATION_MS is served first. Per-lane throughput and waits are logged every LANE_REPORT_INTERVAL
+priority_lanes = os.getenv("LANES", "")
+lane_policy = os.getenv("LANE_POLICY", "weighted")
+lane_queue_size = int(os.getenv("LANE_QUEUE_SIZE", 10000))
+lane_starvation_ms = float(os.getenv("LANE_STARVATION_MS", 200))
+lane_report_interval = float(os.getenv("LANE_REPORT_INTERVAL", 30))
+# Hot path instrumentation (see instrument.py): every INSTRUMENT_SAMPLE_EVERY-th message is timed step by step
+# (0 - off). It's changed at runtime by fields of INSTRUMENT_NAME hash: sample_every, sample_every:<consumer_id>,
+# profile:<consumer_id> (seconds of cProfile + tracemalloc window), profiles are saved to INSTRUMENT_DIR
+instrument_name = os.getenv("INSTRUMENT_NAME", "consumer:instrument")
+instrument_sample_every = int(os.getenv("INSTRUMENT_SAMPLE_EVERY", 0))
+instrument_dir = os.getenv("INSTRUMENT_DIR", "profiles")
+# Ingest backend: "pubsub" - every consumer gets every message and races on lock,
+# "stream" - consumer group on input stream, every message is delivered to only one consumer
+ingest_backend = os.getenv("INGEST_BACKEND", "pubsub")
+input_stream_maxlen = int(os.getenv("INPUT_STREAM_MAXLEN", 1000000))
+stream_read_count = int(os.getenv("STREAM_READ_COUNT", 100))
+stream_block_ms = int(os.getenv("STREAM_BLOCK_MS", 1000))
+stream_claim_interval = float(os.getenv("STREAM_CLAIM_INTERVAL", 30))
+stream_claim_min_idle_ms = int(os.getenv("STREAM_CLAIM_MIN_IDLE_MS", 30000))
+
+# Start of consumer group (main.py, see startup.py): start method of processes - fork, forkserver (modules are
+# preloaded once by the fork server) or spawn, empty - default of the platform. Processes connect at most
+# STARTUP_CONNECT_RATE per second (0 - all at once), readiness of the whole group is waited STARTUP_READY_TIMEOUT seconds
+consumer_start_method = os.getenv("CONSUMER_START_METHOD", "")
+startup_connect_rate = float(os.getenv("STARTUP_CONNECT_RATE", 0))
+startup_ready_timeout = float(os.getenv("STARTUP_READY_TIMEOUT", 60))
+
+# Autoscaling supervisor settings (main.py --supervise), sizes are in processes
+autoscale_min = int(os.getenv("AUTOSCALE_MIN", 1))
+autoscale_max = int(os.getenv("AUTOSCALE_MAX", 100))
+autoscale_step = int(os.getenv("AUTOSCALE_STEP", 1))
+autoscale_interval = float(os.getenv("AUTOSCALE_INTERVAL", 5))
+autoscale_cooldown = float(os.getenv("AUTOSCALE_COOLDOWN", 30))
+# Backlog: "stream" backend - lag + pending entries of input group,
+# "pubsub" backend - the biggest output buffer of subscriber (bytes)
+autoscale_up_backlog = int(os.getenv("AUTOSCALE_UP_BACKLOG", 10000))
+autoscale_down_backlog = int(os.getenv("AUTOSCALE_DOWN_BACKLOG", 100))
+# Shrink only after so many calm checks in a row
+autoscale_down_checks = int(os.getenv("AUTOSCALE_DOWN_CHECKS", 3))
+drain_timeout = float(os.getenv("DRAIN_TIMEOUT", 30))
+
+# Prometheus metrics endpoint of monitoring service (GET /metrics)
+metrics_host = os.getenv("METRICS_HOST", "0.0.0.0")
+metrics_port = int(os.getenv("METRICS_PORT", 9108))
+
+# Archiver of processed stream: compressed append-only segments on disk
+archive_dir = os.getenv("ARCHIVE_DIR", "archive")
+# Entries per XRANGE call (and per compressed chunk of segment)
+archive_chunk = int(os.getenv("ARCHIVE_CHUNK", 10000))
+archive_segment_bytes = int(os.getenv("ARCHIVE_SEGMENT_BYTES", 64 * 1024 * 1024))
+# Pause when archiver caught up with the stream (seconds)
+archive_interval = float(os.getenv("ARCHIVE_INTERVAL", 1))
+
+# Traffic capture (traffic.py): segment files of captured Pub/Sub messages
+capture_dir = os.getenv("CAPTURE_DIR", "captures")
+capture_segment_bytes = int(os.getenv("CAPTURE_SEGMENT_BYTES", 64 * 1024 * 1024))
 
 # Consumer manager settings
 consumer_manager_ttl = float(os.getenv("CONSUMER_MANAGER_TTL", 60))
-consumer_manager_interval = os.getenv("CONSUMER_MANAGER_INTERVAL", 10)
\ No newline at end of file
+consumer_manager_interval = os.getenv("CONSUMER_MANAGER_INTERVAL", 10)
@@ -30,40 +30,275 @@
         :signal
             SIGINT
             SIGTERM
+            SIGUSR1 - log timings of hot path steps (see instrument.py)
+            SIGUSR2 - drain: stop taking new messages, finish taken ones and exit
 """
 
 import signal
 import threading
 import time
 import sys
+from collections import Counter
+from functools import partial, lru_cache
 
 import redis
-import json
 import random
 import logging
 
-from src.config import stream_name, pubsub_channel, stats_name, lock_name, consumer_ids
+from src.config import stream_name, pubsub_channel, stats_name, lock_name, consumer_heartbeats, consumer_mode, lock_ttl, \
+    ingest_backend, input_stream, input_group, stream_read_count, stream_block_ms, stream_claim_interval, \
+    stream_claim_min_idle_ms, consumer_manager_ttl, batch_size, batch_linger_ms, batch_report_interval, \
+    message_codec, stats_flush_interval, stats_flush_count, processed_stream_retention_ms, processed_stream_maxlen, \
+    dedup_backend, dedup_name, dedup_window, redis_transport, processed_stream_shards, pubsub_partitions, \
+    pubsub_rebalance_interval, pubsub_member_ttl, pubsub_rebalance_grace, pipeline_filter, pipeline_transform, \
+    pipeline_transform_executor, pipeline_transform_workers, pipeline_decode_workers, pipeline_queue_size, \
+    pipeline_report_interval, instrument_name, instrument_sample_every, instrument_dir, processed_entry_format, \
+    entry_compress_min_bytes, entry_dictionary, index_name, index_retention, index_bucket_seconds, write_behind_queue, \
+    write_behind_batch, write_behind_dir, write_behind_retry_max, write_behind_close_timeout, priority_lanes, \
+    lane_policy, lane_queue_size, lane_starvation_ms, lane_report_interval, stats_retention
+from src.scripts import PROCESS_MESSAGE, STREAM_AND_INDEX
+from src.codec import get_codec, encode_json, extend_json, DecodeError
+from src.stats import StatsAccumulator, stats_key, group_stats_key
+from src.histogram import Histogram
+from src.dedup import get_dedup
+from src.transport import connect
+from src.shards import shard_names, shard_for
+from src.partitions import assign, PartitionSubscription
+from src.pipeline import Stage, StagePipeline, load_function
+from src.instrument import Instrumentation
+from src.entries import CompactLayout, load_dictionary
+from src.index import MessageIndex
+from src.writebehind import WriteBehind
+from src.lanes import LaneScheduler, parse_lanes, lane_channel
 
 # I will show ALL HAPPENING in my life
 DEBUG = False
 
+
+@lru_cache(maxsize=None)
+def compact_layout():
+    """
+    Compact layout of processed stream entries (see entries.py), None - legacy one
+
+    Dictionary is loaded once per process
+    """
+    if processed_entry_format == "legacy":
+        return None
+    if processed_entry_format != "compact":
+        raise ValueError(f"Unknown entry format {processed_entry_format}, use legacy or compact")
+    return CompactLayout(entry_compress_min_bytes, load_dictionary(entry_dictionary))
+
+
+def make_entry(message, consumer_id: str, raw: bytes = None) -> dict:
+    """
+    Enrich message and build Redis Stream entry from it
+
+    :param message: decoded message
+    :param consumer_id: ID of consumer which processed message
+    :param raw: message as it came in JSON, if available - it will be extended instead of re-encoding
+    :return: stream entry fields
+    """
+    # I will add some additional information to message about consumer, because it was processed it
+    # and I will add some random property
+    extra = {'processed_by': consumer_id, 'random_property': random.random()}
+    layout = compact_layout()
+    if layout is not None:
+        # ... as fields of their own, the message is stored as it came
+        return layout.build(raw if raw is not None else encode_json(message), consumer_id,
+                            extra['random_property'], time.time())
+    if raw is not None and not extra.keys() & message.keys():
+        processed_message = extend_json(raw, extra)
+        message.update(extra)
+    else:
+        message.update(extra)
+        processed_message = encode_json(message)
+
+    return {
+        "message_id": message["message_id"],
+        "processed_by": consumer_id,
+        "processed_message": processed_message,
+        "created_at": time.time()
+    }
+
+
+def stream_trim() -> tuple:
+    """
+    Trimming of processed stream applied by every XADD
+
+    It's approximate (~), so Redis drops only whole macro nodes and it costs almost nothing
+
+    :return: ("MINID", id) by retention, ("MAXLEN", count) or ("", "") if stream is unbounded
+    """
+    if processed_stream_retention_ms:
+        return "MINID", f"{int(time.time() * 1000) - processed_stream_retention_ms}-0"
+    if processed_stream_maxlen:
+        return "MAXLEN", processed_stream_maxlen
+    return "", ""
+
+
+def trim_kwargs() -> dict:
+    """
+    stream_trim as keyword arguments of redis-py xadd
+    """
+    strategy, threshold = stream_trim()
+    return {strategy.lower(): threshold, "approximate": True} if strategy else {}
+
+
+def message_index():
+    """
+    Index of processed messages (see index.py), None - it's off
+    """
+    if not index_retention:
+        return None
+    return MessageIndex(index_name, index_retention, index_bucket_seconds, processed_stream_shards)
+
+
+def lane_scheduler():
+    """
+    Scheduler of priority lanes (see lanes.py), None - they are off
+    """
+    if not priority_lanes:
+        return None
+    return LaneScheduler(parse_lanes(priority_lanes), lane_policy, lane_starvation_ms / 1000)
+
+
+def indexed_entry(index: MessageIndex, stream: str, message_id, consumer_id: str, fields: dict) -> tuple:
+    """
+    KEYS and ARGV of STREAM_AND_INDEX script
+
+    :param index: message index
+    :param stream: shard of processed stream
+    :param fields: stream entry
+    :return: (keys, args)
+    """
+    key, expire_at = index.target(message_id)
+    args = [*stream_trim(), str(message_id), consumer_id, expire_at]
+    for field, value in fields.items():
+        args.extend((field, value))
+    return [stream, key], args
+
+
+def observe_latencies(stats: StatsAccumulator, message, locked_at: float = None, done_at: float = None,
+                      lane: str = None) -> None:
+    """
+    Record latencies of processed message (if publisher stamped it)
+
+    :param stats: stats of consumer which processed message
+    :param message: decoded message
+    :param locked_at: time of acquired lock, None if lock and XADD were one call
+    :param done_at: time of acknowledged XADD
+    :param lane: priority lane of message, its end to end latency is recorded as stage end_to_end@<lane> too
+    """
+    published_at = message.get("published_at")
+    if not isinstance(published_at, (int, float)):
+        return
+    if lane is not None:
+        stats.observe(**{f"end_to_end@{lane}": done_at - published_at})
+    if locked_at is None:
+        stats.observe(end_to_end=done_at - published_at)
+    else:
+        stats.observe(publish_to_lock=locked_at - published_at, lock_to_xadd=done_at - locked_at,
+                      end_to_end=done_at - published_at)
+
+
+def filter_message(function, item):
+    """
+    Filter stage of pipeline mode
+
+    :param function: (decoded message) -> bool
+    :param item: (decoded message, payload)
+    :return: item or None
+    """
+    return item if function(item[0]) else None
+
+
+def transform_message(function, item):
+    """
+    Transform stage of pipeline mode (it runs in process pool too, so it's module level)
+
+    :param function: (decoded message) -> new message
+    :param item: (decoded message, payload)
+    :return: (new message, payload)
+    """
+    return function(item[0]), item[1]
+
+
 class ConsumerEngine:
-    def __init__(self, consumer_id: str, redis_host: str, redis_port: str) -> None:
-        # Hello, Redis! Connection to Redis (Sorry, simplest way)
-        self.r = redis.Redis(host=redis_host, port=redis_port)
+    def __init__(self, consumer_id: str, redis_host: str, redis_port: str, mode: str = consumer_mode) -> None:
+        # Hello, Redis! My pool is shared by my Pub/Sub loop and my keep_alive thread (see transport.py)
+        self.r = connect(redis_host, redis_port, **redis_transport)
         # My Unique ID for self instance of consumer
         self.consumer_id = consumer_id
         # as a consumer i will subscribe to this channel
         self.pubsub_channel = pubsub_channel
-        # all processed messages i will store in this stream
+        # ... or only to my share of its partitions, and i will hear about my colleagues on the rebalance channel
+        self.pubsub_partitions = pubsub_partitions
+        self.partitions = PartitionSubscription(shard_names(pubsub_channel, pubsub_partitions),
+                                                pubsub_rebalance_grace) if pubsub_partitions > 1 else None
+        self.rebalance_channel = f"{pubsub_channel}:rebalance"
+        self.next_rebalance = 0.0
+        # all processed messages i will store in this stream (in its shard chosen by message_id)
         self.stream_name = stream_name
+        self.stream_shards = shard_names(stream_name, processed_stream_shards)
         # i think is better to collect some additional information.
-        # For example get some stats, like count of processed messages and last_activity time
+        # For example get some stats, like count of processed messages
         self.stats_name = stats_name
+        # I will count in memory and flush my stats to my hash (and to the hash of the whole group) from time to time
+        self.stats = StatsAccumulator(stats_key(stats_name, consumer_id), stats_flush_interval, stats_flush_count,
+                                      group_stats_key(stats_name))
+        # ... and time steps of my hot path when i'm asked to (control hash is read with every heartbeat)
+        self.instrument = Instrumentation(consumer_id, instrument_sample_every, instrument_dir)
+        self.instrument_name = instrument_name
         # I will use locking mechanism for message processing and here will be my lock's
         self.lock_name = lock_name
-        # I will register myself on connection.
-        self.consumer_ids = consumer_ids
+        # ... or cheaper time-bucketed hashes, it depends on dedup backend
+        self.dedup = get_dedup(dedup_backend, lock_name, dedup_name, lock_ttl, dedup_window,
+                               processed_stream_shards)
+        # I will register myself on connection and put my heartbeats here (score is the time of heartbeat)
+        self.heartbeats = consumer_heartbeats
+        # I will decode messages by the same codec as publisher encodes them
+        self.codec = get_codec(message_codec)
+        # Where i will get messages from: "pubsub" - channel, "stream" - consumer group on input stream
+        self.ingest_backend = ingest_backend
+        self.input_stream = input_stream
+        self.input_group = input_group
+        # How i will process messages: "simple" - step by step, "script" - lock and XADD in one Lua call
+        self.mode = mode
+        if self.mode == "script":
+            # I will load my script once and call it by sha (it will be reloaded on NOSCRIPT)
+            self.process_message_script = self.r.register_script(PROCESS_MESSAGE)
+            self.r.script_load(PROCESS_MESSAGE)
+        # I will remember where every processed message went (entry ID comes from XADD, so XADD and index entry
+        # go by one Lua call)
+        self.index = message_index()
+        if self.index is not None:
+            self.stream_and_index_script = self.r.register_script(STREAM_AND_INDEX)
+            self.r.script_load(STREAM_AND_INDEX)
+        # I will listen to lane channels and serve my local lane queues by priority (see lanes.py).
+        # Config is checked before my write-behind thread starts and locks its spill directory
+        self.lanes = lane_scheduler()
+        if self.lanes is not None:
+            if ingest_backend != "pubsub" or self.partitions is not None or mode not in ("simple", "script", "batch"):
+                raise ValueError("Lanes need pubsub ingest without partitions and simple, script or batch mode")
+            self.lane_channels = {lane_channel(pubsub_channel, name): name for name in self.lanes.order}
+            # Served messages and waits in my lane queues since the last lane report
+            self.lane_served = Counter()
+            self.lane_waits = {name: Histogram() for name in self.lanes.order}
+        # Redis shouldn't be in my Pub/Sub loop: i will only queue messages and my writer thread will claim and stream
+        # them (see writebehind.py). Script mode and stream ingest need the result in place
+        self.write_behind = None
+        self.write_behind_reported = {}
+        if write_behind_queue and self.mode in ("simple", "batch", "pipeline") and ingest_backend == "pubsub":
+            self.write_behind = WriteBehind(self.claim_and_write, write_behind_dir, consumer_id, write_behind_queue,
+                                            write_behind_batch, write_behind_retry_max)
+            self.write_behind.start()
+        # Sizes of my batches (batch mode) - i will report their distribution from time to time
+        self.batch_sizes = Counter()
+        # When i am retired i will finish what i have and leave
+        self.draining = False
+        self.pubsub = None
+        # main.py wants to know when i'm subscribed and when my first message came (see startup.py)
+        self.startup = None
         # I will be keep to be alive
         self.keep_alive_thread = threading.Thread(target=self.keep_alive, daemon=True)
         # A was born ...
@@ -73,7 +308,8 @@ class ConsumerEngine:
         # Register signal handlers for shutdown
         signal.signal(signal.SIGINT, self.shutdown)
         signal.signal(signal.SIGTERM, self.shutdown)
-
+        signal.signal(signal.SIGUSR2, self.drain)
+        signal.signal(signal.SIGUSR1, self.dump_instrumentation)
 
     def shutdown(self, signum, frame) -> None:
         """
@@ -85,25 +321,81 @@ class ConsumerEngine:
         # She don't like me ...
         if DEBUG:
             logging.info(f"Consumer {self.consumer_id} stopping ...")
-        # Exactly, i will remove myself from the list of active consumers
-        self.r.srem("consumer:ids", self.consumer_id)
+        # I will not lose my queued entries (the rest is spilled) and my stats,
+        # and exactly, i will remove myself from the list of active consumers
+        self.close_write_behind()
+        self.leave()
         # And I will close Redis connection
         self.r.close()
         # Bang Bang - i kill myself ...
         sys.exit(0)
 
-    def acquire_lock(self, message_id) -> bool:
+    def drain(self, signum, frame) -> None:
+        """
+        Stop taking new messages, listening loop will finish taken ones and retire me
+
+        note: please keep unused variables in the function signature.
+        In needs to be there for signal handler
+        """
+        logging.info(f"Consumer {self.consumer_id} draining ...")
+        self.draining = True
+        # Messages sent before UNSUBSCRIBE are still delivered to me and will be processed
+        if self.pubsub is not None:
+            self.pubsub.unsubscribe()
+
+    def dump_instrumentation(self, signum, frame) -> None:
+        """
+        Log timings of hot path steps
+
+        note: please keep unused variables in the function signature.
+        In needs to be there for signal handler
+        """
+        logging.info(f"Consumer {self.consumer_id} timings (sample every {self.instrument.sample_every}):\n"
+                     f"{self.instrument.report()}")
+
+    def retire(self) -> None:
+        """
+        Leave the group after draining
+
+        """
+        self.close_write_behind()
+        self.leave()
+        self.r.close()
+        logging.info(f"Consumer {self.consumer_id} drained and retired")
+
+    def close_write_behind(self) -> None:
+        if self.write_behind is not None:
+            self.write_behind.close(write_behind_close_timeout)
+            self.write_behind = None
+
+    def leave(self) -> None:
+        """
+        Flush the last stats and unregister by one pipeline, my stats hash expires after STATS_RETENTION
+
+        """
+        pipe = self.r.pipeline(transaction=False)
+        self.stats.flush(pipe)
+        pipe.expire(self.stats.key, stats_retention)
+        pipe.zrem(self.heartbeats, self.consumer_id)
+        if self.partitions is not None:
+            # My partitions are free, my colleagues will take them at once
+            pipe.publish(self.rebalance_channel, self.consumer_id)
+        pipe.execute()
+
+    def acquire_lock(self, message_id, published_at=None) -> bool:
         """
         Acquire redis-based lock for message processing
 
         :param message_id:
+        :param published_at: publish time of the message (bucket of bucket dedup store)
         :return:
         """
-        # I will use lock name with message_id as a unique identifier.
-        _lock_name = f"{self.lock_name}:{message_id}"
+        # I will use lock name with message_id as a unique identifier (or message_id in bucket of dedup store).
         # i decide that [ex=5 and nx=True] is more that enough because i will do it only if lock is not exists
         # so i will set this lock for 5 seconds. If my colleague will try to acquire it also, he will skip this message
-        return self.r.set(_lock_name, self.consumer_id, nx=True, ex=5)
+        locked = self.dedup.claim(self.r, self.consumer_id, message_id, published_at)
+        self.dedup.expire(self.r)
+        return locked
 
     def listen_and_process(self) -> None:
         """
@@ -111,60 +403,848 @@ class ConsumerEngine:
 
         :return:
         """
+        if self.ingest_backend == "stream":
+            self.consume_stream()
+            return self.retire()
+
         # I will use Pub/Sub for listening to messages
-        pubsub = self.r.pubsub()
-        # I will subscribe to Pub/Sub channel
-        pubsub.subscribe(self.pubsub_channel)
+        pubsub = self.pubsub = self.r.pubsub()
+        if self.partitions is not None:
+            self.join_partitions(pubsub)
+        elif self.lanes is not None:
+            pubsub.subscribe(*self.lane_channels)
+            self.confirm_subscription(pubsub)
+            logging.info(f"Consumer {self.consumer_id} subscribed lanes {', '.join(self.lane_channels)}")
+        else:
+            # I will subscribe to Pub/Sub channel
+            pubsub.subscribe(self.pubsub_channel)
+            self.confirm_subscription(pubsub)
+            logging.info(f"Consumer {self.consumer_id} subscribed {self.pubsub_channel}")
+
+        if self.lanes is not None:
+            self.listen_and_process_lanes(pubsub)
+            return self.retire()
+
+        if self.mode == "batch":
+            self.listen_and_process_batches(pubsub)
+            return self.retire()
 
-        logging.info(f"Consumer {self.consumer_id} subscribed {self.pubsub_channel}")
+        if self.mode == "pipeline":
+            self.listen_and_process_pipeline(pubsub)
+            return self.retire()
 
-        # I listen ether while i am alive
+        if self.partitions is not None:
+            self.listen_partitions(pubsub)
+            return self.retire()
+
+        # I listen ether while i am alive (or until i am unsubscribed by drain)
         for message in pubsub.listen():
             # I will process only messages
             if message['type'] == 'message':
-                # I will try to parse message data
-                data = json.loads(message['data'].decode('utf-8'))
-                # I will get message_id
-                message_id = data.get("message_id")
-                # As a good boy i will try to acquire lock for message and process it on success
-                if self.acquire_lock(message_id):
-                    if DEBUG:
-                        logging.info(f"Consumer {self.consumer_id} acquired lock for message {message_id}")
-                    self.process_message(data)
-
-                    # I will count processed messages
-                    _counting_processed = f"{self.stats_name}:{self.consumer_id}:processed_messages"
-                    self.r.incr(_counting_processed)
-
-                    # I will update last_activity time
-                    _updating_last_processed = f"{self.stats_name}:{self.consumer_id}:last_activity"
-                    self.r.set(_updating_last_processed, time.time(), ex=60)
-
-    def process_message(self, message) -> None:
+                self.on_message(message['data'])
+        self.retire()
+
+    def join_partitions(self, pubsub) -> None:
         """
-        Process message and stream it to Redis Stream
+        Subscribe rebalance channel and my partitions, then tell my colleagues about me
 
-        :param message:
+        :param pubsub: PubSub object
+        """
+        # Rebalance notices are handled by get_message() itself, they never come as messages
+        pubsub.subscribe(**{self.rebalance_channel: self.on_rebalance_notice})
+        self.confirm_subscription(pubsub)
+        # I must be in the registry before my colleagues recount it
+        self.r.zadd(self.heartbeats, {self.consumer_id: time.time()})
+        self.rebalance(pubsub)
+        self.r.publish(self.rebalance_channel, self.consumer_id)
+
+    def confirm_subscription(self, pubsub, timeout: float = 5.0) -> None:
+        """
+        Wait for the reply to my first SUBSCRIBE and report that i'm subscribed (only if main.py waits for it)
+
+        Nothing can come before the reply, so no message is lost here
+
+        :param pubsub: PubSub object, just subscribed
+        :param timeout: seconds
+        """
+        if self.startup is None:
+            return
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            message = pubsub.get_message(timeout=deadline - time.monotonic())
+            if message is not None and message['type'] == 'subscribe':
+                self.startup.report("subscribed")
+                return
+        logging.warning(f"Consumer {self.consumer_id} got no reply to SUBSCRIBE in {timeout} s")
+
+    def first_message(self) -> None:
+        """
+        Report my first message, the startup is over for me
+
+        """
+        self.startup.report("first_message")
+        self.startup = None
+
+    def on_rebalance_notice(self, message) -> None:
+        """
+        Somebody joined or left, i will recount my partitions at once
+
+        """
+        self.next_rebalance = 0.0
+
+    def rebalance_due(self) -> bool:
+        return self.partitions is not None and time.monotonic() >= self.next_rebalance
+
+    def active_members(self) -> set:
+        """
+        Consumers with fresh heartbeat (me included)
+
+        """
+        since = time.time() - pubsub_member_ttl
+        return {member.decode() for member in self.r.zrangebyscore(self.heartbeats, since, "+inf")} | {
+            self.consumer_id}
+
+    def rebalance(self, pubsub) -> None:
+        """
+        Move my subscriptions to partitions assigned to me now
+
+        :param pubsub: PubSub object
+        """
+        self.next_rebalance = time.monotonic() + pubsub_rebalance_interval
+        # Draining unsubscribed everything, i will not come back
+        if self.draining:
+            return
+        wanted = assign(self.active_members(), self.pubsub_partitions)[self.consumer_id]
+        subscribe, unsubscribe = self.partitions.update(wanted, time.time())
+        if subscribe:
+            pubsub.subscribe(*subscribe)
+        if unsubscribe:
+            pubsub.unsubscribe(*unsubscribe)
+        if subscribe or unsubscribe:
+            logging.info(f"Consumer {self.consumer_id} rebalanced: +{subscribe} -{unsubscribe}, "
+                         f"partitions {sorted(self.partitions.owned)}")
+
+    def listen_partitions(self, pubsub) -> None:
+        """
+        listen_and_process for partitioned Pub/Sub: i wake up every second to check my assignment
+
+        :param pubsub: subscribed PubSub object
+        """
+        while pubsub.subscribed:
+            message = pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is not None and message['type'] == 'message':
+                self.on_message(message['data'])
+            if self.rebalance_due():
+                self.rebalance(pubsub)
+
+    def decode(self, payload: bytes):
+        """
+        Decode payload, undecodable ones are counted and skipped
+
+        :param payload: message as it came from publisher
+        :return: decoded message or None
+        """
+        try:
+            data = self.codec.loads(payload)
+        except DecodeError:
+            data = None
+        if not isinstance(data, dict) or "message_id" not in data:
+            if DEBUG:
+                logging.info(f"Consumer {self.consumer_id} can't decode message {payload[:100]}")
+            self.stats.add(decode_errors=1)
+            return None
+        return data
+
+    def on_message(self, payload: bytes, lane: str = None) -> bool:
+        """
+        Decode, process and count one message
+
+        :param payload: message as it came from publisher
+        :param lane: priority lane of message, it's counted by lane too (stats fields lane:<lane>:<counter>)
+        :return: True if message was processed by me, None - it's queued for my writer thread
+        """
+        if self.startup is not None:
+            self.first_message()
+        instrument = self.instrument
+        instrument.begin()
+        # I will try to parse message data
+        started = instrument.clock()
+        data = self.decode(payload)
+        instrument.record("decode", started)
+        if data is None:
+            return False
+        if self.write_behind is not None:
+            # My writer thread will claim and stream it and count it, i don't wait for Redis
+            started = instrument.clock()
+            self.queue_message(data, payload, lane)
+            instrument.record("queue", started)
+            return None
+        processed = self.handle_message(data, payload if self.codec.is_json else None, lane)
+        self.count_claim(processed, len(payload), lane)
+        if self.stats.due():
+            started = instrument.clock()
+            self.flush_stats()
+            instrument.record("stats", started)
+        return processed
+
+    def count_claim(self, processed: bool, size: int, lane: str = None) -> None:
+        """
+        Count one claimed message (processed_messages and bytes_processed) or lock miss
+
+        :param size: bytes of payload
+        :param lane: priority lane of message
+        """
+        counters = {"processed_messages": 1, "bytes_processed": size} if processed else {"lock_misses": 1}
+        if lane is not None:
+            counters[f"lane:{lane}:{'processed_messages' if processed else 'lock_misses'}"] = 1
+        self.stats.add(**counters)
+
+    def flush_stats(self, heartbeat: bool = False) -> None:
+        """
+        Flush accumulated stats to my stats hash by one pipeline
+
+        :param heartbeat: refresh my score in heartbeats sorted set too
+        """
+        pipe = self.r.pipeline(transaction=False)
+        if heartbeat and self.write_behind is not None:
+            self.report_write_behind(pipe)
+        self.stats.flush(pipe)
+        if heartbeat:
+            pipe.zadd(self.heartbeats, {self.consumer_id: time.time()})
+            # I'm alive, my stats hash must not expire (if the manager took me for dead)
+            pipe.persist(self.stats.key)
+        # Empty pipeline is not sent at all
+        pipe.execute()
+
+    def report_write_behind(self, pipe) -> None:
+        """
+        Counters of write-behind go to my stats (writebehind:<counter>), queue depth and spilled entries
+        which are not replayed yet are set as they are
+
+        :param pipe: pipeline of flush_stats
+        """
+        snapshot = self.write_behind.snapshot()
+        gauges = {f"writebehind:{name}": snapshot.pop(name) for name in ("queued", "spill_pending")}
+        deltas = {f"writebehind:{name}": value - self.write_behind_reported.get(name, 0)
+                  for name, value in snapshot.items()}
+        self.write_behind_reported = snapshot
+        self.stats.add(**deltas)
+        pipe.hset(self.stats.key, mapping=gauges)
+
+    def handle_message(self, data, raw: bytes = None, lane: str = None) -> bool:
+        """
+        Lock and process one decoded message
+
+        :param data: decoded message
+        :param raw: JSON payload of the message (if it came in JSON)
+        :param lane: priority lane of message
+        :return: True if message was processed by me
+        """
+        instrument = self.instrument
+        if self.mode == "script":
+            started = instrument.clock()
+            processed = self.process_message_atomic(data, raw)
+            instrument.record("script", started)
+            if processed:
+                observe_latencies(self.stats, data, done_at=time.time(), lane=lane)
+            return processed
+
+        # I will get message_id
+        message_id = data.get("message_id")
+        # As a good boy i will try to acquire lock for message and process it on success
+        started = instrument.clock()
+        locked = self.acquire_lock(message_id, data.get("published_at"))
+        instrument.record("lock", started)
+        if not locked:
+            return False
+        locked_at = time.time()
+        if DEBUG:
+            logging.info(f"Consumer {self.consumer_id} acquired lock for message {message_id}")
+        started = instrument.clock()
+        self.process_message(data, raw)
+        instrument.record("xadd", started)
+        observe_latencies(self.stats, data, locked_at, time.time(), lane)
+        return True
+
+    def collect_batch(self, pubsub) -> list:
+        """
+        Drain Pub/Sub messages until batch is full or linger time of the batch is over
+
+        :param pubsub: subscribed PubSub object
+        :return: list of (decoded message, payload) pairs (can be empty)
+        """
+        batch = []
+        deadline = None
+        while len(batch) < batch_size:
+            # I wait for the first message of the batch and linger only for the rest
+            timeout = 1.0 if deadline is None else max(0.0, deadline - time.monotonic())
+            message = pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+            if message is None:
+                # While i'm waiting for the first message, rebalance of partitions can't wait
+                if deadline is None and pubsub.subscribed and not self.rebalance_due():
+                    continue
+                break
+            if message['type'] == 'message':
+                data = self.decode(message['data'])
+                if data is None:
+                    continue
+                batch.append((data, message['data']))
+                if deadline is None:
+                    deadline = time.monotonic() + batch_linger_ms / 1000
+        return batch
+
+    def handle_batch(self, batch, raw: bool = True, lane: str = None) -> int:
+        """
+        Lock batch of messages in one pipeline and stream the winners with one more pipeline
+
+        :param batch: list of (decoded message, payload) pairs
+        :param raw: payloads are the messages as they are (not transformed), JSON ones are extended without encoding
+        :param lane: priority lane of the whole batch
+        :return: count of processed messages (0 with write-behind, my writer thread claims them)
+        """
+        raw = raw and self.codec.is_json
+        if self.startup is not None:
+            self.first_message()
+        instrument = self.instrument
+        instrument.begin()
+        started = instrument.clock()
+        if self.write_behind is not None:
+            for data, payload in batch:
+                self.queue_message(data, payload, lane, raw)
+            instrument.record("batch_queue", started)
+            return 0
+        pipe = self.r.pipeline(transaction=False)
+        for data, _ in batch:
+            self.dedup.claim(pipe, self.consumer_id, data.get("message_id"), data.get("published_at"))
+        # Expiration of new buckets goes after the claims, their results are not needed
+        self.dedup.expire(pipe)
+        won = [item for item, locked in zip(batch, pipe.execute()) if locked]
+        locked_at = time.time()
+        instrument.record("batch_lock", started)
+
+        counters = {"processed_messages": len(won), "lock_misses": len(batch) - len(won),
+                    "bytes_processed": sum(len(payload) for _, payload in won)}
+        if lane is not None:
+            counters.update({f"lane:{lane}:processed_messages": len(won),
+                             f"lane:{lane}:lock_misses": len(batch) - len(won)})
+        self.stats.add(**counters)
+        if won:
+            started = instrument.clock()
+            pipe = self.r.pipeline(transaction=False)
+            trim = trim_kwargs()
+            for data, payload in won:
+                self.queue_entry(pipe, data.get("message_id"), self.build_entry(data, payload if raw else None), trim)
+            # Stats go with the same pipeline when it's time
+            if self.stats.due():
+                self.stats.flush(pipe)
+            self.execute_entries(pipe)
+            done_at = time.time()
+            instrument.record("batch_xadd", started)
+            for data, _ in won:
+                observe_latencies(self.stats, data, locked_at, done_at, lane)
+        elif self.stats.due():
+            self.flush_stats()
+        return len(won)
+
+    def listen_and_process_batches(self, pubsub) -> None:
+        """
+        Batch mode of listen_and_process
+
+        :param pubsub: subscribed PubSub object
         :return:
+        """
+        last_report = time.time()
+        while pubsub.subscribed:
+            batch = self.collect_batch(pubsub)
+            if batch:
+                self.batch_sizes[len(batch)] += 1
+                self.handle_batch(batch)
+            if self.rebalance_due():
+                self.rebalance(pubsub)
+            if time.time() - last_report >= batch_report_interval:
+                self.report_batch_sizes()
+                last_report = time.time()
+
+    def listen_and_process_lanes(self, pubsub) -> None:
+        """
+        Lanes of listen_and_process: i read what came to my lane channels into my lane queues without waiting,
+        then serve the next message (batch mode - the next batch_size messages, one batch per lane) chosen
+        by the scheduler
+
+        :param pubsub: subscribed PubSub object
+        """
+        lanes = self.lanes
+        last_report = time.time()
+        # After drain i finish what is in my queues
+        while pubsub.subscribed or len(lanes):
+            self.read_lanes(pubsub)
+            if self.mode == "batch":
+                batches = {}
+                for lane, payload, waited in lanes.take(batch_size):
+                    self.lane_served[lane] += 1
+                    self.lane_waits[lane].record(waited)
+                    data = self.decode(payload)
+                    if data is not None:
+                        batches.setdefault(lane, []).append((data, payload))
+                for lane, batch in batches.items():
+                    self.batch_sizes[len(batch)] += 1
+                    self.handle_batch(batch, lane=lane)
+            else:
+                served = lanes.next()
+                if served is not None:
+                    lane, payload, waited = served
+                    self.lane_served[lane] += 1
+                    self.lane_waits[lane].record(waited)
+                    self.on_message(payload, lane)
+            if time.time() - last_report >= lane_report_interval:
+                self.report_lanes(time.time() - last_report)
+                last_report = time.time()
+
+    def read_lanes(self, pubsub) -> None:
+        """
+        Move messages which came to my lane queues (up to lane_queue_size), i wait only when my queues are empty
+
+        :param pubsub: subscribed PubSub object
+        """
+        lanes = self.lanes
+        timeout = 0.0 if len(lanes) else 1.0
+        while len(lanes) < lane_queue_size:
+            message = pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+            if message is None:
+                return
+            timeout = 0.0
+            if message['type'] == 'message':
+                channel = message['channel']
+                lanes.put(self.lane_channels[channel.decode() if isinstance(channel, bytes) else channel],
+                          message['data'])
+
+    def report_lanes(self, elapsed: float) -> None:
+        """
+        Log throughput, queue depth and wait in my queue of every lane
+
+        :param elapsed: seconds since the previous report
+        """
+        lines = []
+        for lane in self.lanes.order:
+            wait = self.lane_waits[lane]
+            lines.append(f"{lane} {self.lane_served[lane] / max(elapsed, 1e-9):.0f}/s queued {self.lanes.queued(lane)}"
+                         f" wait p99 {wait.quantile(0.99) * 1000:.2f} ms")
+        self.lane_served = Counter()
+        self.lane_waits = {name: Histogram() for name in self.lanes.order}
+        logging.info(f"Consumer {self.consumer_id} lanes: " + ", ".join(lines))
 
+    def build_pipeline(self) -> StagePipeline:
         """
+        Stages of pipeline mode: decode -> filter -> transform -> sink (handle_batch)
 
-        # I will add some additional information to message about myself, because i was processed it
-        message['processed_by'] = self.consumer_id
-        # and I will add some random property
-        message['random_property'] = random.random()
+        :return: not started pipeline
+        """
+        stages = [Stage("decode", self.decode_item, workers=pipeline_decode_workers, queue_size=pipeline_queue_size)]
+        if pipeline_filter:
+            stages.append(Stage("filter", partial(filter_message, load_function(pipeline_filter)),
+                                queue_size=pipeline_queue_size))
+        if pipeline_transform:
+            stages.append(Stage("transform", partial(transform_message, load_function(pipeline_transform)),
+                                executor=pipeline_transform_executor, workers=pipeline_transform_workers,
+                                queue_size=pipeline_queue_size))
+        # Transformed messages can't be extended as they came, they are encoded again
+        return StagePipeline(stages, partial(self.handle_batch, raw=not pipeline_transform), batch_size,
+                             batch_linger_ms / 1000, pipeline_queue_size)
+
+    def decode_item(self, payload: bytes):
+        """
+        Decode stage of pipeline mode
+
+        :return: (decoded message, payload) or None
+        """
+        data = self.decode(payload)
+        return None if data is None else (data, payload)
+
+    def listen_and_process_pipeline(self, pubsub) -> None:
+        """
+        Pipeline mode of listen_and_process: i only read Pub/Sub and feed the pipeline,
+        when it's full i wait (messages wait in Redis)
 
+        :param pubsub: subscribed PubSub object
+        """
+        pipeline = self.build_pipeline()
+        pipeline.start()
+        last_report = time.monotonic()
+        while pubsub.subscribed:
+            message = pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is not None and message['type'] == 'message':
+                pipeline.put(message['data'])
+            if self.rebalance_due():
+                self.rebalance(pubsub)
+            if time.monotonic() - last_report >= pipeline_report_interval:
+                self.report_stages(pipeline, time.monotonic() - last_report)
+                last_report = time.monotonic()
+        # Everything what's taken is processed before i retire
+        pipeline.close()
+        self.report_stages(pipeline, time.monotonic() - last_report)
+
+    def report_stages(self, pipeline: StagePipeline, elapsed: float) -> None:
+        """
+        Count stage counters into my stats hash and log throughput of stages
+
+        Stage with busy close to 100% of its workers and full queue in front of it is the bottleneck
+
+        :param pipeline: running pipeline
+        :param elapsed: seconds since the previous report
+        """
+        lines = []
+        for name, counters in pipeline.snapshot().items():
+            queued = counters.pop("queued")
+            if counters:
+                self.stats.add(**{f"stage:{name}:{counter}": value for counter, value in counters.items()})
+            workers = next((stage.workers for stage in pipeline.stages if stage.name == name), 1)
+            busy = counters["busy_us"] / 1e6 / max(elapsed, 1e-9) / workers
+            lines.append(f"{name} {counters['in'] / max(elapsed, 1e-9):.0f}/s busy {busy:.0%} queued {queued}")
+        logging.info(f"Consumer {self.consumer_id} stages: " + ", ".join(lines))
+
+    def batch_size_distribution(self) -> dict:
+        """
+        Distribution of achieved batch sizes
+
+        :return: dict with count of batches, mean, p50, p90, p99 and max batch size
+        """
+        batches = sum(self.batch_sizes.values())
+        if not batches:
+            return {"batches": 0}
+        distribution = {"batches": batches,
+                        "mean": sum(size * count for size, count in self.batch_sizes.items()) / batches}
+        seen = 0
+        percentiles = [("p50", 0.5), ("p90", 0.9), ("p99", 0.99)]
+        for size in sorted(self.batch_sizes):
+            seen += self.batch_sizes[size]
+            while percentiles and seen >= percentiles[0][1] * batches:
+                distribution[percentiles.pop(0)[0]] = size
+        distribution["max"] = max(self.batch_sizes)
+        return distribution
+
+    def report_batch_sizes(self) -> None:
+        """
+        Log distribution of achieved batch sizes
+
+        :return:
+        """
+        distribution = self.batch_size_distribution()
+        if distribution["batches"]:
+            logging.info(f"Consumer {self.consumer_id} batches: {distribution['batches']}, "
+                         f"mean {distribution['mean']:.1f}, p50 {distribution['p50']}, p90 {distribution['p90']}, "
+                         f"p99 {distribution['p99']}, max {distribution['max']}")
+
+    def build_entry(self, message, raw: bytes = None) -> dict:
+        """
+        Enrich message and build Redis Stream entry from it
+
+        :param message:
+        :param raw: JSON payload of the message (optional)
+        :return: stream entry fields
+        """
+        return make_entry(message, self.consumer_id, raw)
+
+    def queue_entry(self, pipe, message_id, fields: dict, trim: dict) -> None:
+        """
+        Queue XADD of processed message to pipeline (with its index entry, if index is on)
+
+        :param pipe: pipeline
+        :param message_id: ID of message
+        :param fields: stream entry
+        :param trim: trim_kwargs of the pipeline
+        """
+        stream = shard_for(self.stream_shards, message_id)
+        if self.index is None:
+            pipe.xadd(stream, fields, **trim)
+            return
+        # Script object in pipeline checks SCRIPT EXISTS before every execute, raw EVALSHA doesn't
+        keys, args = indexed_entry(self.index, stream, message_id, self.consumer_id, fields)
+        pipe.evalsha(self.stream_and_index_script.sha, len(keys), *keys, *args)
+
+    def execute_entries(self, pipe) -> list:
+        """
+        Execute pipeline of queue_entry calls
+
+        If Redis lost my script (restart, SCRIPT FLUSH), its EVALSHA calls fail by NOSCRIPT and only they
+        are repeated after SCRIPT LOAD. The first other error is raised, as pipeline does it.
+
+        :return: results of pipeline
+        """
+        if self.index is None:
+            return pipe.execute()
+        commands = list(pipe.command_stack)
+        results = pipe.execute(raise_on_error=False)
+        failed = [i for i, result in enumerate(results) if isinstance(result, redis.exceptions.NoScriptError)]
+        if failed:
+            self.r.script_load(STREAM_AND_INDEX)
+            retry = self.r.pipeline(transaction=False)
+            for i in failed:
+                args, options = commands[i]
+                retry.execute_command(*args, **options)
+            for i, result in zip(failed, retry.execute(raise_on_error=False)):
+                results[i] = result
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def queue_message(self, data, payload: bytes, lane: str = None, raw: bool = True) -> None:
+        """
+        Queue message for my writer thread (write-behind), it never waits for Redis
+
+        :param data: decoded message
+        :param payload: message as it came
+        :param lane: priority lane of message
+        :param raw: payload is the message as it is (not transformed)
+        """
+        meta = {"bytes": len(payload)}
+        if isinstance(data.get("published_at"), (int, float)):
+            meta["published_at"] = data["published_at"]
+        if lane is not None:
+            meta["lane"] = lane
+        self.write_behind.put(data.get("message_id"),
+                              self.build_entry(data, payload if raw and self.codec.is_json else None), meta)
+
+    def claim_and_write(self, entries: list) -> int:
+        """
+        Writer of write-behind: claim messages by one pipeline, stream the winners by another one,
+        then my stats if it's time
+
+        Result of the claim is noted in meta of entry, so a retried batch (or its spill) is not claimed again
+
+        :param entries: list of (message_id, fields, meta) - meta of queue_message
+        :return: count of streamed entries
+        """
+        unclaimed = [(message_id, meta) for message_id, _, meta in entries if "claimed" not in meta]
+        if unclaimed:
+            pipe = self.r.pipeline(transaction=False)
+            for message_id, meta in unclaimed:
+                self.dedup.claim(pipe, self.consumer_id, message_id, meta.get("published_at"))
+            self.dedup.expire(pipe)
+            results = pipe.execute()
+            locked_at = time.time()
+            for (_, meta), locked in zip(unclaimed, results):
+                meta["claimed"] = bool(locked)
+                meta["locked_at"] = locked_at
+                self.count_claim(meta["claimed"], meta.get("bytes", 0), meta.get("lane"))
+        won = [entry for entry in entries if entry[2]["claimed"]]
+        if won:
+            pipe = self.r.pipeline(transaction=False)
+            trim = trim_kwargs()
+            for message_id, fields, _ in won:
+                self.queue_entry(pipe, message_id, fields, trim)
+            self.execute_entries(pipe)
+            done_at = time.time()
+            for _, _, meta in won:
+                observe_latencies(self.stats, meta, meta["locked_at"], done_at, meta.get("lane"))
+        if self.stats.due():
+            self.flush_stats()
+        return len(won)
+
+    def process_message(self, message, raw: bytes = None) -> None:
+        """
+        Process message and stream it to Redis Stream
+
+        :param message:
+        :param raw: JSON payload of the message (optional)
+        :return:
+
+        """
         # I will send data to Redis Stream according to my life rules
-        self.r.xadd(self.stream_name, {
-            "message_id": message["message_id"],
-            "processed_by": self.consumer_id,
-            "processed_message": json.dumps(message),
-            "created_at": time.time()
-        })
+        stream = shard_for(self.stream_shards, message.get("message_id"))
+        if self.index is None:
+            self.r.xadd(stream, self.build_entry(message, raw), **trim_kwargs())
+        else:
+            keys, args = indexed_entry(self.index, stream, message.get("message_id"), self.consumer_id,
+                                       self.build_entry(message, raw))
+            self.stream_and_index_script(keys=keys, args=args)
 
         if DEBUG:
             logging.info(f"Message {message['message_id']} was processed by: {self.consumer_id} and streamed")
 
+    def process_message_atomic(self, message, raw: bytes = None) -> bool:
+        """
+        Lock and stream message in one round-trip to Redis (Lua script)
+
+        Stream entry has the same layout as in process_message
+
+        :param message:
+        :param raw: JSON payload of the message (optional)
+        :return: True if message was processed by me
+        """
+        message_id = message.get("message_id")
+        key, field, expire = self.dedup.script_target(message_id, message.get("published_at"))
+        keys = [key, shard_for(self.stream_shards, message_id)]
+        args = [self.consumer_id, expire, field, *stream_trim()]
+        if self.index is not None:
+            index_key, index_expire = self.index.target(message_id)
+            keys.append(index_key)
+            args.extend((str(message_id), index_expire))
+        for field, value in self.build_entry(message, raw).items():
+            args.extend((field, value))
+        processed = self.process_message_script(keys=keys, args=args) is not None
+
+        if DEBUG and processed:
+            logging.info(f"Message {message_id} was processed by: {self.consumer_id} and streamed (script)")
+        return processed
+
+    def ensure_input_group(self) -> None:
+        """
+        Create consumer group on input stream if it is not exists yet
+
+        :return:
+        """
+        try:
+            self.r.xgroup_create(self.input_stream, self.input_group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            # BUSYGROUP - one of my colleagues was faster
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def consume_stream(self) -> None:
+        """
+        I will read input stream as a member of consumer group.
+        Every message is delivered only to one of us, so no locks are needed.
+
+        :return:
+        """
+        self.ensure_input_group()
+        logging.info(f"Consumer {self.consumer_id} joined group {self.input_group} on {self.input_stream}")
+        if self.startup is not None:
+            self.startup.report("subscribed")
+
+        last_claim = time.time()
+        while not self.draining:
+            self.read_stream_batch()
+            # From time to time i will pick up messages of my dead colleagues
+            if time.time() - last_claim >= stream_claim_interval:
+                self.reclaim_pending()
+                last_claim = time.time()
+
+    def read_stream_batch(self) -> int:
+        """
+        Blocking read of one batch from input stream
+
+        :return: count of processed messages
+        """
+        response = self.r.xreadgroup(self.input_group, self.consumer_id, {self.input_stream: ">"},
+                                     count=stream_read_count, block=stream_block_ms)
+        processed = 0
+        instrument = self.instrument
+        for _, entries in response or []:
+            if self.startup is not None:
+                self.first_message()
+            instrument.begin()
+            started = instrument.clock()
+            processed += self.process_stream_entries(entries)
+            instrument.record("stream_batch", started)
+        return processed
+
+    def process_stream_entries(self, entries) -> int:
+        """
+        Process batch of input stream entries: XADD results, flush stats (if it's time) and XACK in one pipeline
+
+        Delivery is at-least-once: entries reclaimed from dead consumer may be streamed twice.
+
+        :param entries: list of (entry_id, fields)
+        :return: count of processed messages
+        """
+        pipe = self.r.pipeline(transaction=False)
+        trim = trim_kwargs()
+        entry_ids = []
+        messages = []
+        processed = 0
+        processed_bytes = 0
+        for entry_id, fields in entries:
+            entry_ids.append(entry_id)
+            # Entry could be trimmed while it was pending
+            if not fields:
+                continue
+            # Undecodable entry is acknowledged too, it will never become better
+            payload = fields[b"data"]
+            data = self.decode(payload)
+            if data is None:
+                continue
+            fields = self.build_entry(data, payload if self.codec.is_json else None)
+            self.queue_entry(pipe, data.get("message_id"), fields, trim)
+            processed += 1
+            processed_bytes += len(payload)
+            messages.append(data)
+
+        if processed:
+            self.stats.add(processed_messages=processed, bytes_processed=processed_bytes)
+        if entry_ids:
+            # Stats go with the same pipeline when it's time
+            if self.stats.due():
+                self.stats.flush(pipe)
+            pipe.xack(self.input_stream, self.input_group, *entry_ids)
+            self.execute_entries(pipe)
+        elif self.stats.due():
+            # Empty batch (empty XAUTOCLAIM page) has no pipeline to go with
+            self.flush_stats()
+        # Consumer group is my lock, so only end to end latency makes sense
+        done_at = time.time()
+        for data in messages:
+            observe_latencies(self.stats, data, done_at=done_at)
+        return processed
+
+    def dead_group_members(self) -> list:
+        """
+        Find members of consumer group without heartbeat (same rules as ConsumerManager.is_active)
+
+        :return: list of (consumer name, pending count)
+        """
+        members = [(member["name"].decode(), member["pending"])
+                   for member in self.r.xinfo_consumers(self.input_stream, self.input_group)]
+        members = [member for member in members if member[0] != self.consumer_id]
+        if not members:
+            return []
+
+        activities = self.r.zmscore(self.heartbeats, [name for name, _ in members])
+        now = time.time()
+        return [member for member, last_activity in zip(members, activities)
+                if last_activity is None or now - float(last_activity) > consumer_manager_ttl]
+
+    def reclaim_pending(self) -> int:
+        """
+        Claim idle pending entries of dead consumers (XAUTOCLAIM) and process them
+
+        :return: count of processed messages
+        """
+        dead = self.dead_group_members()
+        processed = 0
+        if any(pending for _, pending in dead):
+            start_id = "0-0"
+            while True:
+                response = self.r.xautoclaim(self.input_stream, self.input_group, self.consumer_id,
+                                             min_idle_time=stream_claim_min_idle_ms, start_id=start_id,
+                                             count=stream_read_count)
+                start_id, entries = response[0], response[1]
+                processed += self.process_stream_entries(entries)
+                if start_id in (b"0-0", "0-0"):
+                    break
+            logging.info(f"Consumer {self.consumer_id} reclaimed {processed} messages of dead consumers")
+
+        # Dead consumers without pending messages are not needed in the group anymore
+        for name, pending in dead:
+            if not pending:
+                self.r.xgroup_delconsumer(self.input_stream, self.input_group, name)
+        return processed
+
+    def poll_instrumentation(self) -> None:
+        """
+        Take orders from instrumentation control hash and write my timings to my hash
+
+        """
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hgetall(self.instrument_name)
+        # Profile window is taken only once
+        pipe.hdel(self.instrument_name, f"profile:{self.consumer_id}")
+        self.instrument.control(pipe.execute()[0])
+        if self.instrument.timers or self.instrument.last_profile:
+            pipe = self.r.pipeline(transaction=False)
+            self.instrument.write(pipe, f"{self.instrument_name}:{self.consumer_id}")
+            pipe.execute()
 
     def keep_alive(self) -> None:
         """
@@ -172,11 +1252,12 @@ class ConsumerEngine:
 
         :return:
         """
-        logging.info(f"Consumer {self.consumer_id} was {('register' if self.r.sadd(self.consumer_ids, self.consumer_id) else 'unregistred')}")
+        registered = self.r.zadd(self.heartbeats, {self.consumer_id: time.time()})
+        logging.info(f"Consumer {self.consumer_id} was {('register' if registered else 'unregistred')}")
         while True:
-            # I will update last_activity time
-            _updating_last_processed = f"{self.stats_name}:{self.consumer_id}:last_activity"
-            self.r.set(_updating_last_processed, time.time(), ex=60)
+            # I will update my heartbeat (and flush stats which are waiting for it)
+            self.flush_stats(heartbeat=True)
+            self.poll_instrumentation()
             # each 10 seconds
             time.sleep(10)
 
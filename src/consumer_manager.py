@@ -11,14 +11,21 @@ import threading
 
 logging.basicConfig(level=logging.DEBUG)
 
-from config import redis_host, redis_port, stats_name, consumer_manager_ttl, consumer_manager_interval, consumer_ids
+from config import redis_host, redis_port, stats_name, consumer_manager_ttl, consumer_manager_interval, consumer_ids, \
+    consumer_heartbeats, redis_transport, stats_retention
+from transport import connect
 
 
 class ConsumerManager:
     def __init__(self):
-        self.redis = redis.Redis(host=redis_host, port=redis_port)
+        self.redis = connect(redis_host, redis_port, **redis_transport)
         self.stats_name = stats_name
+        # Stats hash of a removed consumer expires (its counters are in the group hash already)
+        self.stats_retention = stats_retention
         self.ttl = consumer_manager_ttl
+        # Consumers and their heartbeats: member - consumer id, score - time of the last heartbeat
+        self.heartbeats = consumer_heartbeats
+        # Old layout: set of consumers and last_activity of every consumer (i will migrate it)
         self.consumers_set = consumer_ids
         self.update_interval = consumer_manager_interval
         self.running = False
@@ -30,12 +37,8 @@ class ConsumerManager:
         :param consumer_id: str Consumer ID
 
         """
-        # My activity i will put here
-        key = f"{self.stats_name}:{consumer_id}:last_activity"
-        # I will set the time
-        self.redis.set(key, int(time.time()))
-        # I will add the consumer to the set to be ensured that i'm active
-        self.redis.sadd(self.consumers_set, consumer_id)
+        # I will set the time as a score of the consumer, so it's registered and active by one command
+        self.redis.zadd(self.heartbeats, {consumer_id: int(time.time())})
 
     def is_active(self, consumer_id):
         """
@@ -43,10 +46,8 @@ class ConsumerManager:
 
         :param consumer_id: str Consumer ID
         """
-        # I will check if the consumer is active by this key
-        key = f"{self.stats_name}:{consumer_id}:last_activity"
-        # I check existing of the key
-        last_activity = self.redis.get(key)
+        # I will check if the consumer is active by its heartbeat score
+        last_activity = self.redis.zscore(self.heartbeats, consumer_id)
         # If not exist i will return False so the consumer is not active
         if last_activity is None:
             return False
@@ -66,38 +67,82 @@ class ConsumerManager:
         """
         Remove inactive consumers from the list
 
+        :return: list of removed consumers
         """
-        # I will get the list of consumers from the set
-        consumers = self.redis.smembers(self.consumers_set)
+        # Everybody whose heartbeat is older than ttl is inactive
+        deadline = time.time() - self.ttl
+        # I will take and remove them atomically (MULTI), so fresh heartbeat can't be lost between
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.zrangebyscore(self.heartbeats, "-inf", f"({deadline}")
+        pipe.zremrangebyscore(self.heartbeats, "-inf", f"({deadline}")
+        removed, _ = pipe.execute()
+        for removed_items_count, consumer_id in enumerate(removed, 1):
+            logging.info(f"[{removed_items_count}] Removing inactive consumer {consumer_id.decode()} ...")
+        if removed:
+            # Stats of removed consumers won't stay forever, the consumer persists them again if it's alive after all
+            pipe = self.redis.pipeline(transaction=False)
+            for consumer_id in removed:
+                pipe.expire(f"{self.stats_name}:{consumer_id.decode()}", self.stats_retention)
+            pipe.execute()
+            # If i removed some consumers i will log summary
+            logging.info(f"Removed {len(removed)} inactive consumers.")
+        return removed
+
+    def get_active_consumers(self):
+        """
+        Get active consumers and their heartbeats
+
+        :return: {consumer_id (bytes): unix time of the last heartbeat}
+        """
+        # Inactive consumers are filtered by score, so i don't need to clean them up before
+        active = dict(self.redis.zrangebyscore(self.heartbeats, time.time() - self.ttl, "+inf", withscores=True))
         # If the list is empty i will log that there is no active consumers
-        if len(consumers) == 0:
+        if not active:
             logging.info("No active consumers found.")
+        return active
 
-        # I will go over the consumers
-        for consumer_id in consumers:
-            # I will remember the count of removed consumers
-            removed_items_count = 0
-            # I will decode the consumer because it's stored as bytes (i not sure m.b. better some like Redis(decode_responses=True))
-            consumer_id = consumer_id.decode()
-            # I will check if the consumer is active
-            if not self.is_active(consumer_id):
-                # If not i will remove the consumer from the set
-                removed_items_count += 1
-                logging.info(f"[{removed_items_count}] Removing inactive consumer {consumer_id} ...")
-                self.redis.srem(self.consumers_set, consumer_id)
-            if removed_items_count > 0:
-                # If i removed some consumers i will log summary
-                logging.info(f"Removed {removed_items_count} inactive consumers.")
-
-    def get_active_consumers(self):
+    def migrate_legacy_registry(self):
         """
-        Get the list of active consumers
+        Move consumers of the old layout (set of ids + last_activity of every consumer) to the heartbeats sorted set
 
+        Last activity is taken from `<stats_name>:<id>:last_activity` key or `last_activity` field of stats hash.
+        Consumers without last activity are dropped, they would be removed as inactive anyway.
+        Old counter `<stats_name>:<id>:processed_messages` is added to the stats hash of the consumer (and to the group
+        stats hash, it sums all consumers) and deleted.
+
+        :return: count of migrated consumers
         """
-        # I remove inactive consumers from set
-        self.cleanup_inactive_consumers()
-        # and return the list of active consumers
-        return self.redis.smembers(self.consumers_set)
+        consumers = [consumer_id.decode() for consumer_id in self.redis.smembers(self.consumers_set)]
+        if not consumers:
+            return 0
+        pipe = self.redis.pipeline(transaction=False)
+        for consumer_id in consumers:
+            pipe.get(f"{self.stats_name}:{consumer_id}:last_activity")
+            pipe.hget(f"{self.stats_name}:{consumer_id}", "last_activity")
+            pipe.get(f"{self.stats_name}:{consumer_id}:processed_messages")
+        values = pipe.execute()
+
+        heartbeats = {}
+        for consumer_id, key_value, field_value in zip(consumers, values[::3], values[1::3]):
+            activities = [float(value) for value in (key_value, field_value) if value is not None]
+            if activities:
+                heartbeats[consumer_id] = max(activities)
+
+        pipe = self.redis.pipeline(transaction=True)
+        if heartbeats:
+            # Heartbeats of already upgraded consumers are newer, i will not move them back
+            pipe.zadd(self.heartbeats, heartbeats, gt=True)
+        for consumer_id, processed in zip(consumers, values[2::3]):
+            if processed is not None and int(processed):
+                pipe.hincrby(f"{self.stats_name}:{consumer_id}", "processed_messages", int(processed))
+                pipe.hincrby(f"{self.stats_name}:group", "processed_messages", int(processed))
+            pipe.delete(f"{self.stats_name}:{consumer_id}:last_activity",
+                        f"{self.stats_name}:{consumer_id}:processed_messages")
+            pipe.hdel(f"{self.stats_name}:{consumer_id}", "last_activity")
+        pipe.srem(self.consumers_set, *consumers)
+        pipe.execute()
+        logging.info(f"Migrated {len(heartbeats)} of {len(consumers)} consumers to {self.heartbeats}")
+        return len(heartbeats)
 
     def run_service(self):
         """
@@ -120,6 +165,8 @@ class ConsumerManager:
         """
         if not self.running:
             self.running = True
+            # Consumers registered by the old layout will be visible after migration
+            self.migrate_legacy_registry()
             threading.Thread(target=self.run_service, daemon=True).start()
             print("[+] Service started.")
 
@@ -0,0 +1,146 @@
+"""
+    Dedup stores: who claimed the message first
+
+    - key    - one key per message `consumer:lock:<message_id>` (SET NX EX), expired one by one by Redis
+    - bucket - time-bucketed hashes `consumer:dedup:<bucket>` (HSETNX message_id), one EXPIREAT per bucket.
+               Bucket is taken from `published_at` of the message, so every consumer claims the same message
+               in the same hash. Claim is remembered at least `window` seconds; thousands of small fields
+               in a few hashes are much cheaper than thousands of keys with TTL, and Redis expires a whole
+               bucket at once instead of every message. Message without `published_at` has no bucket every
+               consumer agrees on (local clocks cross bucket boundaries at different moments), so it's
+               claimed by its own key `consumer:dedup:id:<message_id>` (SET NX EX `window`).
+
+    With K > 1 processed stream shards every key has the hash tag of the message's shard, like the index
+    (index.py): `consumer:lock:{shard}:<message_id>`, `consumer:dedup:{shard}:<bucket>`,
+    `consumer:dedup:{shard}:id:<message_id>`. So PROCESS_MESSAGE touches one slot of Redis Cluster.
+
+    Both have the same claim semantics: claim(...) is truthy only for the first claimer.
+    Methods take a client - Redis, asyncio Redis or pipeline of them - and return what the client returns,
+    so the caller executes (pipeline), awaits (asyncio) or just uses (Redis) the results.
+"""
+
+import time
+
+from src.shards import shard_of
+
+
+def tagged(name: str, message_id, shards: int) -> str:
+    """
+    Prefix of keys of message, with the hash tag of its stream shard when there are shards
+
+    :param name: prefix of keys
+    :param shards: count of processed stream shards
+    """
+    if shards <= 1:
+        return name
+    return f"{name}:{{{shard_of(message_id, shards)}}}"
+
+
+class KeyDedup:
+    name = "key"
+
+    def __init__(self, lock_name: str, ttl: int, shards: int = 1) -> None:
+        self.lock_name = lock_name
+        self.ttl = ttl
+        self.shards = shards
+
+    def key(self, message_id) -> str:
+        return f"{tagged(self.lock_name, message_id, self.shards)}:{message_id}"
+
+    def claim(self, client, consumer_id: str, message_id, published_at=None):
+        return client.set(self.key(message_id), consumer_id, nx=True, ex=self.ttl)
+
+    def expire(self, client) -> list:
+        # Every key has its own TTL already
+        return []
+
+    def script_target(self, message_id, published_at=None) -> tuple:
+        """
+        Arguments of PROCESS_MESSAGE script
+
+        :return: (key, field, expire) - field is empty for key store, expire is TTL
+        """
+        return self.key(message_id), "", self.ttl
+
+
+class BucketDedup:
+    name = "bucket"
+
+    def __init__(self, dedup_name: str, window: int, shards: int = 1) -> None:
+        self.dedup_name = dedup_name
+        self.window = int(window)
+        self.shards = shards
+        # Buckets touched since the last expire(): {key: bucket} and buckets with EXPIREAT sent: {key: expire time}
+        self.touched = {}
+        self.expiring = {}
+
+    def bucket(self, published_at) -> int:
+        """
+        :return: bucket of publish time, None if the message has no `published_at`
+        """
+        if not isinstance(published_at, (int, float)):
+            return None
+        return int(published_at // self.window)
+
+    def undated_key(self, message_id) -> str:
+        return f"{tagged(self.dedup_name, message_id, self.shards)}:id:{message_id}"
+
+    def bucket_key(self, message_id, bucket: int) -> str:
+        return f"{tagged(self.dedup_name, message_id, self.shards)}:{bucket}"
+
+    def expire_at(self, bucket: int) -> int:
+        # Claims of the last moment of bucket live `window` seconds too, so do claims of late (old) messages
+        return max((bucket + 2) * self.window, int(time.time()) + self.window)
+
+    def claim(self, client, consumer_id: str, message_id, published_at=None):
+        bucket = self.bucket(published_at)
+        if bucket is None:
+            return client.set(self.undated_key(message_id), consumer_id, nx=True, ex=self.window)
+        key = self.bucket_key(message_id, bucket)
+        self.touched[key] = bucket
+        return client.hsetnx(key, message_id, consumer_id)
+
+    def expire(self, client) -> list:
+        """
+        Set expiration of buckets touched first time (after their claims, EXPIREAT of missing key does nothing)
+
+        Bucket which expires within a window (or is gone already) is forgotten first: a late message may recreate
+        its hash, so it gets EXPIREAT again (EXPIREAT is idempotent)
+
+        :return: what client returned for every EXPIREAT
+        """
+        now = time.time()
+        self.expiring = {key: at for key, at in self.expiring.items() if at - now > self.window}
+        results = []
+        for key, bucket in self.touched.items():
+            if key not in self.expiring:
+                self.expiring[key] = self.expire_at(bucket)
+                results.append(client.expireat(key, self.expiring[key]))
+        self.touched = {}
+        return results
+
+    def script_target(self, message_id, published_at=None) -> tuple:
+        """
+        Arguments of PROCESS_MESSAGE script
+
+        :return: (key, field, expire) - expire is unix time for EXPIREAT, undated message: (key, "", TTL)
+        """
+        bucket = self.bucket(published_at)
+        if bucket is None:
+            return self.undated_key(message_id), "", self.window
+        return self.bucket_key(message_id, bucket), message_id, self.expire_at(bucket)
+
+
+def get_dedup(backend: str, lock_name: str, dedup_name: str, lock_ttl: int, window: int, shards: int = 1):
+    """
+    Get dedup store by name
+
+    :param backend: key or bucket
+    :param shards: count of processed stream shards (keys get hash tags of shards)
+    :return: dedup store
+    """
+    if backend == "key":
+        return KeyDedup(lock_name, lock_ttl, shards)
+    if backend == "bucket":
+        return BucketDedup(dedup_name, window, shards)
+    raise ValueError(f"Unknown dedup backend {backend}, use key or bucket")
@@ -0,0 +1,193 @@
+"""
+    Layouts of processed stream entries
+
+    legacy  - message_id, processed_by, processed_message (message JSON extended by processed_by and
+              random_property), created_at (float seconds) - message_id and processed_by are there twice
+    compact - every field once, time as integer:
+                m - message JSON as it came (message_id is in it)
+                z - ... or the same compressed by zlib with preset dictionary, instead of m
+                c - processed_by
+                r - random_property
+                t - created_at, unix milliseconds
+
+    Messages shorter than `compress_min` are not compressed (zlib header and checksum eat the gain), compressed
+    one is kept only if it's smaller. Preset dictionary is trained on sample messages (keys and values common to
+    many messages), so even one message is compressed as well as a long stream of them. Readers must use the same
+    dictionary (zlib stream carries its checksum, the wrong one is an error, not garbage).
+
+    decode_entry() reads both layouts: downstream readers, archive and monitoring don't care about the layout.
+
+        python -m src.entries train --capture captures --out entry.dict     # from captured traffic
+        python -m src.entries train --stream --out entry.dict               # from processed stream
+"""
+
+import argparse
+import json
+import re
+import zlib
+from collections import Counter
+
+LEGACY_FIELDS = ("message_id", "processed_by", "processed_message", "created_at")
+# JSON strings (keys with their colon) and scalars
+TOKEN = re.compile(rb'"(?:[^"\\]|\\.)*"\s*:?|-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?|true|false|null')
+
+
+def load_dictionary(path: str) -> bytes:
+    """
+    :param path: file of trained dictionary, empty - no dictionary
+    :return: dictionary or None
+    """
+    if not path:
+        return None
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def train_dictionary(samples, size: int = 2048) -> bytes:
+    """
+    Preset dictionary of zlib from sample messages
+
+    Tokens seen in more than one message are kept, the most valuable (count x length) go to the end of dictionary -
+    the nearest distance for zlib
+
+    :param samples: message JSONs (bytes)
+    :param size: most bytes of dictionary - zlib hashes the whole dictionary for every message, a small one
+                 costs less and compresses short messages as well as a big one
+    :return: dictionary
+    """
+    frequency = Counter()
+    for sample in samples:
+        frequency.update(set(TOKEN.findall(bytes(sample))))
+    common = sorted((count * len(token), token) for token, count in frequency.items() if count > 1)
+    return b"".join(token for _, token in common)[-size:]
+
+
+class CompactLayout:
+    def __init__(self, compress_min: int = 256, dictionary: bytes = None, level: int = 6) -> None:
+        """
+        :param compress_min: messages of so many bytes and longer are compressed, 0 - never
+        :param dictionary: preset dictionary of zlib
+        :param level: zlib level
+        """
+        self.compress_min = compress_min
+        self.dictionary = dictionary
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        if self.dictionary is None:
+            return zlib.compress(data, self.level)
+        # New compressor is cheaper than copy() of a prepared one (copy takes the whole state of zlib)
+        compressor = zlib.compressobj(self.level, zdict=self.dictionary)
+        return compressor.compress(data) + compressor.flush()
+
+    def build(self, message_json: bytes, consumer_id: str, random_property: float, created_at: float) -> dict:
+        """
+        Stream entry
+
+        :param message_json: message as it came (or encoded) in JSON
+        :return: stream entry fields
+        """
+        fields = {"m": message_json}
+        if self.compress_min and len(message_json) >= self.compress_min:
+            compressed = self.compress(message_json)
+            if len(compressed) < len(message_json):
+                fields = {"z": compressed}
+        fields.update(c=consumer_id, r=random_property, t=int(created_at * 1000))
+        return fields
+
+
+def _str(value) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _fields(fields: dict) -> dict:
+    return {_str(name): value for name, value in fields.items()}
+
+
+def decompress(value: bytes, dictionary: bytes = None) -> bytes:
+    if dictionary is None:
+        return zlib.decompress(value)
+    decompressor = zlib.decompressobj(zdict=dictionary)
+    return decompressor.decompress(value) + decompressor.flush()
+
+
+def message_json(fields: dict, dictionary: bytes = None) -> bytes:
+    """
+    Message JSON of entry (of any layout)
+
+    :param fields: entry fields as they came from Redis (or as they were built)
+    :param dictionary: preset dictionary of compact layout
+    :return: JSON bytes
+    """
+    fields = _fields(fields)
+    if "processed_message" in fields:
+        value = fields["processed_message"]
+    elif "z" in fields:
+        value = decompress(fields["z"], dictionary)
+    else:
+        value = fields["m"]
+    return value.encode() if isinstance(value, str) else value
+
+
+def entry_created_at(fields: dict) -> float:
+    """
+    Time of processing (unix seconds) without decoding the message
+
+    """
+    fields = _fields(fields)
+    if "t" in fields:
+        return int(fields["t"]) / 1000
+    return float(fields["created_at"])
+
+
+def decode_entry(fields: dict, dictionary: bytes = None) -> dict:
+    """
+    Entry of any layout in the legacy view
+
+    :param fields: entry fields
+    :param dictionary: preset dictionary of compact layout
+    :return: {"message_id", "processed_by", "created_at" (float), "message" (dict with processed_by and
+              random_property, as in legacy processed_message)}
+    """
+    fields = _fields(fields)
+    message = json.loads(message_json(fields, dictionary))
+    if "processed_message" in fields:
+        processed_by = _str(fields["processed_by"])
+    else:
+        processed_by = _str(fields["c"])
+        message.update(processed_by=processed_by, random_property=float(fields["r"]))
+    return {"message_id": message.get("message_id"), "processed_by": processed_by,
+            "created_at": entry_created_at(fields), "message": message}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train preset dictionary of compact stream entries")
+    parser.add_argument('command', choices=["train"])
+    parser.add_argument('--capture', help="Directory of captured traffic (traffic.py capture)")
+    parser.add_argument('--stream', action='store_true', help="Sample processed stream")
+    parser.add_argument('--samples', type=int, default=10000, help="Most sample messages")
+    parser.add_argument('--size', type=int, default=2048, help="Most bytes of dictionary (up to 32768)")
+    parser.add_argument('--out', default="entry.dict", help="Dictionary file")
+    args = parser.parse_args()
+
+    if args.capture:
+        from itertools import islice
+        from src.segments import segment_paths, iter_records
+        samples = [bytes(payload) for _, payload in islice(iter_records(segment_paths(args.capture)), args.samples)]
+    elif args.stream:
+        from src.config import redis_host, redis_port, redis_transport, stream_name, processed_stream_shards, \
+            entry_dictionary
+        from src.shards import shard_names
+        from src.transport import connect
+        r = connect(redis_host, redis_port, **redis_transport)
+        names = shard_names(stream_name, processed_stream_shards)
+        current = load_dictionary(entry_dictionary)
+        samples = [message_json(fields, current) for name in names
+                   for _, fields in r.xrevrange(name, count=args.samples // len(names))]
+    else:
+        raise SystemExit("--capture or --stream is needed")
+
+    dictionary = train_dictionary(samples, args.size)
+    with open(args.out, "wb") as file:
+        file.write(dictionary)
+    print(f"Dictionary of {len(dictionary)} bytes is trained on {len(samples)} messages: {args.out}")
@@ -0,0 +1,126 @@
+"""
+    Latency histograms
+
+    HDR-style log-linear buckets: 10 buckets per decade (R10 series) from 10us to 100s.
+    Neighbour bounds are ~26% apart, so every latency is known with that relative error
+    by 72 fixed counters, histograms of different consumers are merged by plain addition.
+
+    Stages of message latency (publisher stamps `published_at` into the message):
+        publish_to_lock - from publish to acquired lock (transport, queueing, decode)
+        lock_to_xadd    - from acquired lock to XADD acknowledged by Redis
+        end_to_end      - from publish to XADD acknowledged by Redis
+
+    In consumer's stats hash histogram is kept as fields `latency:<stage>:<bucket index>` (counts)
+    and `latency:<stage>:sum` (seconds).
+"""
+
+import bisect
+
+STAGES = ("publish_to_lock", "lock_to_xadd", "end_to_end")
+
+MANTISSAS = (1.0, 1.25, 1.6, 2.0, 2.5, 3.15, 4.0, 5.0, 6.3, 8.0)
+# Upper bounds of buckets (seconds), the last bucket (index len(BOUNDS)) is +Inf
+BOUNDS = tuple(round(mantissa * 10 ** exponent, 9) for exponent in range(-5, 2) for mantissa in MANTISSAS) + (100.0,)
+
+
+def bucket_index(seconds: float) -> int:
+    """
+    Index of bucket for latency
+
+    :param seconds:
+    :return: index, len(BOUNDS) for latencies above the last bound
+    """
+    return bisect.bisect_left(BOUNDS, seconds)
+
+
+def bucket_field(stage: str, index) -> str:
+    """
+    Field of stats hash for bucket (or "sum") of stage's histogram
+    """
+    return f"latency:{stage}:{index}"
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def record(self, seconds: float, count: int = 1) -> None:
+        self.counts[bucket_index(seconds)] += count
+        self.sum += seconds * count
+
+    def merge(self, other: "Histogram") -> "Histogram":
+        """
+        Add other histogram to this one
+
+        :return: self
+        """
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        return self
+
+    def since(self, older: "Histogram") -> "Histogram":
+        """
+        Histogram of latencies recorded after `older` snapshot of the same (cumulative) histogram
+
+        Consumers which left make counts smaller, such buckets are taken as zero
+        """
+        interval = Histogram()
+        interval.counts = [max(0, mine - theirs) for mine, theirs in zip(self.counts, older.counts)]
+        interval.sum = max(0.0, self.sum - older.sum)
+        return interval
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of bucket containing q-quantile
+
+        :param q: 0..1
+        :return: seconds (inf if it's above the last bound, 0 if histogram is empty)
+        """
+        total = self.count
+        if not total:
+            return 0.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= q * total:
+                return BOUNDS[index] if index < len(BOUNDS) else float("inf")
+        return float("inf")
+
+    def cumulative(self) -> list:
+        """
+        Prometheus style buckets
+
+        :return: list of (le, count of latencies <= le), the last one is ("+Inf", count)
+        """
+        buckets = []
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            buckets.append((f"{BOUNDS[index]:g}" if index < len(BOUNDS) else "+Inf", seen))
+        return buckets
+
+
+def histograms_from_hash(fields: dict) -> dict:
+    """
+    Read histograms of stages from consumer's stats hash
+
+    :param fields: HGETALL result (bytes or str keys)
+    :return: {stage: Histogram}
+    """
+    histograms = {}
+    for field, value in fields.items():
+        field = field.decode() if isinstance(field, bytes) else field
+        if not field.startswith("latency:"):
+            continue
+        _, stage, index = field.split(":", 2)
+        histogram = histograms.setdefault(stage, Histogram())
+        if index == "sum":
+            histogram.sum += float(value)
+        else:
+            histogram.counts[int(index)] += int(value)
+    return histograms
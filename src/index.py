@@ -0,0 +1,177 @@
+"""
+    Index of processed messages: message_id -> stream entry ID and consumer
+
+    Consumers write it by the same Lua call as XADD (see scripts.py), the entry ID is known only inside Redis.
+    Index is kept in time-bucketed hashes, like bucket dedup store (dedup.py):
+
+        K = 1: consumer:index:<bucket>             field - message_id, value - "<entry_id> <consumer_id>"
+        K > 1: consumer:index:{shard}:<bucket>     ... with the hash tag of the stream shard of the message
+
+    Bucket is the time of processing // bucket_seconds, Redis expires a whole bucket `retention` seconds after its
+    end, so index is bounded by the retention and costs a field of a small hash per message, not a key.
+    With sharded stream the bucket of a message lives in the slot of its stream shard (Lua call touches one slot).
+
+    Lookup of thousands of IDs takes two round-trips: one pipeline of HMGET (every live bucket of every shard,
+    IDs in chunks) and one pipeline of XRANGE <id> <id> point reads of the found entries.
+
+        python -m src.index lookup <message_id> [<message_id> ...]
+        python -m src.index lookup --file ids.txt --no-entries       # one ID per line, "-" - stdin
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from src.entries import decode_entry
+from src.shards import shard_of
+
+
+def _str(value) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _chunks(items: list, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class MessageIndex:
+    def __init__(self, index_name: str, retention: int, bucket_seconds: int = 3600, shards: int = 1) -> None:
+        """
+        :param index_name: prefix of bucket hashes
+        :param retention: every message is found at least so many seconds
+        :param bucket_seconds: time span of bucket
+        :param shards: count of processed stream shards
+        """
+        self.index_name = index_name
+        self.retention = int(retention)
+        self.bucket_seconds = int(bucket_seconds)
+        self.shards = shards
+
+    def bucket(self, now: float = None) -> int:
+        return int((time.time() if now is None else now) // self.bucket_seconds)
+
+    def key(self, shard: int, bucket: int) -> str:
+        if self.shards <= 1:
+            return f"{self.index_name}:{bucket}"
+        return f"{self.index_name}:{{{shard}}}:{bucket}"
+
+    def target(self, message_id, now: float = None) -> tuple:
+        """
+        Where the message is indexed
+
+        :return: (bucket key, unix time of its expiration)
+        """
+        bucket = self.bucket(now)
+        return self.key(shard_of(message_id, self.shards), bucket), (bucket + 1) * self.bucket_seconds + self.retention
+
+    def keys(self, shard: int, now: float = None) -> list:
+        """
+        Buckets of shard which may be alive, the newest first (the next one too - clocks of consumers differ)
+
+        """
+        now = time.time() if now is None else now
+        return [self.key(shard, bucket)
+                for bucket in range(self.bucket(now) + 1, self.bucket(now - self.retention) - 1, -1)]
+
+    def locate(self, r, message_ids: list, chunk: int = 1000, now: float = None) -> dict:
+        """
+        Entry IDs of messages by one pipeline of HMGET
+
+        :param r: Redis connection
+        :param message_ids: IDs of messages
+        :param chunk: most fields per HMGET
+        :return: {message_id: (shard, entry_id, consumer_id)}, messages which are not found are not there
+        """
+        by_shard = {}
+        for message_id in dict.fromkeys(message_ids):
+            by_shard.setdefault(shard_of(message_id, self.shards), []).append(message_id)
+        pipe = r.pipeline(transaction=False)
+        queued = []
+        for shard, ids in by_shard.items():
+            for key in self.keys(shard, now):
+                for part in _chunks(ids, chunk):
+                    pipe.hmget(key, part)
+                    queued.append((shard, part))
+        found = {}
+        # Buckets go from the newest, so a message indexed twice (redelivered) is found by its last entry
+        for (shard, part), values in zip(queued, pipe.execute()):
+            for message_id, value in zip(part, values):
+                if value is not None and message_id not in found:
+                    entry_id, _, consumer_id = _str(value).partition(" ")
+                    found[message_id] = (shard, entry_id, consumer_id)
+        return found
+
+    def lookup(self, r, message_ids: list, streams: list, entries: bool = True, dictionary: bytes = None,
+               chunk: int = 1000, now: float = None) -> dict:
+        """
+        Processed messages by their IDs
+
+        :param r: Redis connection
+        :param message_ids: IDs of messages
+        :param streams: processed stream shards (shard_names)
+        :param entries: read entries too (pipeline of XRANGE point reads), otherwise only the index is read
+        :param dictionary: preset dictionary of compact entry layout
+        :return: {message_id: {"stream", "entry_id", "processed_by", "processed_at", "entry"} or None if it's not
+                 found}; "entry" is decode_entry of the entry, None if it's trimmed already (or not read)
+        """
+        found = self.locate(r, message_ids, chunk, now)
+        result = {message_id: None for message_id in message_ids}
+        for message_id, (shard, entry_id, consumer_id) in found.items():
+            result[message_id] = {"stream": streams[shard], "entry_id": entry_id, "processed_by": consumer_id,
+                                  "processed_at": int(entry_id.partition("-")[0]) / 1000, "entry": None}
+        if entries and found:
+            pipe = r.pipeline(transaction=False)
+            for message_id in found:
+                pipe.xrange(result[message_id]["stream"], min=result[message_id]["entry_id"],
+                            max=result[message_id]["entry_id"])
+            for message_id, read in zip(found, pipe.execute()):
+                if read:
+                    result[message_id]["entry"] = decode_entry(read[0][1], dictionary)
+        return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lookup of processed messages by message_id")
+    parser.add_argument('command', choices=["lookup"])
+    parser.add_argument('message_ids', nargs='*', help="IDs of messages")
+    parser.add_argument('--file', help="File of message IDs, one per line, - is stdin")
+    parser.add_argument('--no-entries', dest='entries', action='store_false', help="Read only the index")
+    parser.add_argument('--json', action='store_true', help="Print JSON lines")
+    args = parser.parse_intermixed_args()
+
+    from src.config import redis_host, redis_port, redis_transport, stream_name, processed_stream_shards, \
+        index_name, index_retention, index_bucket_seconds, entry_dictionary
+    from src.entries import load_dictionary
+    from src.shards import shard_names
+    from src.transport import connect
+
+    message_ids = list(args.message_ids)
+    if args.file:
+        with (sys.stdin if args.file == "-" else open(args.file)) as file:
+            message_ids.extend(line.strip() for line in file if line.strip())
+    if not message_ids:
+        raise SystemExit("Message IDs are needed")
+    if not index_retention:
+        print("INDEX_RETENTION is 0: consumers don't write the index, only what is left of it is found",
+              file=sys.stderr)
+
+    index = MessageIndex(index_name, index_retention or index_bucket_seconds, index_bucket_seconds,
+                         processed_stream_shards)
+    r = connect(redis_host, redis_port, **redis_transport)
+    started = time.perf_counter()
+    results = index.lookup(r, message_ids, shard_names(stream_name, processed_stream_shards), args.entries,
+                           load_dictionary(entry_dictionary))
+    elapsed = time.perf_counter() - started
+    for message_id, found in results.items():
+        if args.json:
+            print(json.dumps({"message_id": message_id, **(found or {"found": False})}))
+        elif found is None:
+            print(f"{message_id}\tnot found")
+        else:
+            trimmed = "\ttrimmed" if args.entries and found["entry"] is None else ""
+            print(f"{message_id}\t{found['stream']}\t{found['entry_id']}\t{found['processed_by']}\t"
+                  f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(found['processed_at']))}{trimmed}")
+    print(f"Found {sum(1 for found in results.values() if found)} of {len(results)} messages in "
+          f"{elapsed * 1000:.1f} ms", file=sys.stderr)
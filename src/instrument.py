@@ -0,0 +1,188 @@
+"""
+    Hot path instrumentation of consumer
+
+    Every `sample_every`-th message is timed step by step (decode, lock, xadd, script, stats, batch_lock,
+    batch_xadd), timings go to log-linear histograms (see histogram.py). Not sampled messages cost
+    one counter increment and a couple of attribute checks, so it can stay on in production.
+
+    Control (consumer reads it with every heartbeat) - hash `consumer:instrument`:
+        sample_every               N  - sample every N-th message of all consumers, 0 - off
+        sample_every:<consumer_id> N  - the same for one consumer
+        profile:<consumer_id>      S  - one cProfile + tracemalloc window of S seconds in that consumer,
+                                        the field is removed when it's taken
+
+    Dumps:
+    - SIGUSR1 - timings are logged
+    - every heartbeat - timings are written to hash `consumer:instrument:<consumer_id>` (<step>:count, :mean_ms,
+      :p50_ms, :p99_ms, :max_ms) and the path of the last profile to its `last_profile` field
+
+        python -m src.instrument --sample_every 100          # all consumers
+        python -m src.instrument --consumer <id> --profile 30
+        python -m src.instrument --show
+"""
+
+import argparse
+import cProfile
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+from src.histogram import Histogram
+
+
+class Instrumentation:
+    def __init__(self, name: str, sample_every: int = 0, profile_dir: str = "profiles") -> None:
+        self.name = name
+        self.sample_every = self.default_sample_every = sample_every
+        self.profile_dir = profile_dir
+        self.seen = 0
+        self.sampled = False
+        self.timers = defaultdict(Histogram)
+        self.lock = threading.Lock()
+        # Profile window is asked by another thread and is run by the thread of the hot path
+        self.profile_request = None
+        self.profiler = None
+        self.profile_until = None
+        self.memory_before = None
+        self.last_profile = None
+
+    def begin(self) -> bool:
+        """
+        Start of message (or batch): decide if it's sampled, start or finish profile window
+
+        :return: True if it's sampled
+        """
+        if self.profile_request is not None:
+            self.start_profile()
+        elif self.profiler is not None and time.monotonic() >= self.profile_until:
+            self.stop_profile()
+        if not self.sample_every:
+            self.sampled = False
+            return False
+        self.seen += 1
+        self.sampled = self.seen % self.sample_every == 0
+        return self.sampled
+
+    def clock(self) -> float:
+        """
+        :return: start time of a step, 0 if message is not sampled
+        """
+        return time.perf_counter() if self.sampled else 0.0
+
+    def record(self, step: str, started: float) -> None:
+        """
+        Record the step started at `started` (result of clock())
+
+        """
+        if started:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.timers[step].record(elapsed)
+
+    def summary(self) -> dict:
+        """
+        :return: {step: {count, mean_ms, p50_ms, p99_ms, max_ms}}
+        """
+        with self.lock:
+            timers = {step: histogram for step, histogram in self.timers.items()}
+            return {step: {"count": histogram.count,
+                           "mean_ms": histogram.sum / histogram.count * 1000 if histogram.count else 0.0,
+                           "p50_ms": histogram.quantile(0.5) * 1000,
+                           "p99_ms": histogram.quantile(0.99) * 1000,
+                           "max_ms": histogram.quantile(1.0) * 1000}
+                    for step, histogram in sorted(timers.items())}
+
+    def report(self) -> str:
+        lines = [f"{'step':<12} {'count':>8} {'mean ms':>9} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}"]
+        for step, row in self.summary().items():
+            lines.append(f"{step:<12} {row['count']:>8} {row['mean_ms']:>9.3f} {row['p50_ms']:>8.3f} "
+                         f"{row['p99_ms']:>8.3f} {row['max_ms']:>8.3f}")
+        return "\n".join(lines)
+
+    def write(self, pipe, key: str, ttl: int = 3600) -> None:
+        """
+        Queue timings into hash `key` (it's executed by the caller)
+
+        """
+        fields = {f"{step}:{name}": value for step, row in self.summary().items() for name, value in row.items()}
+        fields["sample_every"] = self.sample_every
+        if self.last_profile:
+            fields["last_profile"] = self.last_profile
+        pipe.hset(key, mapping=fields)
+        pipe.expire(key, ttl)
+
+    def control(self, fields: dict) -> None:
+        """
+        Apply control hash (see module doc)
+
+        :param fields: HGETALL of control hash
+        """
+        fields = {key.decode() if isinstance(key, bytes) else key: value for key, value in fields.items()}
+        sample_every = fields.get(f"sample_every:{self.name}", fields.get("sample_every"))
+        self.sample_every = int(sample_every) if sample_every is not None else self.default_sample_every
+        seconds = fields.get(f"profile:{self.name}")
+        if seconds is not None and self.profiler is None:
+            self.profile_request = float(seconds)
+
+    def start_profile(self) -> None:
+        seconds, self.profile_request = self.profile_request, None
+        logging.info(f"{self.name}: profiling for {seconds} seconds")
+        tracemalloc.start()
+        self.memory_before = tracemalloc.take_snapshot()
+        self.profile_until = time.monotonic() + seconds
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop_profile(self) -> str:
+        """
+        Finish profile window: save pstats file, log the top of functions and of memory growth
+
+        :return: path of pstats file
+        """
+        profiler, self.profiler = self.profiler, None
+        profiler.disable()
+        memory_growth = tracemalloc.take_snapshot().compare_to(self.memory_before, "lineno")[:10]
+        tracemalloc.stop()
+        self.memory_before = None
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"{self.name}-{int(time.time())}.prof")
+        profiler.dump_stats(path)
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(20)
+        logging.info(f"{self.name}: profile is saved to {path}\n{text.getvalue()}"
+                     + "Memory growth:\n" + "\n".join(str(stat) for stat in memory_growth))
+        self.last_profile = path
+        return path
+
+
+if __name__ == "__main__":
+    from src.config import redis_host, redis_port, redis_transport, instrument_name
+    from src.transport import connect
+
+    parser = argparse.ArgumentParser(description="Control and show consumer instrumentation")
+    parser.add_argument('--consumer', help="Consumer ID (default - all consumers)")
+    parser.add_argument('--sample_every', type=int, help="Sample every N-th message, 0 - off")
+    parser.add_argument('--profile', type=float, help="Seconds of cProfile/tracemalloc window (needs --consumer)")
+    parser.add_argument('--show', action='store_true', help="Print timings of consumers")
+    args = parser.parse_args()
+
+    r = connect(redis_host, redis_port, **redis_transport)
+    if args.sample_every is not None:
+        field = f"sample_every:{args.consumer}" if args.consumer else "sample_every"
+        r.hset(instrument_name, field, args.sample_every)
+    if args.profile:
+        if not args.consumer:
+            raise SystemExit("--profile needs --consumer")
+        r.hset(instrument_name, f"profile:{args.consumer}", args.profile)
+    if args.show:
+        pattern = f"{instrument_name}:{args.consumer or '*'}"
+        for key in sorted(r.scan_iter(pattern)):
+            print(key.decode())
+            for field, value in sorted(r.hgetall(key).items()):
+                print(f"    {field.decode():<24} {value.decode()}")
@@ -0,0 +1,137 @@
+"""
+    Priority lanes
+
+    Every lane is its own Pub/Sub channel `<pubsub_channel>:lane:<name>`, publisher chooses the lane of a message.
+    Consumer reads everything which came to its lane channels into local per-lane queues without waiting and serves
+    them by the scheduler, so a bulk backlog waits in the bulk queue, not in front of high priority messages
+    (one channel is FIFO - a burst of bulk messages is served before the next high priority one).
+
+    Lanes are given in priority order with weights: "high:8,bulk:1" (weight is 1 if it's not there).
+
+    weighted - weighted fair share (stride scheduling): every lane has its virtual time, which grows by 1/weight per
+               served message, the lane with the smallest one is served. Lane which was idle starts from the virtual
+               time of the scheduler, so it can't save up credit. Busy lanes get service in the ratio of their
+               weights, a lane alone gets everything.
+    priority   - strict priority, the first non-empty lane is served. Starvation protection: a lane whose oldest
+                 message waits `starvation` seconds or more is served before the lanes above it which keep up
+                 (the first of the starving lanes, so the higher lane still wins when it's late too).
+"""
+
+import re
+import time
+from collections import deque
+
+POLICIES = ("weighted", "priority")
+NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def parse_lanes(spec: str) -> list:
+    """
+    :param spec: "name:weight,..." in priority order, e.g. "high:8,bulk:1"
+    :return: [(name, weight)]
+    """
+    lanes = []
+    for part in spec.split(","):
+        name, _, weight = part.strip().partition(":")
+        if not NAME.match(name):
+            raise ValueError(f"Bad lane name {name!r} in {spec!r}, use letters, digits, _ and -")
+        weight = float(weight) if weight else 1.0
+        if weight <= 0:
+            raise ValueError(f"Weight of lane {name} must be positive, not {weight}")
+        lanes.append((name, weight))
+    names = [name for name, _ in lanes]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Lanes repeat in {spec!r}")
+    return lanes
+
+
+def lane_channel(channel: str, name: str) -> str:
+    """
+    Pub/Sub channel of lane
+
+    :param channel: Pub/Sub channel
+    :param name: lane
+    """
+    return f"{channel}:lane:{name}"
+
+
+class LaneScheduler:
+    def __init__(self, lanes: list, policy: str = "weighted", starvation: float = 0.2) -> None:
+        """
+        :param lanes: [(name, weight)] in priority order (parse_lanes)
+        :param policy: weighted or priority
+        :param starvation: seconds of waiting after which a lane is served first (priority policy)
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown lane policy {policy}, use one of {POLICIES}")
+        self.order = [name for name, _ in lanes]
+        self.weights = dict(lanes)
+        self.policy = policy
+        self.starvation = starvation
+        # (arrival time, item) per lane
+        self.queues = {name: deque() for name in self.order}
+        # Virtual times of lanes and of the scheduler (weighted policy)
+        self.passes = {name: 0.0 for name in self.order}
+        self.vtime = 0.0
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def queued(self, lane: str) -> int:
+        return len(self.queues[lane])
+
+    def put(self, lane: str, item, now: float = None) -> None:
+        """
+        :param lane: name of lane
+        :param item: anything (payload)
+        :param now: monotonic time of arrival
+        """
+        queue = self.queues[lane]
+        if not queue:
+            self.passes[lane] = max(self.passes[lane], self.vtime)
+        queue.append((time.monotonic() if now is None else now, item))
+        self.size += 1
+
+    def choose(self, now: float) -> str:
+        """
+        Lane to serve (some lane is not empty)
+
+        """
+        if self.policy == "priority":
+            ready = [name for name in self.order if self.queues[name]]
+            for name in ready:
+                if now - self.queues[name][0][0] >= self.starvation:
+                    return name
+            return ready[0]
+        return min((self.passes[name], index, name) for index, name in enumerate(self.order) if self.queues[name])[2]
+
+    def next(self, now: float = None):
+        """
+        Take the next item
+
+        :param now: monotonic time
+        :return: (lane, item, seconds it waited in the queue) or None if all lanes are empty
+        """
+        if not self.size:
+            return None
+        now = time.monotonic() if now is None else now
+        lane = self.choose(now)
+        arrived, item = self.queues[lane].popleft()
+        self.size -= 1
+        self.passes[lane] += 1 / self.weights[lane]
+        # Virtual time of the scheduler is the smallest one of busy lanes
+        self.vtime = min((self.passes[name] for name in self.order if self.queues[name]), default=self.passes[lane])
+        return lane, item, now - arrived
+
+    def take(self, count: int, now: float = None) -> list:
+        """
+        :return: up to `count` results of next() in the order of service
+        """
+        taken = []
+        while len(taken) < count:
+            served = self.next(now)
+            if served is None:
+                break
+            taken.append(served)
+        return taken
@@ -7,18 +7,339 @@
 """
 
 import logging
+import threading
 import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import redis
 
-from config import redis_host, redis_port
+from config import redis_host, redis_port, stats_name, consumer_heartbeats, stream_name, metrics_host, metrics_port, \
+    redis_transport, processed_stream_shards
+from histogram import Histogram, STAGES, histograms_from_hash
+from transport import connect
+from shards import shard_names, entries_added
+from entries import entry_created_at
 
 logging.basicConfig(level=logging.DEBUG)
 
+COUNTERS = ("processed_messages", "lock_misses", "decode_errors", "bytes_processed")
+
+
+def processed_total(r: redis.Redis) -> int:
+    """
+    Count of entries ever added to processed stream (all its shards)
+
+    XLEN is not monotonic, stream is trimmed, so i take `entries-added` of XINFO STREAM (Redis 7+)
+
+    :param r: Redis connection
+    :return:
+    """
+    names = shard_names(stream_name, processed_stream_shards)
+    # Shard without messages yet is skipped, stream which is not there at all means not started yet
+    return entries_added(r, names, missing_ok=len(names) > 1)
+
+
+def processed_length(r: redis.Redis) -> int:
+    """
+    Length of processed stream (all its shards)
+
+    :param r: Redis connection
+    :return:
+    """
+    return sum(r.xlen(name) for name in shard_names(stream_name, processed_stream_shards))
+
+
+def last_processed_at(r: redis.Redis) -> float:
+    """
+    Processing time of the newest entry of processed stream (all its shards, any entry layout)
+
+    :param r: Redis connection
+    :return: unix time or None if stream is empty
+    """
+    latest = None
+    for name in shard_names(stream_name, processed_stream_shards):
+        for _, fields in r.xrevrange(name, count=1):
+            created_at = entry_created_at(fields)
+            latest = created_at if latest is None else max(latest, created_at)
+    return latest
+
+
+def consumers_stats(r: redis.Redis) -> dict:
+    """
+    Stats hashes of registered consumers (one pipeline of HGETALL)
+
+    :param r: Redis connection
+    :return: {consumer_id: {field (bytes): value (bytes)}}
+    """
+    consumer_ids = [consumer_id.decode() for consumer_id in r.zrange(consumer_heartbeats, 0, -1)]
+    pipe = r.pipeline()
+    for consumer_id in consumer_ids:
+        pipe.hgetall(f"{stats_name}:{consumer_id}")
+    return dict(zip(consumer_ids, pipe.execute()))
+
+
+def group_stats(r: redis.Redis) -> dict:
+    """
+    Group stats hash, all consumers add to it (see stats.group_stats_key)
+
+    Sums over hashes of registered consumers go down when a consumer leaves, the group hash only grows,
+    so all counters of the whole group are taken from it
+
+    :param r: Redis connection
+    :return: {field (bytes): value (bytes)}
+    """
+    return r.hgetall(f"{stats_name}:group")
+
+
+def consumers_totals(stats: dict) -> dict:
+    """
+    Sum counters of consumers
+
+    :param stats: result of consumers_stats
+    :return: {counter: total}
+    """
+    totals = {name: 0 for name in COUNTERS}
+    for fields in stats.values():
+        for name in totals:
+            totals[name] += int(fields.get(name.encode(), 0))
+    return totals
+
+
+def merged_histograms(stats: dict) -> dict:
+    """
+    Latency histograms of all consumers merged by stage
+
+    :param stats: result of consumers_stats
+    :return: {stage: Histogram}
+    """
+    merged = {stage: Histogram() for stage in STAGES}
+    for fields in stats.values():
+        for stage, histogram in histograms_from_hash(fields).items():
+            merged.setdefault(stage, Histogram()).merge(histogram)
+    return merged
+
+
+def stage_totals(stats: dict) -> dict:
+    """
+    Sum stage counters of pipeline mode (stats fields `stage:<stage>:<counter>`)
+
+    :param stats: result of consumers_stats
+    :return: {stage: {counter: total}}
+    """
+    totals = {}
+    for fields in stats.values():
+        for field, value in fields.items():
+            parts = field.decode().split(":")
+            if len(parts) == 3 and parts[0] == "stage":
+                counters = totals.setdefault(parts[1], {})
+                counters[parts[2]] = counters.get(parts[2], 0) + int(value)
+    return totals
+
+
+def lane_totals(stats: dict) -> dict:
+    """
+    Sum lane counters of consumers (stats fields `lane:<lane>:<counter>`)
+
+    :param stats: result of consumers_stats
+    :return: {lane: {counter: total}}
+    """
+    totals = {}
+    for fields in stats.values():
+        for field, value in fields.items():
+            parts = field.decode().split(":")
+            if len(parts) == 3 and parts[0] == "lane":
+                counters = totals.setdefault(parts[1], {})
+                counters[parts[2]] = counters.get(parts[2], 0) + int(value)
+    return totals
+
+
+def lane_histograms(histograms: dict) -> dict:
+    """
+    End to end latency of lanes (stages `end_to_end@<lane>`)
+
+    :param histograms: result of merged_histograms
+    :return: {lane: Histogram}
+    """
+    return {stage.split("@", 1)[1]: histogram for stage, histogram in histograms.items()
+            if stage.startswith("end_to_end@")}
+
+
+def write_behind_stats(stats: dict) -> dict:
+    """
+    Write-behind fields of consumers (stats fields `writebehind:<name>`)
+
+    :param stats: result of consumers_stats
+    :return: {consumer_id: {name: value}}, only consumers with write-behind
+    """
+    result = {}
+    for consumer_id, fields in stats.items():
+        values = {field.decode().split(":", 1)[1]: int(value) for field, value in fields.items()
+                  if field.startswith(b"writebehind:")}
+        if values:
+            result[consumer_id] = values
+    return result
+
+
+def render_metrics(r: redis.Redis) -> str:
+    """
+    Metrics in Prometheus text exposition format
+
+    p99 for alerts: histogram_quantile(0.99, rate(consumer_message_latency_seconds_bucket[1m]))
+
+    Series of a consumer go away with it, totals of the group and histograms are from the group hash (monotonic)
+
+    :param r: Redis connection
+    :return: text of /metrics
+    """
+    stats = consumers_stats(r)
+    group = {"group": group_stats(r)}
+    lines = [
+        "# HELP processed_stream_length Length of processed messages stream (it's trimmed)",
+        "# TYPE processed_stream_length gauge",
+        f"processed_stream_length {processed_length(r)}",
+        "# HELP processed_stream_entries_added_total Entries ever added to processed messages stream",
+        "# TYPE processed_stream_entries_added_total counter",
+        f"processed_stream_entries_added_total {processed_total(r)}",
+    ]
+    latest = last_processed_at(r)
+    if latest is not None:
+        lines += [
+            "# HELP processed_stream_last_entry_age_seconds Seconds since the newest entry of processed stream",
+            "# TYPE processed_stream_last_entry_age_seconds gauge",
+            f"processed_stream_last_entry_age_seconds {max(0.0, time.time() - latest):.3f}",
+        ]
+    lines += [
+        "# HELP active_consumers Registered consumers",
+        "# TYPE active_consumers gauge",
+        f"active_consumers {len(stats)}",
+    ]
+    # Counters of the whole group ...
+    for name, total in consumers_totals(group).items():
+        metric = f"consumer_group_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {total}")
+    # ... and per consumer, so skew between consumers is visible
+    for name in COUNTERS:
+        metric = f"consumer_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        for consumer_id, fields in sorted(stats.items()):
+            lines.append(f'{metric}{{consumer="{consumer_id}"}} {int(fields.get(name.encode(), 0))}')
+
+    histograms = merged_histograms(group)
+    metric = "consumer_message_latency_seconds"
+    lines.append(f"# HELP {metric} Latency of processed messages by stage, all consumers")
+    lines.append(f"# TYPE {metric} histogram")
+    for stage, histogram in histograms.items():
+        if "@" in stage:
+            continue
+        for le, count in histogram.cumulative():
+            lines.append(f'{metric}_bucket{{stage="{stage}",le="{le}"}} {count}')
+        lines.append(f'{metric}_sum{{stage="{stage}"}} {histogram.sum}')
+        lines.append(f'{metric}_count{{stage="{stage}"}} {histogram.count}')
+
+    # Pipeline mode: the stage with the highest busy rate (per worker) is the bottleneck
+    stages = stage_totals(group)
+    if stages:
+        lines.append("# HELP consumer_stage_items_total Items of pipeline stages by event, all consumers")
+        lines.append("# TYPE consumer_stage_items_total counter")
+        for stage, counters in sorted(stages.items()):
+            for event in ("in", "out", "dropped", "errors"):
+                lines.append(f'consumer_stage_items_total{{stage="{stage}",event="{event}"}} {counters.get(event, 0)}')
+        lines.append("# HELP consumer_stage_busy_seconds_total Time spent in pipeline stages, all consumers")
+        lines.append("# TYPE consumer_stage_busy_seconds_total counter")
+        for stage, counters in sorted(stages.items()):
+            lines.append(f'consumer_stage_busy_seconds_total{{stage="{stage}"}} {counters.get("busy_us", 0) / 1e6}')
+
+    # Priority lanes: p99 of the high lane should stay flat under bulk load
+    lanes = lane_histograms(histograms)
+    if lanes:
+        metric = "consumer_lane_latency_seconds"
+        lines.append(f"# HELP {metric} End to end latency of processed messages by priority lane, all consumers")
+        lines.append(f"# TYPE {metric} histogram")
+        for lane, histogram in sorted(lanes.items()):
+            for le, count in histogram.cumulative():
+                lines.append(f'{metric}_bucket{{lane="{lane}",le="{le}"}} {count}')
+            lines.append(f'{metric}_sum{{lane="{lane}"}} {histogram.sum}')
+            lines.append(f'{metric}_count{{lane="{lane}"}} {histogram.count}')
+    lane_counters = lane_totals(group)
+    if lane_counters:
+        lines.append("# HELP consumer_lane_messages_total Messages of priority lanes by event, all consumers")
+        lines.append("# TYPE consumer_lane_messages_total counter")
+        for lane, counters in sorted(lane_counters.items()):
+            for event in ("processed_messages", "lock_misses"):
+                lines.append(f'consumer_lane_messages_total{{lane="{lane}",event="{event}"}} '
+                             f'{counters.get(event, 0)}')
+
+    # Write-behind: growing queue or spill means Redis doesn't keep up (or is not there)
+    write_behind = write_behind_stats(stats)
+    if write_behind:
+        for name, help_text in (("queued", "Entries queued in memory"),
+                                ("spill_pending", "Spilled entries not replayed yet")):
+            lines.append(f"# HELP consumer_writebehind_{name} {help_text}")
+            lines.append(f"# TYPE consumer_writebehind_{name} gauge")
+            for consumer_id, values in sorted(write_behind.items()):
+                lines.append(f'consumer_writebehind_{name}{{consumer="{consumer_id}"}} {values.get(name, 0)}')
+        lines.append("# HELP consumer_writebehind_entries_total Write-behind entries by event")
+        lines.append("# TYPE consumer_writebehind_entries_total counter")
+        for consumer_id, values in sorted(write_behind.items()):
+            for event in ("written", "spilled", "replayed", "adopted"):
+                lines.append(f'consumer_writebehind_entries_total{{consumer="{consumer_id}",event="{event}"}} '
+                             f'{values.get(event, 0)}')
+        for name, help_text in (("spilled_bytes", "Bytes spilled to disk"), ("errors", "Failed writes")):
+            lines.append(f"# HELP consumer_writebehind_{name}_total {help_text}")
+            lines.append(f"# TYPE consumer_writebehind_{name}_total counter")
+            for consumer_id, values in sorted(write_behind.items()):
+                lines.append(f'consumer_writebehind_{name}_total{{consumer="{consumer_id}"}} {values.get(name, 0)}')
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    GET /metrics, metrics are read from Redis on every scrape
+    """
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        try:
+            body = render_metrics(self.server.redis).encode()
+        except redis.RedisError as e:
+            self.send_error(503, str(e))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would flood the log
+        pass
+
+
+def start_metrics_server(r: redis.Redis, host: str = metrics_host, port: int = metrics_port) -> ThreadingHTTPServer:
+    """
+    Serve /metrics in background thread
+
+    :param r: Redis connection
+    :return: server (call shutdown() to stop it)
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.redis = r
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Metrics are served on http://{host}:{port}/metrics")
+    return server
+
+
 def monitor_processed_messages(seconds:int = 3):
     """Мониторинг количества обработанных сообщений"""
-    r = redis.Redis(host=redis_host, port=redis_port)
+    r = connect(redis_host, redis_port, **redis_transport)
+    start_metrics_server(r)
     last_time = time.time()
     last_count = 0
+    last_latency = Histogram()
+    last_lanes = {}
 
     itr = 0
     while True:
@@ -26,9 +347,31 @@ def monitor_processed_messages(seconds:int = 3):
         itr += 1
         current_time = time.time()
         try:
-            messages_count = r.xlen("messages:processed")
+            messages_count = processed_total(r)
             rate = (messages_count - last_count) / (current_time - last_time)
             logging.info(f"[{itr}] Processed {messages_count} messages, speed: {rate:.2f} msg/sec.")
+            group = {"group": group_stats(r)}
+            totals = consumers_totals(group)
+            logging.info(f"[{itr}] Consumers: processed {totals['processed_messages']}, "
+                         f"lock misses {totals['lock_misses']}, decode errors {totals['decode_errors']}, "
+                         f"bytes {totals['bytes_processed']}.")
+            histograms = merged_histograms(group)
+            latency = histograms["end_to_end"]
+            interval = latency.since(last_latency)
+            if interval.count:
+                logging.info(f"[{itr}] End to end latency: p50 {interval.quantile(0.5) * 1000:.2f} ms, "
+                             f"p99 {interval.quantile(0.99) * 1000:.2f} ms.")
+            last_latency = latency
+            lanes = lane_histograms(histograms)
+            rows = []
+            for lane, histogram in sorted(lanes.items()):
+                interval = histogram.since(last_lanes.get(lane, Histogram()))
+                if interval.count:
+                    rows.append(f"{lane} {interval.count / (current_time - last_time):.0f} msg/sec "
+                                f"p99 {interval.quantile(0.99) * 1000:.2f} ms")
+            if rows:
+                logging.info(f"[{itr}] Lanes: " + ", ".join(rows) + ".")
+            last_lanes = lanes
         except:
             logging.warn("Not started yet")
             continue
@@ -37,4 +380,4 @@ def monitor_processed_messages(seconds:int = 3):
 
 
 if __name__ == "__main__":
-    monitor_processed_messages()
\ No newline at end of file
+    monitor_processed_messages()
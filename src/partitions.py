@@ -0,0 +1,99 @@
+"""
+    Partitioned Pub/Sub
+
+    Publisher routes every message to one of K partition channels by hash of message_id
+    (`PUBSUB_CHANNEL:{i}`, see shards.py), so every message is sent only to the consumer(s) of its partition.
+
+    Assignment of partitions is computed by every consumer on its own from the same registry
+    (members of heartbeats sorted set) by rendezvous hashing with bounded load: partition goes to the member
+    with the highest hash of "member:partition" which doesn't have its fair share (K // members, then one more
+    for the rest) yet.
+    Nobody coordinates it, and when a member joins or leaves mostly only its partitions move.
+
+    While views of members differ (one consumer saw the change, another one not yet) a partition can be
+    heard by two consumers or by nobody. So the new owner subscribes at once and the old one keeps the
+    partition for `grace` seconds more - duplicates are dropped by locks.
+
+    Pub/Sub doesn't keep messages, so what is sent to a partition nobody hears is lost for good:
+    - view skew longer than `grace`: the new owner sees the change late (e.g. its rebalance notice was missed
+      and it waits for the next rebalance interval), the old one drops the partition after `grace` - the
+      partition is unheard until the new owner subscribes
+    - crashed member (no goodbye notice) - its partitions are unheard until its heartbeat is older than
+      PUBSUB_MEMBER_TTL and the others take them
+    Use stream ingest (consumer group) if every message must be processed.
+"""
+
+import hashlib
+
+
+def ranking(partition: int, members) -> list:
+    """
+    Members by their preference for partition (rendezvous hashing)
+
+    :param members: consumer ids
+    :return: consumer ids, the most preferred first
+    """
+    def weight(member):
+        return hashlib.blake2b(f"{member}:{partition}".encode(), digest_size=8).digest(), member
+    return sorted(members, key=weight, reverse=True)
+
+
+def assign(members, partitions: int) -> dict:
+    """
+    Assignment of all partitions
+
+    :param members: consumer ids
+    :param partitions: count of partitions
+    :return: {consumer id: [partition, ...]}, every member is in it (maybe with no partitions)
+    """
+    members = sorted(set(members))
+    assignment = {member: [] for member in members}
+    if not members:
+        return assignment
+    # Everybody gets his fair share first, the rest goes one by one, so nobody stays idle while somebody has many
+    share = partitions // len(members)
+    rest = []
+    for partition in range(partitions):
+        owner = next((member for member in ranking(partition, members) if len(assignment[member]) < share), None)
+        if owner is None:
+            rest.append(partition)
+        else:
+            assignment[owner].append(partition)
+    for partition in rest:
+        owner = next(member for member in ranking(partition, members) if len(assignment[member]) <= share)
+        assignment[owner].append(partition)
+    return assignment
+
+
+class PartitionSubscription:
+    """
+    Partitions of one subscriber
+
+    update() tells which channels to subscribe and unsubscribe to get from the current set to the wanted one:
+    new partitions at once, lost ones after `grace` seconds.
+    """
+
+    def __init__(self, channels: list, grace: float) -> None:
+        self.channels = channels
+        self.grace = grace
+        # Partitions i'm subscribed to and partitions to let go: {partition: unsubscribe time}
+        self.owned = set()
+        self.dropping = {}
+
+    def update(self, wanted, now: float) -> tuple:
+        """
+        :param wanted: partitions assigned to me now
+        :param now: current time
+        :return: (channels to subscribe, channels to unsubscribe)
+        """
+        wanted = set(wanted)
+        subscribe = sorted(wanted - self.owned)
+        for partition in wanted:
+            self.dropping.pop(partition, None)
+        for partition in self.owned - wanted:
+            self.dropping.setdefault(partition, now + self.grace)
+        unsubscribe = sorted(partition for partition, at in self.dropping.items() if at <= now)
+        for partition in unsubscribe:
+            del self.dropping[partition]
+        self.owned = (self.owned | wanted) - set(unsubscribe)
+        return [self.channels[p] for p in subscribe], [self.channels[p] for p in unsubscribe]
@@ -0,0 +1,239 @@
+"""
+    Staged processing pipeline
+
+    Messages go through stages, every stage has its own bounded input queue and its own workers:
+
+        intake -> [decode] -> [filter] -> [transform] -> ... -> [sink]
+
+    - thread  - `workers` threads call the function (I/O bound and cheap stages)
+    - process - the function runs in a process pool of `workers` (CPU bound stages, it must be picklable -
+                a module level function), at most 2 * workers items are in flight
+    - sink    - one thread takes items by batches (up to `batch_size`, waiting `linger` seconds for the rest)
+
+    Stage function takes an item and returns the next item, None drops it (filtered).
+    Backpressure: a full queue blocks the stage before it, down to put() of the intake, so a saturated
+    process pool slows down reading instead of eating memory.
+
+    Every stage counts items in / out / dropped / errors and seconds spent in its function (busy),
+    busy / elapsed time close to `workers` and a full input queue show the bottleneck.
+"""
+
+import importlib
+import logging
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+# End of stream, every worker of a stage gets one
+STOP = object()
+
+
+def load_function(path: str):
+    """
+    Import function by its path
+
+    :param path: "package.module:function"
+    :return: function
+    """
+    module, _, name = path.partition(":")
+    if not name:
+        raise ValueError(f"Function path must be module:function, not {path}")
+    return getattr(importlib.import_module(module), name)
+
+
+class Stage:
+    def __init__(self, name: str, function, executor: str = "thread", workers: int = 1,
+                 queue_size: int = 1000) -> None:
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Unknown stage executor {executor}, use thread or process")
+        self.name = name
+        self.function = function
+        self.executor = executor
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.counters = Counter()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.pool = None
+        self.next = None
+
+    def count(self, **counters) -> None:
+        with self.lock:
+            self.counters.update(counters)
+
+    def emit(self, result) -> None:
+        if result is None:
+            self.count(dropped=1)
+        else:
+            self.count(out=1)
+            self.next.put(result)
+
+    def start(self, next_queue) -> None:
+        self.next = next_queue
+        if self.executor == "process":
+            self.pool = ProcessPoolExecutor(self.workers)
+            self.threads = [threading.Thread(target=self.feed_pool, name=f"stage-{self.name}", daemon=True)]
+        else:
+            self.threads = [threading.Thread(target=self.work, name=f"stage-{self.name}-{i}", daemon=True)
+                            for i in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self) -> None:
+        for _ in self.threads:
+            self.queue.put(STOP)
+        for thread in self.threads:
+            thread.join()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def work(self) -> None:
+        """
+        Thread worker
+
+        """
+        while True:
+            item = self.queue.get()
+            if item is STOP:
+                return
+            started = time.perf_counter()
+            try:
+                result = self.function(item)
+            except Exception as e:
+                logging.debug(f"Stage {self.name} failed: {e}")
+                self.count(**{"in": 1, "errors": 1})
+                continue
+            finally:
+                self.count(busy_us=int((time.perf_counter() - started) * 1e6))
+            self.count(**{"in": 1})
+            self.emit(result)
+
+    def feed_pool(self) -> None:
+        """
+        Feed process pool keeping order of items and at most 2 * workers of them in flight
+
+        Busy time is the time of waiting for results, it's what the pool costs the pipeline
+        """
+        inflight = deque()
+        stopping = False
+        while not stopping or inflight:
+            if not stopping and len(inflight) < 2 * self.workers:
+                try:
+                    item = self.queue.get(timeout=0.001 if inflight else 0.1)
+                except queue.Empty:
+                    item = None
+                if item is STOP:
+                    stopping = True
+                elif item is not None:
+                    inflight.append(self.pool.submit(self.function, item))
+                    continue
+            if not inflight:
+                continue
+            # The oldest one is waited for only when no more can be taken
+            if not (inflight[0].done() or stopping or len(inflight) >= 2 * self.workers):
+                continue
+            started = time.perf_counter()
+            future = inflight.popleft()
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.debug(f"Stage {self.name} failed: {e}")
+                self.count(**{"in": 1, "errors": 1})
+                continue
+            finally:
+                self.count(busy_us=int((time.perf_counter() - started) * 1e6))
+            self.count(**{"in": 1})
+            self.emit(result)
+
+    def snapshot(self) -> dict:
+        """
+        Take counters since the last snapshot
+
+        :return: {counter: value} with the current depth of input queue
+        """
+        with self.lock:
+            counters, self.counters = self.counters, Counter()
+        counters["queued"] = self.queue.qsize()
+        return counters
+
+
+class StagePipeline:
+    """
+    Stages connected by their queues, ending with a batching sink
+
+    """
+
+    def __init__(self, stages: list, sink, batch_size: int = 500, linger: float = 0.005,
+                 queue_size: int = 1000) -> None:
+        """
+        :param stages: list of Stage
+        :param sink: function (list of items), called by one thread
+        :param batch_size: most items per sink call
+        :param linger: seconds to wait for more items of a batch after the first one
+        """
+        self.stages = stages
+        self.sink = Stage("sink", sink, queue_size=queue_size)
+        self.batch_size = batch_size
+        self.linger = linger
+
+    def start(self) -> None:
+        queues = [stage.queue for stage in self.stages[1:]] + [self.sink.queue]
+        for stage, next_queue in zip(self.stages, queues):
+            stage.start(next_queue)
+        self.sink.threads = [threading.Thread(target=self.drain_sink, name="stage-sink", daemon=True)]
+        self.sink.threads[0].start()
+
+    def put(self, item) -> None:
+        """
+        Put item into the first stage, blocks while it's full (backpressure)
+
+        """
+        (self.stages[0] if self.stages else self.sink).queue.put(item)
+
+    def close(self) -> None:
+        """
+        Process everything what's in the queues and stop
+
+        """
+        for stage in self.stages:
+            stage.stop()
+        self.sink.stop()
+
+    def drain_sink(self) -> None:
+        """
+        Sink thread: call sink with batches
+
+        """
+        stopping = False
+        while not stopping:
+            item = self.sink.queue.get()
+            if item is STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.linger
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.sink.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            started = time.perf_counter()
+            try:
+                self.sink.function(batch)
+            except Exception as e:
+                logging.warning(f"Sink failed, batch of {len(batch)} is lost: {e}")
+                self.sink.count(errors=len(batch))
+            self.sink.count(**{"in": len(batch), "busy_us": int((time.perf_counter() - started) * 1e6)})
+
+    def snapshot(self) -> dict:
+        """
+        Counters of all stages since the last snapshot
+
+        :return: {stage name: counters}
+        """
+        return {stage.name: stage.snapshot() for stage in self.stages + [self.sink]}
@@ -1,21 +1,79 @@
-import os
+import argparse
+import math
 import random
 from datetime import datetime, timedelta
+from functools import lru_cache
 import time
 import uuid
+from multiprocessing import Pool
+
 import redis
 
-redis_host = os.getenv("REDIS_HOST","localhost")
-redis_port = os.getenv("REDIS_PORT", 6379)
+from config import redis_host, redis_port, pubsub_channel, ingest_backend, input_stream, input_stream_maxlen, \
+    message_codec, redis_transport, pubsub_partitions, priority_lanes
+from codec import get_codec
+from histogram import Histogram
+from transport import connect
+from shards import shard_names, shard_for
+from lanes import parse_lanes, lane_channel
+
 target_duration = timedelta(minutes=2)
 batch_size = 1000
 
-def publisher():
+
+@lru_cache(maxsize=None)
+def default_lane(lanes: str, backend: str, partitions: int) -> str:
+    """
+    Lane of messages published without lane: with LANES consumers listen only to lane channels,
+    so such messages go to the last (the lowest) lane instead of the channel nobody listens to
+
+    :return: name of lane, None if there are no lanes
+    """
+    if not lanes or backend != "pubsub" or partitions > 1:
+        return None
+    return parse_lanes(lanes)[-1][0]
+
+
+def publish(pipe, payload: bytes, message_id: str = None, lane: str = None) -> None:
+    """
+    Queue one message into pipeline according to ingest backend
+
+    :param message_id: chooses partition channel of partitioned Pub/Sub
+    :param lane: priority lane, message goes to its channel (see lanes.py), None - the default lane if LANES is set
+    """
+    if lane is None:
+        lane = default_lane(priority_lanes, ingest_backend, pubsub_partitions)
+    if lane is not None:
+        pipe.publish(lane_channel(pubsub_channel, lane), payload)
+    elif ingest_backend == "stream":
+        # Consumer group will deliver it only to one consumer
+        pipe.xadd(input_stream, {"data": payload}, maxlen=input_stream_maxlen, approximate=True)
+    elif pubsub_partitions > 1:
+        # Only consumers of the partition will get it
+        pipe.publish(shard_for(shard_names(pubsub_channel, pubsub_partitions), message_id), payload)
+    else:
+        pipe.publish(pubsub_channel, payload)
+
+
+def check_lane(lane: str) -> None:
+    """
+    Lane must be one of LANES, consumers listen only to their channels
+
+    """
+    if ingest_backend != "pubsub" or pubsub_partitions > 1:
+        raise ValueError("Lanes need pubsub ingest without partitions")
+    names = [name for name, _ in parse_lanes(priority_lanes)] if priority_lanes else []
+    if lane not in names:
+        raise ValueError(f"Unknown lane {lane}, LANES are {priority_lanes!r}")
+
+
+def publisher(lane: str = None):
     try:
-        connection = redis.Redis(host=redis_host, port=redis_port)
+        connection = connect(redis_host, redis_port, **redis_transport)
     except redis.ConnectionError:
         print("Error: Failed to connect to Redis server")
         exit(1)
+    codec = get_codec(message_codec)
     start_time = datetime.now()
     total_messages = 0
 
@@ -23,9 +81,9 @@ def publisher():
         while datetime.now() - start_time < target_duration:
             p = connection.pipeline()
             for _ in range(batch_size):
-                p.publish("messages:published",
-                          f'{{"message_id":"{str(uuid.uuid4())}"}}'
-                          )
+                # Publish time lets consumers measure end to end latency
+                message_id = str(uuid.uuid4())
+                publish(p, codec.dumps({"message_id": message_id, "published_at": time.time()}), message_id, lane)
             p.execute()
             total_messages += batch_size
             time.sleep(random.uniform(0.1, 0.5))
@@ -34,5 +92,209 @@ def publisher():
     finally:
         print(f"Total messages published: {total_messages}")
 
+
+# Load generator mode
+#
+# Open loop: every message has its intended send time from the rate profile, the schedule doesn't wait
+# for Redis. Publish latency is counted from the intended time to the acknowledge of the pipeline,
+# so when Redis (or the generator) falls behind, the waiting is in the latency too (no coordinated omission).
+
+class LoadProfile:
+    """
+    Target rate as a function of time
+
+    - constant: `rate` all the time
+    - step: `rate`, then + `step_rate` every `step_seconds` (up to `max_rate` if it's set)
+    - ramp: linear from `rate` to `max_rate` during `duration`
+    """
+
+    def __init__(self, kind: str, rate: float, duration: float, max_rate: float = None,
+                 step_rate: float = 0, step_seconds: float = 10) -> None:
+        if kind not in ("constant", "step", "ramp"):
+            raise ValueError(f"Unknown load profile {kind}")
+        if kind == "ramp" and duration <= 0:
+            raise ValueError(f"Ramp needs positive duration, not {duration}")
+        if kind == "step" and step_seconds <= 0:
+            raise ValueError(f"Step needs positive step_seconds, not {step_seconds}")
+        self.kind = kind
+        self.rate = rate
+        self.duration = duration
+        self.max_rate = max_rate
+        self.step_rate = step_rate
+        self.step_seconds = step_seconds
+
+    def rate_at(self, t: float) -> float:
+        """
+        :param t: seconds since start
+        :return: msgs/sec
+        """
+        if self.kind == "step":
+            rate = self.rate + self.step_rate * int(t // self.step_seconds)
+            return min(rate, self.max_rate) if self.max_rate else rate
+        if self.kind == "ramp":
+            return self.rate + ((self.max_rate or self.rate) - self.rate) * min(1.0, t / self.duration)
+        return self.rate
+
+    def schedule(self, share: float = 1.0, phase: float = 0.0):
+        """
+        Intended send times
+
+        :param share: part of the rate for this worker
+        :param phase: part of the first interval to shift this worker's schedule (workers interleave)
+        :return: iterator of seconds since start
+        """
+        t = phase / max(self.rate_at(0) * share, 1e-9)
+        # Tolerance of accumulated float error, so 10 msgs/sec for 1 second is 10 messages
+        while t < self.duration - 1e-9:
+            yield t
+            t += 1 / max(self.rate_at(t) * share, 1e-9)
+
+
+def message_factory(shape: str, payload_size: int):
+    """
+    Build messages of given shape, padded up to payload size (JSON bytes, approximately)
+
+    :param shape: id - message_id only, flat - a few scalar fields, nested - list of objects
+    :param payload_size: target size of encoded message, 0 - no padding
+    :return: function (published_at) -> message
+    """
+    if shape == "id":
+        template = {}
+    elif shape == "flat":
+        template = {"user": 12345, "event": "click", "amount": 9.99, "tags": ["a", "b", "c"]}
+    elif shape == "nested":
+        template = {"items": [{"sku": f"sku-{i}", "qty": i, "price": i * 1.5} for i in range(5)]}
+    else:
+        raise ValueError(f"Unknown message shape {shape}")
+
+    sample = get_codec("json").dumps({"message_id": str(uuid.uuid4()), "published_at": time.time(), **template})
+    padding = max(0, payload_size - len(sample) - len(',"padding":""'))
+    if padding:
+        template["padding"] = "x" * padding
+
+    def make(published_at: float) -> dict:
+        return {"message_id": str(uuid.uuid4()), "published_at": published_at, **template}
+    return make
+
+
+def generate_load(profile: LoadProfile, share: float, phase: float, shape: str, payload_size: int,
+                  max_batch: int, report_interval: float, lane: str = None) -> dict:
+    """
+    Publish by the open loop schedule (one worker)
+
+    :param lane: priority lane of messages
+
+    :return: {"sent": int, "latency": Histogram, "intervals": {interval: [sent, Histogram]}}
+    """
+    connection = connect(redis_host, redis_port, **redis_transport)
+    codec = get_codec(message_codec)
+    make = message_factory(shape, payload_size)
+    schedule = profile.schedule(share, phase)
+    latency = Histogram()
+    intervals = {}
+    sent = 0
+
+    wall_start, start = time.time(), time.monotonic()
+    intended = next(schedule, None)
+    while intended is not None:
+        now = time.monotonic() - start
+        if intended > now:
+            time.sleep(intended - now)
+            continue
+        # Everything which is due goes by one pipeline
+        due = []
+        pipe = connection.pipeline(transaction=False)
+        while intended is not None and intended <= now and len(due) < max_batch:
+            # Message is stamped by its intended time, consumer latency includes lag of the generator too
+            message = make(wall_start + intended)
+            publish(pipe, codec.dumps(message), message["message_id"], lane)
+            due.append(intended)
+            intended = next(schedule, None)
+        pipe.execute()
+        acked = time.monotonic() - start
+        # Tail acknowledged after the end of schedule belongs to the last interval
+        index = min(int(acked // report_interval), max(0, math.ceil(profile.duration / report_interval) - 1))
+        interval = intervals.setdefault(index, [0, Histogram()])
+        interval[0] += len(due)
+        for t in due:
+            latency.record(acked - t)
+            interval[1].record(acked - t)
+        sent += len(due)
+    connection.close()
+    return {"sent": sent, "latency": latency, "intervals": intervals, "elapsed": time.monotonic() - start}
+
+
+def _generate_load(kwargs: dict) -> dict:
+    return generate_load(**kwargs)
+
+
+def run_load(profile: LoadProfile, processes: int = 1, shape: str = "id", payload_size: int = 0,
+             max_batch: int = 100, report_interval: float = 5, lane: str = None) -> dict:
+    """
+    Run load generator in `processes` worker processes, each one takes its share of the rate
+
+    :return: merged results of workers
+    """
+    workers = [dict(profile=profile, share=1 / processes, phase=i / processes, shape=shape,
+                    payload_size=payload_size, max_batch=max_batch, report_interval=report_interval, lane=lane)
+               for i in range(processes)]
+    if processes == 1:
+        results = [generate_load(**workers[0])]
+    else:
+        with Pool(processes) as pool:
+            results = pool.map(_generate_load, workers)
+
+    merged = {"sent": 0, "latency": Histogram(), "intervals": {}, "elapsed": 0.0}
+    for result in results:
+        merged["sent"] += result["sent"]
+        merged["latency"].merge(result["latency"])
+        merged["elapsed"] = max(merged["elapsed"], result["elapsed"])
+        for index, (sent, histogram) in result["intervals"].items():
+            interval = merged["intervals"].setdefault(index, [0, Histogram()])
+            interval[0] += sent
+            interval[1].merge(histogram)
+    return merged
+
+
+def report(profile: LoadProfile, result: dict, report_interval: float) -> None:
+    """
+    Print achieved rate and publish latency percentiles by intervals and in total
+
+    """
+    print(f"{'from s':>7} {'target/s':>10} {'achieved/s':>11} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for index in sorted(result["intervals"]):
+        sent, histogram = result["intervals"][index]
+        print(f"{index * report_interval:>7.0f} {profile.rate_at(index * report_interval):>10.0f} "
+              f"{sent / report_interval:>11.0f} {histogram.quantile(0.5) * 1000:>8.2f} "
+              f"{histogram.quantile(0.99) * 1000:>8.2f} {histogram.quantile(1.0) * 1000:>8.2f}")
+    latency = result["latency"]
+    print(f"Total messages published: {result['sent']}, achieved {result['sent'] / result['elapsed']:.0f} msgs/sec, "
+          f"publish latency p50 {latency.quantile(0.5) * 1000:.2f} ms, p90 {latency.quantile(0.9) * 1000:.2f} ms, "
+          f"p99 {latency.quantile(0.99) * 1000:.2f} ms, p99.9 {latency.quantile(0.999) * 1000:.2f} ms")
+
+
 if __name__ == "__main__":
-    publisher()
+    parser = argparse.ArgumentParser(description="Publisher (fixed loop) or open loop load generator (--rate)")
+    parser.add_argument('--rate', type=float, help="Target msgs/sec, enables load generator")
+    parser.add_argument('--duration', type=float, default=60, help="Seconds")
+    parser.add_argument('--profile', choices=["constant", "step", "ramp"], default="constant")
+    parser.add_argument('--max_rate', type=float, help="Final rate of ramp, limit of step")
+    parser.add_argument('--step_rate', type=float, default=1000, help="Rate increment of step profile")
+    parser.add_argument('--step_seconds', type=float, default=10, help="Step length of step profile")
+    parser.add_argument('--shape', choices=["id", "flat", "nested"], default="id", help="Message shape")
+    parser.add_argument('--payload_size', type=int, default=0, help="Pad message to this size (bytes)")
+    parser.add_argument('--processes', type=int, default=1, help="Publishing processes")
+    parser.add_argument('--max_batch', type=int, default=100, help="Most messages per pipeline")
+    parser.add_argument('--report_interval', type=float, default=5, help="Seconds per row of the report")
+    parser.add_argument('--lane', help="Priority lane of messages (one of LANES)")
+    args = parser.parse_args()
+
+    if args.lane is not None:
+        check_lane(args.lane)
+    if args.rate is None:
+        publisher(args.lane)
+    else:
+        load_profile = LoadProfile(args.profile, args.rate, args.duration, args.max_rate, args.step_rate,
+                                   args.step_seconds)
+        report(load_profile, run_load(load_profile, args.processes, args.shape, args.payload_size, args.max_batch,
+                                      args.report_interval, args.lane), args.report_interval)
@@ -0,0 +1,328 @@
+"""
+   I'm the younger brother of monitoring bot.
+   He counts processed messages, and i count what they cost Redis: commands, CPU and memory per processed
+   message, broken down by key families of the design - so we can see which part of it dominates server cost.
+
+   During the run i sample INFO commandstats / cpu / memory / clients, biggest output buffer of Pub/Sub clients,
+   processed stream and consumer stats, at the start and at the end i size key families (SCAN + MEMORY USAGE)
+   and take SLOWLOG entries of the run.
+
+       python src/redis_profiler.py --duration 60 --interval 5
+
+   Commands are attributed to families by their kind (INFO commandstats has no keys): SET NX / HSETNX / EXPIRE*
+   are locks, H* are stats, Z* / S* are registry (ids), X* are streams, PUBLISH / SUBSCRIBE are Pub/Sub.
+   Redis counts the commands which a Lua script runs under their own names too, so the SET / HSETNX / EXPIREAT / XADD
+   of script mode are in their families already. "script" row (EVALSHA) shows calls of scripts and their whole
+   time, inner commands included - it's not added to the total, that would count script mode twice.
+   Message index (index.py) is written by HSET / EXPIREAT inside scripts, so its commands are in stats / locks,
+   index row has only memory of its own.
+   My own calls go to "other": i count what i send (OwnCalls) and move that many calls of the command out of
+   its family, with the average usec of the command.
+"""
+
+import argparse
+import logging
+import time
+from collections import Counter
+
+import redis
+
+from config import redis_host, redis_port, redis_transport, lock_name, dedup_name, stats_name, consumer_ids, \
+    consumer_heartbeats, stream_name, input_stream, processed_stream_shards, instrument_name, index_name
+from monitoring import processed_total, group_stats, consumers_totals
+from transport import connect
+from shards import shard_names
+
+logging.basicConfig(level=logging.DEBUG)
+
+FAMILIES = ("locks", "script", "stats", "ids", "stream", "index", "pubsub", "other")
+# Calls and time of scripts are the calls and time of commands they run, they are not in totals
+TOTAL_FAMILIES = tuple(family for family in FAMILIES if family != "script")
+
+COMMAND_FAMILIES = {
+    "locks": ("set", "setnx", "hsetnx", "expire", "expireat", "pexpire", "del", "unlink", "exists", "get"),
+    "script": ("evalsha", "eval", "evalsha_ro", "eval_ro", "fcall", "fcall_ro"),
+    "stats": ("hincrby", "hincrbyfloat", "hset", "hmset", "hget", "hgetall", "hdel", "hmget"),
+    "ids": ("zadd", "zrem", "zrange", "zrangebyscore", "zremrangebyscore", "zscore", "zcard", "sadd", "srem",
+            "smembers", "sismember", "scard"),
+    "stream": ("xadd", "xrange", "xrevrange", "xread", "xreadgroup", "xack", "xlen", "xinfo", "xgroup",
+               "xautoclaim", "xclaim", "xpending", "xtrim", "xdel"),
+    "pubsub": ("publish", "subscribe", "unsubscribe", "psubscribe", "punsubscribe", "pubsub", "spublish",
+               "ssubscribe", "sunsubscribe"),
+}
+FAMILY_OF_COMMAND = {command: family for family, commands in COMMAND_FAMILIES.items() for command in commands}
+
+
+def family_of(command: str) -> str:
+    """
+    Family of command
+
+    :param command: name as INFO commandstats has it, e.g. "set" or "xinfo|stream"
+    :return: one of FAMILIES
+    """
+    return FAMILY_OF_COMMAND.get(command.lower().split("|")[0], "other")
+
+
+def key_families() -> dict:
+    """
+    Keys and key patterns of families (names are taken from config.py)
+
+    :return: {family: [key or pattern]}
+    """
+    return {
+        "locks": [f"{lock_name}:*", f"{dedup_name}:*"],
+        "stats": [f"{stats_name}:*", f"{instrument_name}*"],
+        "ids": [consumer_ids, consumer_heartbeats],
+        "stream": shard_names(stream_name, processed_stream_shards) + [input_stream],
+        "index": [f"{index_name}:*"],
+    }
+
+
+class OwnCalls:
+    def __init__(self, r: redis.Redis) -> None:
+        """
+        Counts commands which i send through `r` (its pipelines included) - INFO commandstats can't tell whose
+        calls they are, so without it my XINFO, ZRANGE, HGETALL and EXISTS would be counted as the workload
+
+        :param r: Redis connection, its execute_command and pipeline are wrapped
+        """
+        self.calls = Counter()
+        execute_command = r.execute_command
+        pipeline = r.pipeline
+
+        def counted_command(*args, **options):
+            self.count(args)
+            return execute_command(*args, **options)
+
+        def counted_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            def counted_execute(*execute_args, **execute_kwargs):
+                if pipe.command_stack:
+                    if pipe.transaction:
+                        self.calls.update(("multi", "exec"))
+                    for command_args, _ in pipe.command_stack:
+                        self.count(command_args)
+                return execute(*execute_args, **execute_kwargs)
+
+            pipe.execute = counted_execute
+            return pipe
+
+        r.execute_command = counted_command
+        r.pipeline = counted_pipeline
+
+    def count(self, args: tuple) -> None:
+        """
+        :param args: command as redis-py sends it, e.g. ("XINFO STREAM", name) -> "xinfo|stream"
+        """
+        self.calls["|".join(str(args[0]).lower().split())] += 1
+
+
+def command_costs(commandstats: dict, own: dict = None) -> dict:
+    """
+    Sum commandstats by families
+
+    :param commandstats: INFO commandstats ({"cmdstat_set": {"calls": .., "usec": ..}})
+    :param own: my own calls so far ({"xinfo|stream": n}, OwnCalls.calls), they go to "other"
+    :return: {family: {"calls": n, "usec": n}}
+    """
+    costs = {family: {"calls": 0, "usec": 0} for family in FAMILIES}
+    for name, stat in commandstats.items():
+        command = name.removeprefix("cmdstat_")
+        calls, usec = int(stat["calls"]), int(stat["usec"])
+        mine = min((own or {}).get(command, 0), calls)
+        mine_usec = usec * mine // calls if calls else 0
+        family = costs[family_of(command)]
+        family["calls"] += calls - mine
+        family["usec"] += usec - mine_usec
+        costs["other"]["calls"] += mine
+        costs["other"]["usec"] += mine_usec
+    return costs
+
+
+def pubsub_buffer(r: redis.Redis) -> int:
+    """
+    The biggest output buffer of Pub/Sub clients (bytes) - messages published, but not read by a consumer yet
+    """
+    return max((int(client["omem"]) for client in r.client_list(_type="pubsub")), default=0)
+
+
+def snapshot(r: redis.Redis, own: OwnCalls = None) -> dict:
+    """
+    Counters of Redis and of the workload at the moment
+
+    :param r: Redis connection
+    :param own: my own calls through `r`, moved to "other"
+    :return: dict
+    """
+    cpu = r.info("cpu")
+    memory = r.info("memory")
+    clients = r.info("clients")
+    totals = consumers_totals({"group": group_stats(r)})
+    return {
+        "time": time.time(),
+        "commands": command_costs(r.info("commandstats"), own.calls if own else None),
+        "cpu_usec": (float(cpu["used_cpu_sys"]) + float(cpu["used_cpu_user"])) * 1e6,
+        "used_memory": int(memory["used_memory"]),
+        "clients": int(clients["connected_clients"]),
+        "pubsub_buffer": pubsub_buffer(r),
+        "processed": processed_total(r),
+        "attempts": totals["processed_messages"] + totals["lock_misses"],
+    }
+
+
+def family_memory(r: redis.Redis, families: dict, sample: int = 100) -> dict:
+    """
+    Memory of key families: exact for keys, estimated by `sample` keys of every pattern
+
+    :param r: Redis connection
+    :param families: result of key_families
+    :param sample: keys of pattern measured by MEMORY USAGE
+    :return: {family: {"keys": n, "bytes": n}}
+    """
+    result = {}
+    for family, names in families.items():
+        keys = 0
+        size = 0.0
+        for name in names:
+            if "*" in name:
+                found = 0
+                measured = []
+                for key in r.scan_iter(match=name, count=1000):
+                    found += 1
+                    if len(measured) < sample:
+                        measured.append(key)
+            else:
+                measured = [name] if r.exists(name) else []
+                found = len(measured)
+            if not measured:
+                continue
+            pipe = r.pipeline(transaction=False)
+            for key in measured:
+                pipe.memory_usage(key, samples=0)
+            usage = [value or 0 for value in pipe.execute()]
+            keys += found
+            size += sum(usage) / len(usage) * found
+        result[family] = {"keys": keys, "bytes": int(size)}
+    return result
+
+
+def slowlog_since(r: redis.Redis, last_id: int, count: int = 1024) -> dict:
+    """
+    Slow commands logged after entry `last_id` by families
+
+    :return: {family: {"count": n, "usec": n, "slowest": command}}
+    """
+    result = {}
+    for entry in r.slowlog_get(count):
+        if entry["id"] <= last_id:
+            continue
+        command = entry["command"]
+        command = command.decode(errors="replace") if isinstance(command, bytes) else str(command)
+        family = result.setdefault(family_of(command.split(" ")[0]), {"count": 0, "usec": 0, "slowest": None,
+                                                                      "slowest_usec": 0})
+        family["count"] += 1
+        family["usec"] += entry["duration"]
+        if entry["duration"] > family["slowest_usec"]:
+            family["slowest"], family["slowest_usec"] = command[:80], entry["duration"]
+    return result
+
+
+def slowlog_last_id(r: redis.Redis) -> int:
+    entries = r.slowlog_get(1)
+    return entries[0]["id"] if entries else -1
+
+
+def interval_line(old: dict, new: dict) -> str:
+    """
+    One line of the interval between two snapshots
+
+    """
+    seconds = max(new["time"] - old["time"], 1e-9)
+    processed = new["processed"] - old["processed"]
+    calls = sum(new["commands"][f]["calls"] - old["commands"][f]["calls"] for f in TOTAL_FAMILIES)
+    per_message = max(processed, 1)
+    return (f"{processed / seconds:.0f} msg/s, {calls / per_message:.2f} commands/msg, "
+            f"{(new['cpu_usec'] - old['cpu_usec']) / per_message:.1f} CPU usec/msg, "
+            f"memory {new['used_memory']} B, clients {new['clients']}, pubsub buffer {new['pubsub_buffer']} B")
+
+
+def cost_report(first: dict, last: dict, memory_before: dict, memory_after: dict, slowlog: dict) -> str:
+    """
+    Cost of the run per processed message by families
+
+    :param first: snapshot at the start
+    :param last: snapshot at the end
+    :param memory_before: family_memory at the start
+    :param memory_after: family_memory at the end
+    :param slowlog: slowlog_since the start
+    :return: text
+    """
+    processed = last["processed"] - first["processed"]
+    attempts = last["attempts"] - first["attempts"]
+    per_message = max(processed, 1)
+    lines = [f"Processed {processed} messages ({attempts} lock attempts) in {last['time'] - first['time']:.1f} s",
+             f"{'family':<8} {'calls':>10} {'calls/msg':>10} {'usec':>12} {'usec/msg':>9} {'keys':>9} "
+             f"{'bytes':>12} {'bytes/msg':>10} {'slow':>5}"]
+    total_calls = total_usec = 0
+    for family in FAMILIES:
+        calls = last["commands"][family]["calls"] - first["commands"][family]["calls"]
+        usec = last["commands"][family]["usec"] - first["commands"][family]["usec"]
+        if family in TOTAL_FAMILIES:
+            total_calls += calls
+            total_usec += usec
+        after = memory_after.get(family, {"keys": 0, "bytes": 0})
+        grown = after["bytes"] - memory_before.get(family, {"bytes": 0})["bytes"]
+        memory = (f"{after['keys']:>9} {after['bytes']:>12} {grown / per_message:>10.1f}" if family in memory_after
+                  else f"{'':>9} {'':>12} {'':>10}")
+        lines.append(f"{family:<8} {calls:>10} {calls / per_message:>10.2f} {usec:>12} {usec / per_message:>9.2f} "
+                     f"{memory} {slowlog.get(family, {}).get('count', 0):>5}")
+    lines.append(f"{'total':<8} {total_calls:>10} {total_calls / per_message:>10.2f} {total_usec:>12} "
+                 f"{total_usec / per_message:>9.2f}")
+    lines.append(f"Redis CPU (sys + user): {(last['cpu_usec'] - first['cpu_usec']) / per_message:.1f} usec/msg, "
+                 f"commands take {total_usec / max(last['cpu_usec'] - first['cpu_usec'], 1):.0%} of it "
+                 f"(the rest is networking, Pub/Sub fan-out and background work)")
+    lines.append(f"used_memory: {last['used_memory'] - first['used_memory']:+} B "
+                 f"({(last['used_memory'] - first['used_memory']) / per_message:+.1f} B/msg)")
+    for family, slow in sorted(slowlog.items()):
+        lines.append(f"slowlog {family}: {slow['count']} entries, {slow['usec']} usec, "
+                     f"slowest {slow['slowest_usec']} usec: {slow['slowest']}")
+    return "\n".join(lines)
+
+
+def profile(duration: float, interval: float, sample: int) -> str:
+    """
+    Sample Redis during the run and report its cost
+
+    :param duration: seconds of the run
+    :param interval: seconds between samples
+    :param sample: keys of every pattern measured by MEMORY USAGE
+    :return: report
+    """
+    r = connect(redis_host, redis_port, **redis_transport)
+    own = OwnCalls(r)
+    families = key_families()
+    memory_before = family_memory(r, families, sample)
+    last_id = slowlog_last_id(r)
+    first = previous = snapshot(r, own)
+    itr = 0
+    while time.time() - first["time"] < duration:
+        time.sleep(min(interval, max(0.0, duration - (time.time() - first["time"]))))
+        itr += 1
+        current = snapshot(r, own)
+        logging.info(f"[{itr}] {interval_line(previous, current)}")
+        previous = current
+    report = cost_report(first, previous, memory_before, family_memory(r, families, sample),
+                         slowlog_since(r, last_id))
+    logging.info(f"Redis cost of the run:\n{report}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Redis server-side cost of the consumer workload")
+    parser.add_argument('--duration', type=float, default=60, help="Seconds of the run")
+    parser.add_argument('--interval', type=float, default=5, help="Seconds between samples")
+    parser.add_argument('--sample', type=int, default=100, help="Keys of every pattern measured by MEMORY USAGE")
+    args = parser.parse_args()
+    profile(args.duration, args.interval, args.sample)
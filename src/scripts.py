@@ -0,0 +1,63 @@
+"""
+    Server-side Lua scripts used by consumers.
+
+    Every script is registered once on startup (SCRIPT LOAD) and called by EVALSHA.
+    redis-py `Script` objects reload the source automatically on NOSCRIPT,
+    so restart of Redis or SCRIPT FLUSH is not a problem.
+"""
+
+# Dedup claim and XADD in one round-trip (stats are accumulated by consumer and flushed separately)
+#
+# KEYS[1] - dedup key (lock key or bucket hash, see dedup.py), KEYS[2] - stream,
+# KEYS[3] - bucket hash of message index (optional, see index.py)
+# ARGV[1] - consumer id, ARGV[2] - lock ttl (lock key) or unix time of bucket expiration,
+# ARGV[3] - field of bucket hash (message id) or empty string for lock key,
+# ARGV[4] - trim strategy of stream (MAXLEN, MINID or empty string), ARGV[5] - its threshold,
+# ARGV[6..] - stream entry as field/value pairs, or with index:
+# ARGV[6] - message id, ARGV[7] - unix time of index bucket expiration, ARGV[8..] - stream entry
+#
+# Returns ID of the stream entry or nil if message was claimed by somebody else
+PROCESS_MESSAGE = """
+if ARGV[3] == '' then
+    if not redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+        return false
+    end
+else
+    if redis.call('HSETNX', KEYS[1], ARGV[3], ARGV[1]) == 0 then
+        return false
+    end
+    redis.call('EXPIREAT', KEYS[1], ARGV[2])
+end
+local entry = KEYS[3] and 8 or 6
+local id
+if ARGV[4] == '' then
+    id = redis.call('XADD', KEYS[2], '*', unpack(ARGV, entry))
+else
+    id = redis.call('XADD', KEYS[2], ARGV[4], '~', ARGV[5], '*', unpack(ARGV, entry))
+end
+if KEYS[3] then
+    redis.call('HSET', KEYS[3], ARGV[6], id .. ' ' .. ARGV[1])
+    redis.call('EXPIREAT', KEYS[3], ARGV[7])
+end
+return id
+"""
+
+# XADD and its index entry in one round-trip (simple, batch and stream ingest modes with index)
+#
+# KEYS[1] - stream, KEYS[2] - bucket hash of message index
+# ARGV[1] - trim strategy of stream (MAXLEN, MINID or empty string), ARGV[2] - its threshold,
+# ARGV[3] - message id, ARGV[4] - consumer id, ARGV[5] - unix time of index bucket expiration,
+# ARGV[6..] - stream entry as field/value pairs
+#
+# Returns ID of the stream entry
+STREAM_AND_INDEX = """
+local id
+if ARGV[1] == '' then
+    id = redis.call('XADD', KEYS[1], '*', unpack(ARGV, 6))
+else
+    id = redis.call('XADD', KEYS[1], ARGV[1], '~', ARGV[2], '*', unpack(ARGV, 6))
+end
+redis.call('HSET', KEYS[2], ARGV[3], id .. ' ' .. ARGV[4])
+redis.call('EXPIREAT', KEYS[2], ARGV[5])
+return id
+"""
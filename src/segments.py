@@ -0,0 +1,148 @@
+"""
+    Segment files of captured traffic
+
+    Capture directory:
+        <arrival ns of the first record>.seg - segment, new one is started when the current one is full
+
+    Segment is MAGIC followed by records, every record is a fixed header and the payload as it came:
+
+        arrived   uint64   unix time of arrival, nanoseconds
+        length    uint32   payload length
+        payload   bytes
+
+    Segments are append-only, a torn record at the tail (crash of capture) is not read.
+    Reader memory-maps a segment and returns payloads as memoryview slices of the map - nothing is copied
+    or decoded, the page cache is the buffer. Segment can be read by byte ranges (record_offsets cuts it into
+    ranges at record boundaries), so replaying processes split the capture instead of reading all of it.
+"""
+
+import mmap
+import os
+import struct
+
+MAGIC = b"RCAPSEG1"
+HEADER = struct.Struct("<QI")
+SUFFIX = ".seg"
+
+
+class SegmentWriter:
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024) -> None:
+        """
+        :param directory: capture directory (created if it's not there)
+        :param segment_bytes: segment is closed when it's bigger
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.file = None
+        self.size = 0
+        self.records = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, arrived_ns: int, payload: bytes) -> None:
+        """
+        Append one record
+
+        :param arrived_ns: arrival time (time.time_ns())
+        :param payload: message as it came
+        """
+        if self.file is None or self.size >= self.segment_bytes:
+            self.roll(arrived_ns)
+        self.file.write(HEADER.pack(arrived_ns, len(payload)))
+        self.file.write(payload)
+        self.size += HEADER.size + len(payload)
+        self.records += 1
+
+    def roll(self, arrived_ns: int) -> None:
+        self.close()
+        self.file = open(os.path.join(self.directory, f"{arrived_ns:020d}{SUFFIX}"), "wb")
+        self.file.write(MAGIC)
+        self.size = len(MAGIC)
+
+    def flush(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def segment_paths(directory: str) -> list:
+    """
+    Segments of capture in time order
+
+    """
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(SUFFIX))
+
+
+def _map(path: str) -> memoryview:
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size <= len(MAGIC):
+            return None
+        # Map lives as long as any of its slices, the file itself is not needed after mmap()
+        data = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a segment of captured traffic")
+    return data
+
+
+def record_offsets(path: str, every: int) -> list:
+    """
+    Record boundaries of segment about every `every` bytes (only headers are read)
+
+    :param path: segment file
+    :param every: bytes between boundaries, at least
+    :return: offsets, the first record and the end of the last whole record included; ranges are pairs of neighbours
+    """
+    data = _map(path)
+    if data is None:
+        return []
+    offset, end = len(MAGIC), len(data)
+    offsets = [offset]
+    unpack = HEADER.unpack_from
+    while offset + HEADER.size <= end:
+        _, length = unpack(data, offset)
+        if offset + HEADER.size + length > end:
+            break
+        offset += HEADER.size + length
+        if offset - offsets[-1] >= every:
+            offsets.append(offset)
+    if offset != offsets[-1]:
+        offsets.append(offset)
+    return offsets
+
+
+def iter_segment(path: str, start: int = None, stop: int = None):
+    """
+    Records of one segment
+
+    :param path: segment file
+    :param start: offset of the first record (a boundary of record_offsets), None - from the first record
+    :param stop: offset where reading stops, None - the end of segment
+    :return: iterator of (arrived ns, memoryview of payload)
+    """
+    data = _map(path)
+    if data is None:
+        return
+    offset = len(MAGIC) if start is None else start
+    end = len(data) if stop is None else min(stop, len(data))
+    unpack = HEADER.unpack_from
+    while offset + HEADER.size <= end:
+        arrived, length = unpack(data, offset)
+        offset += HEADER.size
+        if offset + length > end:
+            # Torn tail
+            return
+        yield arrived, data[offset:offset + length]
+        offset += length
+
+
+def iter_records(paths: list):
+    """
+    Records of all segments in order
+
+    :return: iterator of (arrived ns, memoryview of payload)
+    """
+    for path in paths:
+        yield from iter_segment(path)
@@ -0,0 +1,176 @@
+"""
+    Sharded processed stream
+
+    With K shards processed messages go to K stream keys instead of one, every message to the shard
+    chosen by CRC32 of its message_id (stable in every process, unlike hash()):
+
+        K = 1: messages:processed            (the old single key)
+        K > 1: messages:processed:{0} ... messages:processed:{K-1}
+
+    Shard number is the hash tag of the key, so Redis Cluster hashes only `{i}` and shards are spread
+    over slots (and nodes) instead of one slot taking the whole write load. Dedup and index keys of a message
+    have the hash tag of its shard too (dedup.py, index.py), Lua scripts touch keys of one slot.
+
+    Readers get one stream back by K-way merge of shards by entry id (millisecond timestamp, sequence):
+    - iter_merged  - history, XRANGE of every shard page by page
+    - MergedReader - tail for downstream consumers, entries are returned in id order across shards and reads
+"""
+
+import heapq
+import zlib
+
+import redis
+
+
+def shard_names(stream: str, shards: int) -> list:
+    """
+    Keys of stream shards
+
+    :param stream: base name of stream
+    :param shards: count of shards
+    :return: list of keys
+    """
+    if shards <= 1:
+        return [stream]
+    return [f"{stream}:{{{shard}}}" for shard in range(shards)]
+
+
+def shard_of(message_id, shards: int) -> int:
+    """
+    Shard of message
+
+    :param message_id: str or bytes, None goes to shard 0
+    :return: shard number
+    """
+    if shards <= 1 or message_id is None:
+        return 0
+    if not isinstance(message_id, bytes):
+        message_id = str(message_id).encode()
+    return zlib.crc32(message_id) % shards
+
+
+def shard_for(names: list, message_id) -> str:
+    """
+    Key of the shard of message
+
+    :param names: result of shard_names
+    :return: key
+    """
+    return names[shard_of(message_id, len(names))]
+
+
+def entries_added(r, names: list, missing_ok: bool = True) -> int:
+    """
+    Count of entries ever added to stream shards
+
+    XLEN is not monotonic when stream is trimmed, so i take `entries-added` of XINFO STREAM (Redis 7+)
+
+    :param r: Redis connection
+    :param names: result of shard_names
+    :param missing_ok: shard which doesn't exist yet counts as 0, otherwise its error is raised
+    :return:
+    """
+    total = 0
+    for name in names:
+        try:
+            info = r.xinfo_stream(name)
+        except redis.ResponseError:
+            if not missing_ok:
+                raise
+            continue
+        total += info.get("entries-added", info["length"])
+    return total
+
+
+def entry_key(entry_id) -> tuple:
+    """
+    Sort key of stream entry id
+
+    :param entry_id: b"1700000000000-0" or str
+    :return: (milliseconds, sequence)
+    """
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+def _id_str(entry_id) -> str:
+    return entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+
+
+def _tagged(name, entries) -> list:
+    return [(entry_key(entry_id), name, entry_id, fields) for entry_id, fields in entries]
+
+
+def iter_merged(r, names: list, start: str = "-", end: str = "+", count: int = 1000):
+    """
+    Entries of all shards in id order (K-way merge)
+
+    :param r: Redis connection
+    :param names: shard keys
+    :param start: first id (inclusive)
+    :param end: last id (inclusive)
+    :param count: entries per XRANGE call
+    :return: iterator of (shard, entry_id, fields)
+    """
+    def shard_entries(name):
+        cursor = start
+        while True:
+            entries = r.xrange(name, min=cursor, max=end, count=count)
+            yield from _tagged(name, entries)
+            if len(entries) < count:
+                return
+            cursor = f"({_id_str(entries[-1][0])}"
+
+    for _, name, entry_id, fields in heapq.merge(*(shard_entries(name) for name in names), key=lambda e: e[0]):
+        yield name, entry_id, fields
+
+
+class MergedReader:
+    """
+    Tail of sharded stream in id order
+
+    Every read() fetches up to `count` new entries of every shard. A shard which returned a full page may
+    have more entries below the ids of other shards, so only entries up to the last one of the shortest
+    full page are returned, the rest waits for the next read().
+
+    Shards are read by one pipeline, not MULTI (shards are in different slots of Cluster), so an entry may be
+    added to a shard after it was read and before the next shard is. It gets the id of the time of XADD (Redis
+    clock), so i take TIME before the reads and return only entries older than that millisecond, newer ones wait
+    for the next read() too. Entries are in id order across reads, as long as clocks of Redis nodes agree
+    (on Cluster, TIME is of the node of the first shard).
+    """
+
+    def __init__(self, r, names: list, start: str = "0-0", count: int = 1000) -> None:
+        self.r = r
+        self.names = list(names)
+        self.count = count
+        # Last id fetched from every shard and entries fetched but not returned yet
+        self.cursors = {name: start for name in self.names}
+        self.buffers = {name: [] for name in self.names}
+
+    def read(self) -> list:
+        """
+        :return: list of (shard, entry_id, fields) in id order, may be empty
+        """
+        pipe = self.r.pipeline(transaction=False)
+        pipe.time()
+        for name in self.names:
+            pipe.xrange(name, min=f"({self.cursors[name]}", count=self.count)
+        (seconds, microseconds), *pages = pipe.execute()
+        # Entries of this millisecond or later may still come to shards which were read already
+        watermark = (seconds * 1000 + microseconds // 1000, -1)
+        for name, entries in zip(self.names, pages):
+            if entries:
+                self.cursors[name] = _id_str(entries[-1][0])
+                self.buffers[name].extend(_tagged(name, entries))
+            if len(entries) == self.count:
+                watermark = min(watermark, entry_key(self.cursors[name]))
+
+        ready = []
+        for name, buffer in self.buffers.items():
+            split = next((i for i, entry in enumerate(buffer) if entry[0] > watermark), len(buffer))
+            ready.append(buffer[:split])
+            self.buffers[name] = buffer[split:]
+        return [(name, entry_id, fields) for _, name, entry_id, fields in heapq.merge(*ready, key=lambda e: e[0])]
@@ -0,0 +1,122 @@
+"""
+    Start of consumer group
+
+    Consumers report their startup events to main.py by a queue of multiprocessing:
+    - subscribed    - SUBSCRIBE is confirmed by Redis (joined input group for stream backend),
+                      messages published since then are not missed by the consumer
+    - first_message - the first message came to the consumer
+
+    GroupStartup collects them - the group is ready when all its consumers are subscribed (readiness barrier),
+    it logs time-to-full-group and time-to-first-message (since the start of the group).
+
+    Connect ramp-up: consumer waits `stagger(index, rate)` seconds before it connects, so Redis gets at most
+    `rate` new consumers (connections, registrations, SUBSCRIBE) per second instead of all of them at once.
+"""
+
+import logging
+import queue
+import time
+
+
+def stagger(index: int, rate: float) -> float:
+    """
+    Delay of consumer before it connects
+
+    :param index: number of consumer in the group
+    :param rate: consumers per second, 0 - all at once
+    :return: seconds
+    """
+    return index / rate if rate > 0 else 0.0
+
+
+class StartupReporter:
+    """
+    Consumer side: every event is reported only once
+
+    """
+
+    def __init__(self, events, consumer_ids: list) -> None:
+        """
+        :param events: queue of main process
+        :param consumer_ids: consumers of the process (one for ConsumerEngine)
+        """
+        self.events = events
+        self.consumer_ids = list(consumer_ids)
+        self.reported = set()
+
+    def report(self, event: str) -> None:
+        if event not in self.reported:
+            self.reported.add(event)
+            self.events.put((event, self.consumer_ids, time.time()))
+
+
+class GroupStartup:
+    """
+    Main side: readiness barrier of consumer group
+
+    """
+
+    def __init__(self, events, expected: int, started_at: float = None) -> None:
+        """
+        :param events: queue consumers report to
+        :param expected: count of consumers in the group
+        :param started_at: start of the group (unix time)
+        """
+        self.events = events
+        self.expected = expected
+        self.started_at = time.time() if started_at is None else started_at
+        # Seconds since the start of the group: {consumer id: seconds}
+        self.subscribed = {}
+        self.first_message = {}
+
+    def collect(self, timeout: float) -> bool:
+        """
+        Take events until the next one is not there for `timeout` seconds
+
+        :return: True if something was taken
+        """
+        try:
+            event, consumer_ids, at = self.events.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        seen = self.subscribed if event == "subscribed" else self.first_message
+        first = not seen
+        for consumer_id in consumer_ids:
+            seen.setdefault(consumer_id, at - self.started_at)
+        if event == "subscribed" and len(self.subscribed) == self.expected:
+            logging.info(f"Consumer group is ready: {self.summary(self.subscribed)}")
+        elif event == "first_message" and first:
+            logging.info(f"First message came {min(self.first_message.values()):.3f} s after the start of the group")
+        return True
+
+    def summary(self, seen: dict) -> str:
+        times = sorted(seen.values())
+        return (f"{len(times)}/{self.expected} consumers in {times[-1]:.3f} s "
+                f"(first {times[0]:.3f} s, p50 {times[len(times) // 2]:.3f} s)") if times else "nobody"
+
+    def wait_ready(self, timeout: float) -> bool:
+        """
+        Readiness barrier: wait until all consumers are subscribed
+
+        :param timeout: seconds since the start of the group
+        :return: True if the whole group is subscribed
+        """
+        deadline = self.started_at + timeout
+        while len(self.subscribed) < self.expected:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logging.warning(f"Consumer group is not ready in {timeout} s: {self.summary(self.subscribed)}")
+                return False
+            self.collect(remaining)
+        return True
+
+    def watch(self, timeout: float) -> None:
+        """
+        Wait for readiness, then for the first message of every consumer (the rest of startup events)
+
+        :param timeout: readiness timeout (seconds)
+        """
+        self.wait_ready(timeout)
+        while len(self.first_message) < self.expected:
+            self.collect(1.0)
+        logging.info(f"All consumers got messages: {self.summary(self.first_message)}")
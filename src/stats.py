@@ -0,0 +1,121 @@
+"""
+    Consumer statistics
+
+    Counters are accumulated in process and flushed by one pipeline into a single hash per consumer
+    and into the group hash `consumer:stats:group`, which all consumers add to:
+
+        consumer:stats:<consumer_id>
+            processed_messages  - messages processed (streamed) by the consumer
+            lock_misses         - messages taken by other consumers
+            decode_errors       - payloads which can't be decoded
+            bytes_processed     - payload bytes of processed messages
+            latency:*           - latency histograms of processed messages (see histogram.py)
+            stage:<stage>:*     - stage counters of pipeline mode: in, out, dropped, errors, busy_us (see pipeline.py)
+            lane:<lane>:*       - processed_messages and lock_misses of priority lane (see lanes.py), its end to end
+                                  latency is the histogram latency:end_to_end@<lane>:*
+
+    Liveness is not here, heartbeats are scores of `consumer:heartbeats` sorted set.
+    Hash of a consumer goes away with the consumer (it expires after STATS_RETENTION), so its sum goes down when
+    consumers leave; the group hash only grows, so its counters and latency buckets are safe for Prometheus.
+"""
+
+import threading
+import time
+from collections import Counter, defaultdict
+
+from src.histogram import bucket_index, bucket_field
+
+COUNTERS = ("processed_messages", "lock_misses", "decode_errors", "bytes_processed")
+GROUP = "group"
+
+
+def stats_key(stats_name: str, consumer_id: str) -> str:
+    """
+    Key of consumer's stats hash
+
+    :param stats_name: prefix of stats keys
+    :param consumer_id:
+    :return:
+    """
+    return f"{stats_name}:{consumer_id}"
+
+
+def group_stats_key(stats_name: str) -> str:
+    """
+    Key of the group stats hash (sum of all consumers ever)
+
+    :param stats_name: prefix of stats keys
+    """
+    return stats_key(stats_name, GROUP)
+
+
+class StatsAccumulator:
+    """
+    Accumulate counters of one consumer, flush is thread safe (heartbeat thread flushes too)
+    """
+
+    def __init__(self, key: str, flush_interval: float, flush_count: int, group_key: str = None) -> None:
+        """
+        :param key: stats hash of the consumer
+        :param group_key: group stats hash, the same counters are added to it
+        """
+        self.key = key
+        self.keys = [key] if group_key is None else [key, group_key]
+        self.flush_interval = flush_interval
+        self.flush_count = flush_count
+        self.counters = Counter()
+        # Latency histograms: {stage: Counter({bucket index: count})} and {stage: sum of seconds}
+        self.latencies = defaultdict(Counter)
+        self.latency_sums = Counter()
+        # Count of events since the last flush
+        self.pending = 0
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, **counters) -> None:
+        """
+        Add to counters, e.g. add(processed_messages=1, bytes_processed=42)
+
+        """
+        with self.lock:
+            self.counters.update(counters)
+            self.pending += 1
+
+    def observe(self, **stages) -> None:
+        """
+        Record latencies of one message, e.g. observe(end_to_end=0.012)
+
+        Negative latencies (clocks of publisher and consumer are not in sync) are taken as zero
+        """
+        with self.lock:
+            for stage, seconds in stages.items():
+                seconds = max(0.0, seconds)
+                self.latencies[stage][bucket_index(seconds)] += 1
+                self.latency_sums[stage] += seconds
+
+    def due(self) -> bool:
+        """
+        Is it time to flush: enough events or flush_interval passed since the last flush
+        """
+        return self.pending > 0 and (self.pending >= self.flush_count
+                                     or time.monotonic() - self.last_flush >= self.flush_interval)
+
+    def flush(self, pipe) -> None:
+        """
+        Queue HINCRBY of accumulated counters and latency buckets into pipeline
+
+        :param pipe: Redis pipeline, it's executed by the caller
+        """
+        with self.lock:
+            counters, self.counters, self.pending = self.counters, Counter(), 0
+            latencies, self.latencies = self.latencies, defaultdict(Counter)
+            latency_sums, self.latency_sums = self.latency_sums, Counter()
+            self.last_flush = time.monotonic()
+        for key in self.keys:
+            for name, value in counters.items():
+                if value:
+                    pipe.hincrby(key, name, value)
+            for stage, buckets in latencies.items():
+                for index, count in buckets.items():
+                    pipe.hincrby(key, bucket_field(stage, index), count)
+                pipe.hincrbyfloat(key, bucket_field(stage, "sum"), latency_sums[stage])
@@ -0,0 +1,179 @@
+"""
+    Consumer Group Supervisor
+
+    I keep the consumer group between min and max size:
+    - measure backlog and throughput of the group in Redis
+    - grow the group when backlog is high, shrink it when it's calm for a while (hysteresis + cooldown)
+    - respawn crashed workers
+    - retire workers gracefully: SIGUSR2 (drain), SIGTERM after drain_timeout
+
+    Worker is one consumer process (with one or many logical consumers inside)
+"""
+
+import logging
+import os
+import signal
+import time
+from typing import Callable
+
+import redis
+
+from src.config import stream_name, input_stream, input_group, ingest_backend, autoscale_min, autoscale_max, \
+    autoscale_step, autoscale_interval, autoscale_cooldown, autoscale_up_backlog, autoscale_down_backlog, \
+    autoscale_down_checks, drain_timeout, redis_transport, processed_stream_shards
+from src.transport import connect
+from src.shards import shard_names, entries_added
+
+
+class ScalingPolicy:
+    """
+    Decide the size of the group by backlog
+
+    Grow by `step` when backlog is above `up_backlog`, shrink by `step` after `down_checks`
+    checks in a row with backlog below `down_backlog`. No changes during `cooldown` after the last one.
+    """
+
+    def __init__(self, min_size: int = autoscale_min, max_size: int = autoscale_max, step: int = autoscale_step,
+                 up_backlog: int = autoscale_up_backlog, down_backlog: int = autoscale_down_backlog,
+                 down_checks: int = autoscale_down_checks, cooldown: float = autoscale_cooldown) -> None:
+        self.min_size = min_size
+        self.max_size = max_size
+        self.step = step
+        self.up_backlog = up_backlog
+        self.down_backlog = down_backlog
+        self.down_checks = down_checks
+        self.cooldown = cooldown
+        self.calm_checks = 0
+        self.last_change = float("-inf")
+
+    def decide(self, size: int, backlog: int, now: float) -> int:
+        """
+        :param size: current size of the group
+        :param backlog: current backlog
+        :param now: current time
+        :return: wanted size of the group
+        """
+        self.calm_checks = self.calm_checks + 1 if backlog <= self.down_backlog else 0
+
+        target = size
+        if backlog > self.up_backlog:
+            target = size + self.step
+        elif self.calm_checks >= self.down_checks:
+            target = size - self.step
+        target = max(self.min_size, min(self.max_size, target))
+
+        # Out of bounds is fixed at once, everything else waits for cooldown
+        in_bounds = self.min_size <= size <= self.max_size
+        if target == size or (in_bounds and now - self.last_change < self.cooldown):
+            return size
+        self.last_change = now
+        self.calm_checks = 0
+        return target
+
+
+class ConsumerSupervisor:
+    def __init__(self, redis_host: str, redis_port: str, spawn: Callable, policy: ScalingPolicy = None,
+                 interval: float = autoscale_interval) -> None:
+        self.r = connect(redis_host, redis_port, **redis_transport)
+        # spawn() starts one worker process and returns it
+        self.spawn = spawn
+        self.policy = policy or ScalingPolicy()
+        self.interval = interval
+        self.workers = []
+        # retired worker -> deadline of its draining
+        self.retiring = {}
+        self.last_time = None
+        self.last_processed = None
+        self.running = False
+
+    def measure(self) -> dict:
+        """
+        Measure backlog and throughput of the group
+
+        :return: {"backlog": int, "rate": msg/sec of processed stream growth}
+        """
+        now = time.time()
+        # Processed stream is trimmed, so its growth is counted by entries-added, not XLEN
+        processed = entries_added(self.r, shard_names(stream_name, processed_stream_shards))
+        rate = 0.0
+        if self.last_time is not None:
+            rate = (processed - self.last_processed) / (now - self.last_time)
+        self.last_time, self.last_processed = now, processed
+
+        if ingest_backend == "stream":
+            groups = [group for group in self.r.xinfo_groups(input_stream) if group["name"].decode() == input_group]
+            backlog = sum((group.get("lag") or 0) + group["pending"] for group in groups)
+        else:
+            # Messages which subscribers did not read yet are waiting in their output buffers
+            backlog = max((int(client["omem"]) for client in self.r.client_list(_type="pubsub")), default=0)
+        return {"backlog": backlog, "rate": rate}
+
+    def reap(self) -> None:
+        """
+        Respawn crashed workers and forget (or kill) retired ones
+
+        """
+        for index, worker in enumerate(self.workers):
+            if not worker.is_alive():
+                logging.warning(f"Worker {worker.pid} died with code {worker.exitcode}, respawning ...")
+                self.workers[index] = self.spawn()
+
+        now = time.time()
+        for worker, deadline in list(self.retiring.items()):
+            if not worker.is_alive():
+                del self.retiring[worker]
+            elif now > deadline:
+                logging.warning(f"Worker {worker.pid} did not drain in time, terminating ...")
+                worker.terminate()
+                del self.retiring[worker]
+
+    def scale_to(self, size: int) -> None:
+        """
+        Grow or shrink the group
+
+        :param size: wanted count of workers
+        """
+        while len(self.workers) < size:
+            self.workers.append(self.spawn())
+        while len(self.workers) > size:
+            worker = self.workers.pop()
+            # The youngest worker goes first. It will stop taking messages and finish taken ones
+            os.kill(worker.pid, signal.SIGUSR2)
+            self.retiring[worker] = time.time() + drain_timeout
+
+    def step(self) -> None:
+        """
+        One check of the group
+
+        """
+        self.reap()
+        try:
+            metrics = self.measure()
+        except redis.RedisError as e:
+            logging.warning(f"Can't measure the group: {e}")
+            return
+        size = len(self.workers)
+        target = self.policy.decide(size, metrics["backlog"], time.time())
+        logging.info(f"Workers: {size}, retiring: {len(self.retiring)}, backlog: {metrics['backlog']}, "
+                     f"speed: {metrics['rate']:.2f} msg/sec" + (f", scaling to {target}" if target != size else ""))
+        self.scale_to(target)
+
+    def run(self) -> None:
+        """
+        Supervise the group until stop()
+
+        """
+        self.running = True
+        self.scale_to(self.policy.min_size)
+        while self.running:
+            time.sleep(self.interval)
+            self.step()
+
+    def stop(self) -> None:
+        """
+        Stop supervising and terminate all workers
+
+        """
+        self.running = False
+        for worker in self.workers + list(self.retiring):
+            worker.terminate()
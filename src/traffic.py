@@ -0,0 +1,251 @@
+"""
+    Capture and replay of real traffic
+
+    capture - subscribe Pub/Sub channel (all its partitions and lanes) and record messages with their arrival time
+              into segment files (see segments.py), messages of priority lane <name> go to subdirectory lane-<name>
+    replay  - memory-map the segments and publish them again by big pipelines: at 1x (arrival pattern of
+              the capture, bursts included), at N x or at max speed (--speed 0), striped over processes
+
+        python src/traffic.py capture --duration 60
+        python src/traffic.py replay --speed 10 --processes 4 --restamp
+
+    Capture is split before the processes start: segments are cut into chunks of CHUNK_BYTES at record boundaries
+    (only record headers are read) and the chunks are dealt to processes in turn, so every process reads its share
+    only and a burst is spread over all of them.
+    Payloads go to Redis as they were captured (memoryview of the map, nothing is decoded but message_id with
+    partitioned Pub/Sub). With --restamp every message gets `published_at` of its replay (decoded and encoded again
+    by MESSAGE_CODEC), otherwise consumers count the time since the capture as its end to end latency.
+    Lanes are replayed to their channels, in arrival order with the rest of the capture.
+"""
+
+import argparse
+import heapq
+import logging
+import os
+import time
+from multiprocessing import Pool
+
+from config import redis_host, redis_port, redis_transport, pubsub_channel, pubsub_partitions, ingest_backend, \
+    message_codec, capture_dir, capture_segment_bytes, priority_lanes
+from codec import get_codec, DecodeError
+from publisher import publish
+from segments import SegmentWriter, segment_paths, iter_segment, record_offsets
+from shards import shard_names
+from lanes import parse_lanes, lane_channel
+from transport import connect
+
+logging.basicConfig(level=logging.DEBUG)
+
+LANE_DIR = "lane-"
+# Capture is dealt to replaying processes by chunks of segments of about so many bytes
+CHUNK_BYTES = 1024 * 1024
+
+
+def _str(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def capture(directory: str, duration: float, segment_bytes: int = capture_segment_bytes) -> int:
+    """
+    Record Pub/Sub traffic
+
+    :param directory: capture directory
+    :param duration: seconds, 0 - until Ctrl+C
+    :param segment_bytes: size of segment
+    :return: count of recorded messages
+    """
+    r = connect(redis_host, redis_port, **redis_transport)
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    channels = [pubsub_channel] + (shard_names(pubsub_channel, pubsub_partitions) if pubsub_partitions > 1 else [])
+    lanes = {lane_channel(pubsub_channel, name): name for name, _ in parse_lanes(priority_lanes)} \
+        if priority_lanes else {}
+    pubsub.subscribe(*channels, *lanes)
+    logging.info(f"Capturing {', '.join(channels + list(lanes))} to {directory}")
+    writers = {None: SegmentWriter(directory, segment_bytes)}
+    for name in lanes.values():
+        writers[name] = SegmentWriter(os.path.join(directory, LANE_DIR + name), segment_bytes)
+    started = last_flush = time.monotonic()
+    try:
+        while not duration or time.monotonic() - started < duration:
+            message = pubsub.get_message(timeout=0.1)
+            if message is not None and message['type'] == 'message':
+                writers[lanes.get(_str(message['channel']))].write(time.time_ns(), message['data'])
+            if time.monotonic() - last_flush >= 1:
+                for writer in writers.values():
+                    writer.flush()
+                last_flush = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for writer in writers.values():
+            writer.close()
+        pubsub.close()
+        r.close()
+    records = sum(writer.records for writer in writers.values())
+    logging.info(f"Captured {records} messages in {time.monotonic() - started:.1f} s")
+    return records
+
+
+def capture_sources(directory: str) -> list:
+    """
+    Segments of capture by lane
+
+    :param directory: capture directory
+    :return: [(lane or None, segments)]
+    """
+    sources = [(None, segment_paths(directory))]
+    for name in sorted(os.listdir(directory)):
+        if name.startswith(LANE_DIR) and os.path.isdir(os.path.join(directory, name)):
+            sources.append((name[len(LANE_DIR):], segment_paths(os.path.join(directory, name))))
+    return sources
+
+
+def split_capture(sources: list, workers: int, chunk_bytes: int = CHUNK_BYTES) -> list:
+    """
+    Deal chunks of segments to workers in turn (all lanes together), one worker gets whole segments
+
+    :param sources: result of capture_sources
+    :param workers: count of workers
+    :param chunk_bytes: size of chunk
+    :return: for every worker [(lane or None, [(segment, start, stop)])], None - the whole segment
+    """
+    if workers == 1:
+        return [[(lane, [(path, None, None) for path in paths]) for lane, paths in sources]]
+    shares = [[(lane, []) for lane, _ in sources] for _ in range(workers)]
+    dealt = 0
+    for index, (_, paths) in enumerate(sources):
+        for path in paths:
+            offsets = record_offsets(path, chunk_bytes)
+            for start, stop in zip(offsets, offsets[1:]):
+                shares[dealt % workers][index][1].append((path, start, stop))
+                dealt += 1
+    return shares
+
+
+def iter_capture(share: list):
+    """
+    Records of all lanes merged by arrival time
+
+    :param share: one item of split_capture
+    :return: iterator of (arrived ns, lane or None, memoryview of payload)
+    """
+    def lane_records(lane, ranges):
+        for path, start, stop in ranges:
+            for arrived, payload in iter_segment(path, start, stop):
+                yield arrived, lane, payload
+
+    return heapq.merge(*(lane_records(lane, ranges) for lane, ranges in share), key=lambda record: record[0])
+
+
+def capture_start(share: list) -> int:
+    """
+    Arrival of the first record (the schedule of replay starts from it)
+
+    :param share: one item of split_capture
+    :return: nanoseconds, 0 if it's empty
+    """
+    return next(iter_capture(share), (0,))[0]
+
+
+def replay_worker(share: list, speed: float, first: int = None, max_batch: int = 1000, restamp: bool = False) -> dict:
+    """
+    Publish share of capture
+
+    :param share: chunks of segments by lane (item of split_capture)
+    :param speed: 1 - as captured, N - N times faster, 0 - as fast as possible
+    :param first: arrival of the first record of the whole capture, schedule starts from it (None - of the share)
+    :param max_batch: most messages per pipeline
+    :param restamp: set `published_at` to the time of replay, False - send payloads as captured
+    :return: {"sent": n, "elapsed": seconds, "max_lag": seconds behind the schedule}
+    """
+    connection = connect(redis_host, redis_port, **redis_transport)
+    partitioned = ingest_backend == "pubsub" and pubsub_partitions > 1
+    codec = get_codec(message_codec) if restamp or partitioned else None
+    if first is None:
+        first = capture_start(share)
+    pipe = connection.pipeline(transaction=False)
+    pending = sent = 0
+    max_lag = 0.0
+    start = time.monotonic()
+    for arrived, lane, payload in iter_capture(share):
+        if speed:
+            due = (arrived - first) / 1e9 / speed
+            now = time.monotonic() - start
+            if due > now:
+                # Everything which is due is sent, i wait for the next one
+                if pending:
+                    pipe.execute()
+                    sent, pending = sent + pending, 0
+                    now = time.monotonic() - start
+                if due > now:
+                    time.sleep(due - now)
+            max_lag = max(max_lag, now - due)
+        message_id = None
+        if codec is not None:
+            try:
+                message = codec.loads(bytes(payload))
+                message_id = message.get("message_id")
+                if restamp:
+                    message["published_at"] = time.time()
+                    payload = codec.dumps(message)
+            except (DecodeError, AttributeError, TypeError):
+                # Not a message of the publisher, it goes as it was
+                pass
+        publish(pipe, payload, message_id, lane)
+        pending += 1
+        if pending >= max_batch:
+            pipe.execute()
+            sent, pending = sent + pending, 0
+    if pending:
+        pipe.execute()
+        sent += pending
+    connection.close()
+    return {"sent": sent, "elapsed": time.monotonic() - start, "max_lag": max_lag}
+
+
+def _replay_worker(kwargs: dict) -> dict:
+    return replay_worker(**kwargs)
+
+
+def replay(directory: str, speed: float = 1.0, processes: int = 1, max_batch: int = 1000,
+           restamp: bool = False) -> dict:
+    """
+    Replay capture by `processes` workers, chunks of capture are dealt to them, so bursts stay bursts
+
+    :return: merged results of workers
+    """
+    sources = capture_sources(directory)
+    first = capture_start(split_capture(sources, 1)[0])
+    workers = [dict(share=share, speed=speed, first=first, max_batch=max_batch, restamp=restamp)
+               for share in split_capture(sources, processes)]
+    if processes == 1:
+        results = [replay_worker(**workers[0])]
+    else:
+        with Pool(processes) as pool:
+            results = pool.map(_replay_worker, workers)
+    merged = {"sent": sum(result["sent"] for result in results),
+              "elapsed": max(result["elapsed"] for result in results),
+              "max_lag": max(result["max_lag"] for result in results)}
+    logging.info(f"Replayed {merged['sent']} messages of {sum(len(paths) for _, paths in sources)} segments in {merged['elapsed']:.2f} s "
+                 f"({merged['sent'] / max(merged['elapsed'], 1e-9):.0f} msgs/sec, speed "
+                 f"{'max' if not speed else f'{speed}x'}, max lag {merged['max_lag'] * 1000:.1f} ms)")
+    return merged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Capture and replay of Pub/Sub traffic")
+    parser.add_argument('command', choices=["capture", "replay"])
+    parser.add_argument('--dir', default=capture_dir, help="Capture directory")
+    parser.add_argument('--duration', type=float, default=60, help="Seconds of capture, 0 - until Ctrl+C")
+    parser.add_argument('--speed', type=float, default=1, help="Replay speed: 1 - as captured, N - N x, 0 - max")
+    parser.add_argument('--processes', type=int, default=1, help="Replaying processes")
+    parser.add_argument('--max_batch', type=int, default=1000, help="Most messages per pipeline")
+    parser.add_argument('--restamp', action='store_true',
+                        help="Set published_at to the time of replay (decode and encode every message), "
+                             "otherwise latencies are counted from the capture")
+    args = parser.parse_args()
+
+    if args.command == "capture":
+        capture(args.dir, args.duration)
+    else:
+        replay(args.dir, args.speed, args.processes, args.max_batch, args.restamp)
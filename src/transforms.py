@@ -0,0 +1,29 @@
+"""
+    Example stages of pipeline mode (PIPELINE_FILTER / PIPELINE_TRANSFORM = "src.transforms:<function>")
+
+    Functions take a decoded message; transforms return the new message (they may run in process pool,
+    so they live on module level), filters return True to keep it.
+"""
+
+import hashlib
+import json
+
+
+def has_published_at(message: dict) -> bool:
+    """
+    Filter: only messages stamped by the publisher
+
+    """
+    return isinstance(message.get("published_at"), (int, float))
+
+
+def checksum(message: dict, rounds: int = 1000) -> dict:
+    """
+    CPU bound transform: add key-stretched SHA-256 of the message
+
+    :param rounds: hashing rounds (cost)
+    """
+    digest = json.dumps(message, sort_keys=True).encode()
+    for _ in range(rounds):
+        digest = hashlib.sha256(digest).digest()
+    return {**message, "checksum": digest.hex()}
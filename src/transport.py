@@ -0,0 +1,120 @@
+"""
+    Transport: how services connect to Redis
+
+    Every service builds its client by connect() instead of a bare `redis.Redis(host, port)`:
+    - explicitly sized blocking connection pool - when all connections are busy, a command waits
+      for a free one (up to `pool_timeout` seconds) instead of opening yet another connection
+    - unix domain socket instead of TCP when Redis is co-located (`socket_path`)
+    - RESP parser: hiredis (C) if it's installed, otherwise pure python; it can be forced for comparison
+      (parser classes are private names of redis-py, when they are not where i look for them, redis-py
+      chooses the parser itself and only "auto" is accepted)
+    - TCP keepalive and health checks (PING of a connection idle for `health_check_interval` seconds),
+      so a dead connection is found before a command is lost on it
+    - connect and command timeouts
+
+    Command timeout (`socket_timeout`) is off by default: Pub/Sub `listen()` and XREADGROUP BLOCK wait for
+    traffic longer than any sane command timeout, keepalive and health checks take care of dead peers.
+    If it's set, it must be longer than STREAM_BLOCK_MS.
+
+    Client is thread safe, threads of one process share its pool (every command takes a connection
+    and puts it back), Pub/Sub holds its own connection of the pool while subscribed.
+"""
+
+import socket
+
+import redis
+import redis.asyncio
+from redis.utils import HIREDIS_AVAILABLE
+
+try:
+    from redis._parsers import _AsyncHiredisParser, _AsyncRESP2Parser, _HiredisParser, _RESP2Parser
+    PARSERS = {"hiredis": (_HiredisParser, _AsyncHiredisParser), "python": (_RESP2Parser, _AsyncRESP2Parser)}
+except ImportError:
+    PARSERS = {}
+
+
+def parser_name(parser: str = "auto") -> str:
+    """
+    Resolve parser setting
+
+    :param parser: auto (hiredis if it's installed), hiredis or python
+    :return: hiredis or python, None - default parser of redis-py
+    """
+    if parser == "auto":
+        if not PARSERS:
+            return None
+        return "hiredis" if HIREDIS_AVAILABLE else "python"
+    if parser not in ("hiredis", "python"):
+        raise ValueError(f"Unknown Redis parser {parser}, use auto, hiredis or python")
+    if not PARSERS:
+        raise ValueError(f"Parser can't be chosen with redis-py {redis.__version__}, use auto")
+    if parser == "hiredis" and not HIREDIS_AVAILABLE:
+        raise ValueError("hiredis parser is not available, install hiredis")
+    return parser
+
+
+def keepalive_options() -> dict:
+    """
+    TCP keepalive probing: the first probe after 30 seconds of silence, dead after 3 unanswered ones
+    (options which the platform doesn't have are skipped)
+
+    """
+    options = {}
+    for name, value in (("TCP_KEEPIDLE", 30), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 3)):
+        if hasattr(socket, name):
+            options[getattr(socket, name)] = value
+    return options
+
+
+def connection_kwargs(host: str, port, socket_path: str = None, parser: str = "auto", socket_timeout: float = None,
+                      connect_timeout: float = 5, health_check_interval: int = 30, asyncio: bool = False) -> dict:
+    """
+    Arguments of connection pool
+
+    :param socket_path: unix domain socket of Redis, host and port are ignored if it's set
+    :param asyncio: for redis.asyncio pool
+    :return: kwargs of ConnectionPool (connection_class included)
+    """
+    module = redis.asyncio.connection if asyncio else redis.connection
+    kwargs = {
+        "socket_timeout": socket_timeout,
+        "socket_connect_timeout": connect_timeout,
+        "health_check_interval": health_check_interval,
+    }
+    name = parser_name(parser)
+    if name is not None:
+        kwargs["parser_class"] = PARSERS[name][1 if asyncio else 0]
+    if socket_path:
+        kwargs.update(connection_class=module.UnixDomainSocketConnection, path=socket_path)
+    else:
+        kwargs.update(connection_class=module.Connection, host=host, port=int(port), socket_keepalive=True,
+                      socket_keepalive_options=keepalive_options())
+    return kwargs
+
+
+def make_pool(host: str, port, max_connections: int = 16, pool_timeout: float = 20, asyncio: bool = False,
+              **settings):
+    """
+    Blocking connection pool of `max_connections`
+
+    :param pool_timeout: seconds to wait for a free connection, then ConnectionError
+    :param settings: see connection_kwargs
+    :return: BlockingConnectionPool (sync or asyncio)
+    """
+    module = redis.asyncio if asyncio else redis
+    return module.BlockingConnectionPool(max_connections=max_connections, timeout=pool_timeout,
+                                         **connection_kwargs(host, port, asyncio=asyncio, **settings))
+
+
+def connect(host: str, port, asyncio: bool = False, **settings):
+    """
+    Redis client on its own blocking pool
+
+    :param settings: see make_pool and connection_kwargs
+    :return: redis.Redis or redis.asyncio.Redis
+    """
+    pool = make_pool(host, port, asyncio=asyncio, **settings)
+    client = redis.asyncio.Redis(connection_pool=pool) if asyncio else redis.Redis(connection_pool=pool)
+    # The pool is only mine, so close() (aclose()) of the client disconnects it as well
+    client.auto_close_connection_pool = True
+    return client
@@ -0,0 +1,285 @@
+"""
+    Write-behind of processed messages
+
+    Listening loop only puts messages (their stream entries) to my queue and goes on, my thread claims and writes
+    them to Redis by pipelined batches, so neither the lock (claim) nor XADD is in the loop. When Redis stalls
+    (BGSAVE fork, slow commands, failover) or fails, the loop keeps taking messages and nothing of it waits:
+
+        put() -> memory queue -> writer thread -> write(batch) -> Redis
+                      | queue is full
+                      v
+                 spill segments (<directory>/<consumer_id>/*.seg, see segments.py) -> replayed when writes succeed
+
+    Once something is spilled, new entries go to the spill too until it's replayed, so entries stay in order
+    (only what is left in memory on close is spilled after them).
+    Failed batch is retried with backoff (up to `retry_max` seconds) until it's written.
+    Write function may note what it did in the `meta` of entry (the consumer notes the result of the claim there),
+    the note is kept for retries of the batch and spilled with the entry, so a retried batch is not claimed again.
+    Delivery is at-least-once: a batch can be written twice if Redis applied it, but the answer was lost,
+    and a segment which was replayed partly before a crash is replayed again from the start.
+    Every spilled entry is flushed to the kernel at once, so it survives kill -9 or OOM kill of the process;
+    entries in the memory queue don't.
+
+    Spill of a dead process is not lost: spill directory of every consumer is locked by flock, a consumer on
+    the same host adopts directories which are not locked (their owners are gone) and replays them.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from collections import deque
+
+from src.segments import SegmentWriter, segment_paths, iter_segment
+
+PART = struct.Struct("<I")
+LOCK_FILE = ".lock"
+
+
+def pack_entry(message_id, fields: dict, meta: dict = None) -> bytes:
+    """
+    Spill record of stream entry: parts (message_id, meta as JSON, field, value, ...) prefixed by their lengths
+
+    Values are stored as redis-py sends them (str - UTF-8, numbers - str()), so replayed entry is the same
+    """
+    parts = [b"" if message_id is None else str(message_id).encode(), json.dumps(meta or {}).encode()]
+    for field, value in fields.items():
+        parts.append(field if isinstance(field, bytes) else str(field).encode())
+        parts.append(value if isinstance(value, bytes) else str(value).encode())
+    return b"".join(PART.pack(len(part)) + part for part in parts)
+
+
+def unpack_entry(record) -> tuple:
+    """
+    :param record: result of pack_entry (bytes or memoryview)
+    :return: (message_id or None, fields with bytes names and values, meta)
+    """
+    parts = []
+    offset = 0
+    while offset < len(record):
+        (length,) = PART.unpack_from(record, offset)
+        offset += PART.size
+        parts.append(bytes(record[offset:offset + length]))
+        offset += length
+    message_id = parts[0].decode() or None
+    return message_id, dict(zip(parts[2::2], parts[3::2])), json.loads(parts[1])
+
+
+class WriteBehind:
+    def __init__(self, write, directory: str, name: str, max_queue: int = 10000, batch: int = 500,
+                 retry_max: float = 5.0, segment_bytes: int = 16 * 1024 * 1024) -> None:
+        """
+        :param write: function of list of (message_id, fields, meta), it writes them to Redis or raises,
+                      returns count of entries written to the stream (None - all of them)
+        :param directory: root of spill directories
+        :param name: my spill directory in the root (consumer id)
+        :param max_queue: entries in memory, the next ones are spilled
+        :param batch: most entries per write
+        :param retry_max: most seconds between retries of failed write
+        :param segment_bytes: size of spill segment
+        """
+        self.write = write
+        self.root = directory
+        self.directory = os.path.join(directory, name)
+        self.max_queue = max_queue
+        self.batch = batch
+        self.retry_max = retry_max
+        self.queue = deque()
+        # Signal handler (main thread) may close me while the same thread is in put()
+        self.lock = threading.RLock()
+        self.ready = threading.Condition(self.lock)
+        self.spill = SegmentWriter(self.directory, segment_bytes)
+        self.spilling = False
+        self.closing = False
+        self.deadline = 0.0
+        # Batch of the memory queue which is being written
+        self.inflight = []
+        self.lock_file = None
+        self.thread = None
+        self.counters = {"written": 0, "spilled": 0, "spilled_bytes": 0, "replayed": 0, "errors": 0, "adopted": 0}
+        self.spill_pending = 0
+
+    def start(self) -> None:
+        """
+        Lock my spill directory, adopt spills of dead consumers and start the writer thread
+        """
+        self.lock_file = open(os.path.join(self.directory, LOCK_FILE), "w")
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.adopt()
+        self.spilling = bool(segment_paths(self.directory))
+        self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+        self.thread.start()
+
+    def adopt(self) -> None:
+        """
+        Take spill segments of consumers which are gone (their directories are not locked)
+        """
+        for name in os.listdir(self.root):
+            directory = os.path.join(self.root, name)
+            if directory == self.directory or not os.path.isdir(directory):
+                continue
+            with open(os.path.join(directory, LOCK_FILE), "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Owner is alive
+                    continue
+                for path in segment_paths(directory):
+                    records = sum(1 for _ in iter_segment(path))
+                    os.rename(path, os.path.join(self.directory, os.path.basename(path)))
+                    self.counters["adopted"] += records
+                    self.spill_pending += records
+                os.remove(os.path.join(directory, LOCK_FILE))
+            os.rmdir(directory)
+            logging.info(f"Spill of {name} is adopted by {self.directory}")
+
+    def put(self, message_id, fields: dict, meta: dict = None) -> None:
+        """
+        Queue stream entry, it never waits for Redis
+
+        :param message_id: ID of message (it chooses the stream shard)
+        :param fields: stream entry
+        :param meta: what the write function needs besides the entry (JSON serializable)
+        """
+        entry = (message_id, fields, {} if meta is None else meta)
+        with self.lock:
+            if self.spilling or len(self.queue) >= self.max_queue:
+                record = pack_entry(*entry)
+                self.spill.write(time.time_ns(), record)
+                self.spill.flush()
+                self.spilling = True
+                self.spill_pending += 1
+                self.counters["spilled"] += 1
+                self.counters["spilled_bytes"] += len(record)
+            else:
+                self.queue.append(entry)
+            self.ready.notify()
+
+    def take(self) -> list:
+        with self.lock:
+            count = min(len(self.queue), self.batch)
+            self.inflight = [self.queue.popleft() for _ in range(count)]
+            return self.inflight
+
+    def deliver(self, entries: list) -> bool:
+        """
+        Write entries, failed write is retried with backoff until it's written or i'm closed
+
+        :return: True if written
+        """
+        delay = 0.05
+        while True:
+            try:
+                written = self.write(entries)
+                self.counters["written"] += len(entries) if written is None else written
+                return True
+            except Exception as e:
+                self.counters["errors"] += 1
+                logging.warning(f"Write-behind of {len(entries)} entries failed: {e}, retry in {delay:.2f} s")
+                if self.closing and time.monotonic() >= self.deadline:
+                    return False
+                time.sleep(delay)
+                delay = min(delay * 2, self.retry_max)
+
+    def replay(self) -> bool:
+        """
+        Replay spill segments in order, every segment is removed when it's written
+
+        :return: False if i was closed before the spill was replayed
+        """
+        with self.lock:
+            # The next spilled entry starts a new segment, the closed ones are mine to replay
+            self.spill.close()
+            paths = segment_paths(self.directory)
+        for path in paths:
+            entries = []
+            for _, record in iter_segment(path):
+                entries.append(unpack_entry(record))
+                if len(entries) >= self.batch:
+                    if not self.deliver(entries):
+                        return False
+                    self.replayed(len(entries))
+                    entries = []
+            if entries:
+                if not self.deliver(entries):
+                    return False
+                self.replayed(len(entries))
+            os.remove(path)
+        with self.lock:
+            if self.spill.file is None and not segment_paths(self.directory):
+                self.spilling = False
+                logging.info(f"Spill of write-behind is replayed ({self.counters['replayed']} entries so far)")
+        return True
+
+    def replayed(self, count: int) -> None:
+        with self.lock:
+            self.counters["replayed"] += count
+            self.spill_pending -= count
+
+    def run(self) -> None:
+        """
+        Writer thread: memory queue first, then the spill (everything in memory is older than the spill)
+        """
+        while True:
+            entries = self.take()
+            if entries:
+                written = self.deliver(entries)
+                self.inflight = []
+                if not written:
+                    self.requeue(entries)
+                    return
+                continue
+            if self.spilling:
+                if not self.replay():
+                    return
+                continue
+            with self.lock:
+                if self.closing:
+                    return
+                if not self.queue:
+                    self.spill.flush()
+                    self.ready.wait(1.0)
+
+    def requeue(self, entries: list) -> None:
+        with self.lock:
+            self.queue.extendleft(reversed(entries))
+
+    def close(self, timeout: float = 30.0) -> None:
+        """
+        Write what's queued and stop, what is not written in `timeout` seconds is spilled to disk
+        (the next consumer on this host will replay it)
+        """
+        with self.lock:
+            self.closing = True
+            self.deadline = time.monotonic() + timeout
+            self.ready.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        with self.lock:
+            # Thread is still stuck in a write - its batch and the queue go to a new segment after the spilled ones
+            self.queue.extendleft(reversed(self.inflight))
+            self.inflight = []
+            while self.queue:
+                self.spill.write(time.time_ns(), pack_entry(*self.queue.popleft()))
+                self.spill_pending += 1
+            self.spill.close()
+            if self.spill_pending:
+                logging.warning(f"Write-behind left {self.spill_pending} entries spilled in {self.directory}")
+            # My spill is complete, anybody can adopt it - or there is nothing to adopt and i clean up
+            if self.lock_file is not None:
+                if not segment_paths(self.directory):
+                    os.remove(os.path.join(self.directory, LOCK_FILE))
+                    os.rmdir(self.directory)
+                self.lock_file.close()
+                self.lock_file = None
+
+    def snapshot(self) -> dict:
+        """
+        :return: counters (written, spilled, spilled_bytes, replayed, errors, adopted) and gauges (queued,
+                 spill_pending)
+        """
+        with self.lock:
+            return {**self.counters, "queued": len(self.queue), "spill_pending": self.spill_pending}
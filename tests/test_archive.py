@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from src.archive import ArchiveWriter, ArchiveReader, iter_entries, parse_id, read_index
+
+
+def make_entries(start, stop):
+    return [(f'{i}-0'.encode(), {b'message_id': str(i).encode(), b'raw': b'\xff'}) for i in range(start, stop)]
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_parse_id(self):
+        self.assertEqual(parse_id(b'5-1'), (5, 1))
+        self.assertEqual(parse_id('5'), (5, 0))
+        self.assertLess(parse_id('-'), parse_id('0-1'))
+        self.assertGreater(parse_id('+'), parse_id('99999999999999-0'))
+
+    def test_write_and_read_range(self):
+        # Test chunks are appended to segments and read back by range of IDs (bytes survive as they are)
+        writer = ArchiveWriter(self.directory, segment_bytes=1)
+        writer.append(make_entries(1, 4))
+        writer.append(make_entries(4, 7))
+
+        chunks = read_index(self.directory)
+        self.assertEqual([(c.first_id, c.last_id, c.count) for c in chunks], [('1-0', '3-0', 3), ('4-0', '6-0', 3)])
+        # Segment is rolled when it's full
+        self.assertEqual(len({c.segment for c in chunks}), 2)
+
+        reader = ArchiveReader(self.directory)
+        self.assertEqual(list(reader.entries()), make_entries(1, 7))
+        self.assertEqual([e[0] for e in reader.entries('3-0', '5')], [b'3-0', b'4-0', b'5-0'])
+
+    def test_writer_resumes_after_restart(self):
+        ArchiveWriter(self.directory).append(make_entries(1, 3))
+        writer = ArchiveWriter(self.directory)
+        self.assertEqual(writer.last_id, '2-0')
+        writer.append(make_entries(3, 5))
+        # The same segment is continued
+        self.assertEqual(len({c.segment for c in read_index(self.directory)}), 1)
+        self.assertEqual(len(list(ArchiveReader(self.directory).entries())), 4)
+
+    def test_torn_index_line_is_ignored(self):
+        ArchiveWriter(self.directory).append(make_entries(1, 3))
+        with open(os.path.join(self.directory, 'index'), 'a') as f:
+            f.write('1-0.jsonl.gz 999')
+        self.assertEqual(len(read_index(self.directory)), 1)
+
+    def test_iter_entries_archived_and_live(self):
+        # Test archived entries are followed by live ones, entries in both places are returned once
+        ArchiveWriter(self.directory).append(make_entries(1, 4))
+        r = MagicMock()
+        r.xrange.side_effect = [make_entries(4, 6), make_entries(6, 7)]
+
+        entries = list(iter_entries(r, 'stream', ArchiveReader(self.directory), count=2))
+
+        self.assertEqual(entries, make_entries(1, 7))
+        self.assertEqual(r.xrange.call_args_list[0].kwargs['min'], '(3-0')
+        self.assertEqual(r.xrange.call_args_list[1].kwargs['min'], '(5-0')
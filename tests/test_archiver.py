@@ -0,0 +1,40 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from archiver import StreamArchiver
+from archive import ArchiveWriter
+
+
+class TestStreamArchiver(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.mock_redis = MagicMock()
+        self.archiver = StreamArchiver(self.mock_redis, 'stream', ArchiveWriter(self.tmp.name), chunk=2)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_archive_from_cursor(self):
+        # Test archiving continues after the last archived entry
+        self.mock_redis.xrange.return_value = [(b'1-0', {b'a': b'1'}), (b'2-0', {b'a': b'2'})]
+        self.mock_redis.xinfo_stream.return_value = {'max-deleted-entry-id': b'0-0'}
+        self.assertEqual(self.archiver.archive_once(), 2)
+        self.mock_redis.xrange.assert_called_with('stream', min='-', count=2)
+
+        self.mock_redis.xrange.return_value = []
+        self.assertEqual(self.archiver.archive_once(), 0)
+        self.mock_redis.xrange.assert_called_with('stream', min='(2-0', count=2)
+
+    def test_trimmed_before_archiving(self):
+        # Test loss of entries trimmed before they were archived is reported
+        self.archiver.writer.append([(b'1-0', {b'a': b'1'})])
+        self.mock_redis.xrange.return_value = [(b'9-0', {b'a': b'9'})]
+        self.mock_redis.xinfo_stream.return_value = {'max-deleted-entry-id': b'8-0'}
+
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(self.archiver.archive_once(), 1)
@@ -0,0 +1,70 @@
+import unittest
+from unittest.mock import patch, MagicMock, AsyncMock
+from src.async_consumer import AsyncConsumerEngine
+
+
+class TestAsyncConsumerEngine(unittest.IsolatedAsyncioTestCase):
+
+    @patch('redis.asyncio.Redis')
+    def setUp(self, mock_redis):
+        # Mock async Redis connection
+        self.mock_redis = mock_redis.return_value
+        self.mock_redis.set = AsyncMock()
+        self.mock_redis.xadd = AsyncMock()
+        self.pipe = MagicMock()
+        self.pipe.execute = AsyncMock()
+        self.mock_redis.pipeline.return_value.__aenter__.return_value = self.pipe
+        self.consumer = AsyncConsumerEngine(['c1', 'c2'], redis_host='localhost', redis_port=6379, mode='simple')
+
+    async def test_process_with_lock(self):
+        # Test message is locked and streamed on behalf of logical consumer
+        self.mock_redis.set.return_value = True
+
+        self.assertTrue(await self.consumer.process('c2', {'message_id': '123'}))
+
+        self.mock_redis.set.assert_awaited_once_with(f'{self.consumer.lock_name}:123', 'c2', nx=True, ex=5)
+        fields = self.mock_redis.xadd.call_args.args[1]
+        self.assertEqual((fields['message_id'], fields['processed_by']), ('123', 'c2'))
+
+    async def test_process_lock_taken(self):
+        # Test message locked by another consumer is skipped
+        self.mock_redis.set.return_value = None
+
+        self.assertFalse(await self.consumer.process('c1', {'message_id': '123'}))
+        self.mock_redis.xadd.assert_not_called()
+
+    async def test_flush_stats_of_due_consumers(self):
+        # Test stats of logical consumers go to their own hashes by one pipeline
+        self.pipe.__len__.return_value = 1
+        self.consumer.stats['c1'].add(processed_messages=1)
+        self.consumer.stats['c1'].flush_count = 1
+
+        await self.consumer.flush_stats()
+
+        self.pipe.hincrby.assert_any_call(f'{self.consumer.stats_name}:c1', 'processed_messages', 1)
+        self.pipe.hincrby.assert_any_call(f'{self.consumer.stats_name}:group', 'processed_messages', 1)
+        self.assertEqual(self.pipe.hincrby.call_count, 2)
+        self.pipe.execute.assert_awaited_once()
+
+        await self.consumer.flush_stats(heartbeat=True)
+        self.pipe.zadd.assert_called_once_with(self.consumer.heartbeats, {'c1': unittest.mock.ANY,
+                                                                          'c2': unittest.mock.ANY})
+
+    async def test_dispatch_round_robin(self):
+        # Test messages are spread across logical consumers
+        for i in range(4):
+            await self.consumer.dispatch({'message_id': str(i)}, 10)
+
+        self.assertEqual([queue.qsize() for queue in self.consumer.queues], [2, 2])
+        self.assertEqual(self.consumer.queues[1].get_nowait(), ({'message_id': '1'}, 10))
+
+    @patch('redis.asyncio.Redis')
+    def test_unsupported_config_is_refused(self, mock_redis):
+        # Test config which would run with other semantics than ConsumerEngine fails on start
+        for mode, name, value in (('batch', 'ingest_backend', 'pubsub'), ('pipeline', 'ingest_backend', 'pubsub'),
+                                  ('simple', 'ingest_backend', 'stream'), ('simple', 'priority_lanes', 'high,bulk'),
+                                  ('script', 'write_behind_queue', 1000), ('simple', 'instrument_sample_every', 100)):
+            with self.subTest(mode=mode, option=name), \
+                    patch(f'src.async_consumer.{name}', value):
+                with self.assertRaises(ValueError):
+                    AsyncConsumerEngine(['c1'], redis_host='localhost', redis_port=6379, mode=mode)
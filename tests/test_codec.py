@@ -0,0 +1,45 @@
+import unittest
+import json
+from unittest.mock import patch
+from src import codec
+from src.codec import get_codec, encode_json, extend_json, available_codecs
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_roundtrip(self):
+        # Test every available codec decodes what it encodes
+        message = {'message_id': '1F1B1E1C-1B1B-1E1B-1B1B-1B1E1B1B1E1B', 'body': {'items': [1, 2.5, 'x']}}
+        for name in available_codecs():
+            with self.subTest(codec=name):
+                _codec = get_codec(name)
+                self.assertEqual(_codec.loads(_codec.dumps(message)), message)
+
+    def test_json_codecs_share_wire_format(self):
+        # Test publisher with one JSON codec and consumer with another understand each other
+        payload = get_codec('auto').dumps({'message_id': '123'})
+        self.assertEqual(get_codec('json').loads(payload), {'message_id': '123'})
+
+    def test_unavailable_codec(self):
+        with patch.object(codec, 'msgpack', None):
+            with self.assertRaises(ValueError):
+                get_codec('msgpack')
+
+    def test_auto_falls_back_to_json(self):
+        with patch.object(codec, 'orjson', None):
+            self.assertEqual(get_codec('auto').name, 'json')
+
+    def test_extend_json(self):
+        self.assertEqual(json.loads(extend_json(b'{"a": 1}\n', {'b': 'x'})), {'a': 1, 'b': 'x'})
+        self.assertEqual(json.loads(extend_json(b'{ }', {'b': 2})), {'b': 2})
+        self.assertEqual(extend_json(b'{"a":1}', {}), b'{"a":1}')
+
+    def test_extend_json_stdlib_encoder(self):
+        with patch.object(codec, 'orjson', None):
+            self.assertEqual(extend_json(b'{"a":1}', {'b': 2}), b'{"a":1,"b":2}')
+
+    def test_encode_json_what_orjson_refuses(self):
+        # Test message of json codec with a big integer and msgpack message with integer keys are encoded
+        message = get_codec('json').loads(b'{"message_id": "1", "amount": 123456789012345678901234567890}')
+        self.assertEqual(json.loads(encode_json(message)), message)
+        self.assertEqual(json.loads(encode_json({1: 'a'})), {'1': 'a'})
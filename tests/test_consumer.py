@@ -1,13 +1,23 @@
 import unittest
 import json
-from unittest.mock import patch, MagicMock
+import time
+from collections import Counter
+from unittest.mock import patch, MagicMock, call
 from src.consumer import ConsumerEngine
+from src.config import stats_retention
+from src.codec import JsonCodec
+from src.dedup import BucketDedup
+from src.partitions import PartitionSubscription, assign
+from src.entries import CompactLayout, decode_entry
+from src.index import MessageIndex
+import redis
 
 class TestConsumerEngine(unittest.TestCase):
 
+    @patch('threading.Thread')
     @patch('redis.Redis')
-    def setUp(self, mock_redis):
-        # Mock Redis connection
+    def setUp(self, mock_redis, mock_thread):
+        # Mock Redis connection (and keep heartbeat thread away from mocked pipelines)
         self.mock_redis = mock_redis.return_value
         self.consumer = ConsumerEngine(consumer_id='test_consumer', redis_host='localhost', redis_port=6379)
 
@@ -29,9 +39,11 @@ class TestConsumerEngine(unittest.TestCase):
     @patch('json.loads')
     def test_listen_and_process_message(self, mock_json_loads):
         # Mock the pubsub listening process
+        self.consumer.codec = JsonCodec()
+        payload = json.dumps({'message_id': '1F1B1E1C-1B1B-1E1B-1B1B-1B1E1B1B1E1B'}).encode('utf-8')
         pubsub_mock = MagicMock()
         pubsub_mock.listen.return_value = [
-            {'type': 'message', 'data': json.dumps({'message_id': '1F1B1E1C-1B1B-1E1B-1B1B-1B1E1B1B1E1B'}).encode('utf-8')},
+            {'type': 'message', 'data': payload},
         ]
         self.mock_redis.pubsub.return_value = pubsub_mock
         self.mock_redis.set.return_value = True  # Lock acquisition success
@@ -39,12 +51,13 @@ class TestConsumerEngine(unittest.TestCase):
 
         with patch.object(self.consumer, 'process_message') as mock_process_message:
             self.consumer.listen_and_process()
-            mock_process_message.assert_called_once_with({'message_id': '1F1B1E1C-1B1B-1E1B-1B1B-1B1E1B1B1E1B'})
+            mock_process_message.assert_called_once_with({'message_id': '1F1B1E1C-1B1B-1E1B-1B1B-1B1E1B1B1E1B'}, payload)
 
 
     @patch('json.loads')
     def test_listen_and_process_lock_acquisition_failure(self, mock_json_loads):
         # Test failure to acquire lock in listen_and_process
+        self.consumer.codec = JsonCodec()
         pubsub_mock = MagicMock()
         pubsub_mock.listen.return_value = [
             {'type': 'message', 'data': bytes(str({'message_id': '1F1B1E1C-1B1B-1E1B-1B1B-1B1E1B1B1E1B'}).encode())},
@@ -71,16 +84,505 @@ class TestConsumerEngine(unittest.TestCase):
         self.mock_redis.xadd.assert_called_once_with(self.consumer.stream_name, {
             'message_id': '123',
             'processed_by': 'test_consumer',
-            'processed_message': json.dumps(message),
+            'processed_message': unittest.mock.ANY,
             'created_at': unittest.mock.ANY
         })
+        fields = self.mock_redis.xadd.call_args.args[1]
+        self.assertEqual(json.loads(fields['processed_message']), message)
 
+    @patch('random.random', return_value=0.5)
+    def test_process_message_extends_raw_payload(self, mock_random):
+        # Test JSON payload is extended without re-encoding
+        raw = b'{"message_id": "123", "body": [1, 2]}'
+        message = json.loads(raw)
+        self.consumer.process_message(message, raw)
+
+        fields = self.mock_redis.xadd.call_args.args[1]
+        self.assertTrue(fields['processed_message'].startswith(b'{"message_id": "123", "body": [1, 2],'))
+        self.assertEqual(json.loads(fields['processed_message']),
+                         {'message_id': '123', 'body': [1, 2], 'processed_by': 'test_consumer', 'random_property': 0.5})
+
+
+    @patch('random.random', return_value=0.5)
+    @patch('src.consumer.compact_layout', return_value=CompactLayout(compress_min=0))
+    def test_process_message_compact(self, mock_layout, mock_random):
+        # Test compact entry keeps the payload as it came and doesn't repeat message_id and processed_by
+        raw = b'{"message_id": "123", "body": [1, 2]}'
+        self.consumer.process_message(json.loads(raw), raw)
+
+        fields = self.mock_redis.xadd.call_args.args[1]
+        self.assertEqual(sorted(fields), ['c', 'm', 'r', 't'])
+        self.assertIs(fields['m'], raw)
+        self.assertEqual(decode_entry(fields)['message'],
+                         {'message_id': '123', 'body': [1, 2], 'processed_by': 'test_consumer', 'random_property': 0.5})
+
+    @patch('random.random', return_value=0.5)
+    def test_process_message_atomic(self, mock_random):
+        # Test one-call processing with Lua script keeps the stream entry layout
+        self.consumer.mode = "script"
+        self.consumer.process_message_script = MagicMock(return_value=b'1-0')
+        message = {'message_id': '123'}
+
+        self.assertTrue(self.consumer.handle_message(message))
+
+        kwargs = self.consumer.process_message_script.call_args.kwargs
+        self.assertEqual(kwargs['keys'], [f'{self.consumer.lock_name}:123', self.consumer.stream_name])
+        self.assertEqual(kwargs['args'][1:5], [5, '', '', ''])
+        fields = kwargs['args'][5:]
+        self.assertEqual(fields[0::2], ['message_id', 'processed_by', 'processed_message', 'created_at'])
+        self.assertEqual(json.loads(fields[5]), message)
+        self.mock_redis.xadd.assert_not_called()
+
+    @patch('src.consumer.processed_stream_retention_ms', 60000)
+    @patch('time.time', return_value=1000.0)
+    def test_stream_trim_by_retention(self, mock_time):
+        # Test retention by age wins over length and becomes MINID
+        self.consumer.process_message({'message_id': '123'})
+        self.assertEqual(self.mock_redis.xadd.call_args.kwargs, {'minid': '940000-0', 'approximate': True})
+
+    @patch('src.consumer.processed_stream_maxlen', 1000000)
+    def test_stream_trim_by_length(self):
+        # Test retention is opt-in: stream is unbounded by default, MAXLEN is applied when it's set
+        self.consumer.process_message({'message_id': '123'})
+        self.assertEqual(self.mock_redis.xadd.call_args.kwargs, {'maxlen': 1000000, 'approximate': True})
+
+    def test_sharded_stream(self):
+        # Test message goes to the shard of its message_id in every mode
+        self.consumer.stream_shards = ['s:{0}', 's:{1}', 's:{2}']
+        self.consumer.process_message({'message_id': 'm4'})
+        self.assertEqual(self.mock_redis.xadd.call_args.args[0], 's:{2}')
+
+        self.consumer.process_message_script = MagicMock(return_value=b'1-0')
+        self.consumer.process_message_atomic({'message_id': 'm4'})
+        self.assertEqual(self.consumer.process_message_script.call_args.kwargs['keys'][1], 's:{2}')
+
+    def test_rebalance_partitions(self):
+        # Test consumer subscribes only its share of partitions and lets lost ones go after the grace period
+        self.consumer.pubsub_partitions = 4
+        self.consumer.partitions = PartitionSubscription([f'ch:{{{p}}}' for p in range(4)], grace=0)
+        pubsub = MagicMock()
+        self.mock_redis.zrangebyscore.return_value = []
+        self.consumer.rebalance(pubsub)
+        pubsub.subscribe.assert_called_once_with('ch:{0}', 'ch:{1}', 'ch:{2}', 'ch:{3}')
+
+        self.mock_redis.zrangebyscore.return_value = [b'test_consumer', b'other']
+        self.consumer.rebalance(pubsub)
+        mine = assign(['test_consumer', 'other'], 4)['test_consumer']
+        pubsub.unsubscribe.assert_called_once_with(*[f'ch:{{{p}}}' for p in range(4) if p not in mine])
+        self.assertFalse(self.consumer.rebalance_due())
+
+    @patch('src.consumer.pipeline_filter', 'src.transforms:has_published_at')
+    @patch('src.consumer.pipeline_transform', 'src.transforms:checksum')
+    def test_pipeline_mode(self):
+        # Test messages go through filter and transform to the sink, transformed ones are encoded again
+        self.consumer.codec = JsonCodec()
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.return_value = [True]
+        pipeline = self.consumer.build_pipeline()
+        self.assertEqual([stage.name for stage in pipeline.stages], ['decode', 'filter', 'transform'])
+        pipeline.start()
+        pipeline.put(json.dumps({'message_id': '1', 'published_at': time.time()}).encode())
+        pipeline.put(json.dumps({'message_id': '2'}).encode())
+        pipeline.put(b'garbage')
+        pipeline.close()
+
+        self.assertEqual(pipe.xadd.call_count, 1)
+        self.assertIn('checksum', json.loads(pipe.xadd.call_args.args[1]['processed_message']))
+        counters = pipeline.snapshot()
+        self.assertEqual(counters['decode']['dropped'], 1)
+        self.assertEqual(counters['filter']['dropped'], 1)
+
+    def test_process_message_atomic_lock_taken(self):
+        # Test script reports lock taken by another consumer
+        self.consumer.mode = "script"
+        self.consumer.process_message_script = MagicMock(return_value=None)
+        self.assertFalse(self.consumer.handle_message({'message_id': '123'}))
+
+    @patch('random.random', return_value=0.5)
+    @patch('time.time', return_value=1050.0)
+    def test_process_message_atomic_indexed(self, mock_time, mock_random):
+        # Test script mode indexes the message in the same Lua call
+        self.consumer.mode = "script"
+        self.consumer.index = MessageIndex('consumer:index', 600, 100)
+        self.consumer.process_message_script = MagicMock(return_value=b'1-0')
+
+        self.assertTrue(self.consumer.handle_message({'message_id': '123'}))
+
+        kwargs = self.consumer.process_message_script.call_args.kwargs
+        self.assertEqual(kwargs['keys'][2], 'consumer:index:10')
+        self.assertEqual(kwargs['args'][5:8], ['123', 1700, 'message_id'])
+
+    def test_process_message_indexed(self):
+        # Test simple mode streams and indexes message by one script call instead of XADD
+        self.consumer.index = MessageIndex('consumer:index', 600, 100)
+        self.consumer.stream_and_index_script = MagicMock()
+
+        self.consumer.process_message({'message_id': '123'})
+
+        kwargs = self.consumer.stream_and_index_script.call_args.kwargs
+        self.assertEqual(kwargs['keys'][0], self.consumer.stream_name)
+        self.assertEqual(kwargs['args'][:4], ['', '', '123', 'test_consumer'])
+        self.mock_redis.xadd.assert_not_called()
+
+    def test_handle_batch_indexed_reloads_script(self):
+        # Test batch is streamed by EVALSHA in the pipeline and calls lost by NOSCRIPT are repeated after SCRIPT LOAD
+        self.consumer.index = MessageIndex('consumer:index', 600, 100)
+        self.consumer.stream_and_index_script = MagicMock(sha='abc')
+        lock_pipe, write_pipe, retry_pipe = MagicMock(), MagicMock(), MagicMock()
+        lock_pipe.execute.return_value = [True, True]
+        write_pipe.command_stack = [(('EVALSHA', 'abc', 2, 'a'), {}), (('EVALSHA', 'abc', 2, 'b'), {})]
+        write_pipe.execute.return_value = [b'1-0', redis.exceptions.NoScriptError('NOSCRIPT')]
+        retry_pipe.execute.return_value = [b'2-0']
+        self.mock_redis.pipeline.side_effect = [lock_pipe, write_pipe, retry_pipe]
+
+        self.assertEqual(self.consumer.handle_batch([({'message_id': m}, b'{}') for m in 'ab']), 2)
+
+        self.assertEqual(write_pipe.evalsha.call_count, 2)
+        self.assertEqual(write_pipe.evalsha.call_args.args[:3], ('abc', 2, self.consumer.stream_name))
+        write_pipe.xadd.assert_not_called()
+        self.mock_redis.script_load.assert_called()
+        retry_pipe.execute_command.assert_called_once_with('EVALSHA', 'abc', 2, 'b')
+
+    def test_write_behind_loop_never_calls_redis(self):
+        # Test with write-behind the loop only queues messages, even when Redis is gone
+        self.consumer.codec = JsonCodec()
+        self.consumer.write_behind = MagicMock()
+        self.mock_redis.set.side_effect = redis.ConnectionError("Redis is gone")
+        self.mock_redis.pipeline.side_effect = redis.ConnectionError("Redis is gone")
+
+        self.assertIsNone(self.consumer.on_message(b'{"message_id": "123", "published_at": 1.5}', lane='high'))
+        self.assertEqual(self.consumer.handle_batch([({'message_id': m}, b'{}') for m in 'ab']), 0)
+
+        self.mock_redis.set.assert_not_called()
+        self.mock_redis.xadd.assert_not_called()
+        puts = self.consumer.write_behind.put.call_args_list
+        self.assertEqual([call.args[0] for call in puts], ['123', 'a', 'b'])
+        self.assertEqual(puts[0].args[2], {'bytes': 42, 'published_at': 1.5, 'lane': 'high'})
+        self.assertEqual(self.consumer.stats.counters['processed_messages'], 0)
+
+    def test_claim_and_write(self):
+        # Test writer thread claims by one pipeline, streams the winners and doesn't claim again on retry
+        entries = [('a', {'n': 1}, {'bytes': 10, 'published_at': time.time()}), ('b', {'n': 2}, {'bytes': 20})]
+        claim_pipe, write_pipe, retry_pipe = MagicMock(), MagicMock(), MagicMock()
+        claim_pipe.execute.return_value = [True, None]
+        write_pipe.execute.side_effect = redis.ConnectionError("Redis is gone")
+        self.mock_redis.pipeline.side_effect = [claim_pipe, write_pipe, retry_pipe, MagicMock()]
+
+        with self.assertRaises(redis.ConnectionError):
+            self.consumer.claim_and_write(entries)
+        self.assertEqual(self.consumer.claim_and_write(entries), 1)
+
+        self.assertEqual(claim_pipe.set.call_count, 2)
+        retry_pipe.set.assert_not_called()
+        self.assertEqual(retry_pipe.xadd.call_args.args[1], {'n': 1})
+        self.assertEqual(retry_pipe.xadd.call_count, 1)
+        counters = self.consumer.stats.counters
+        self.assertEqual((counters['processed_messages'], counters['lock_misses'], counters['bytes_processed']),
+                         (1, 1, 10))
+        self.assertEqual(sum(self.consumer.stats.latencies['end_to_end'].values()), 1)
+
+    def lane_consumer(self, mock_redis, mode):
+        consumer = ConsumerEngine(consumer_id='test_consumer', redis_host='localhost', redis_port=6379, mode=mode)
+        consumer.codec = JsonCodec()
+        pubsub = mock_redis.return_value.pubsub.return_value
+        # A burst of bulk messages came before one high priority message
+        messages = [{'type': 'message', 'channel': b'messages:published:lane:bulk',
+                     'data': json.dumps({'message_id': f'b{i}'}).encode()} for i in range(5)]
+        messages.append({'type': 'message', 'channel': b'messages:published:lane:high',
+                         'data': json.dumps({'message_id': 'h1'}).encode()})
+
+        def get_message(**kwargs):
+            if messages:
+                return messages.pop(0)
+            pubsub.subscribed = False
+            return None
+
+        pubsub.get_message.side_effect = get_message
+        return consumer, pubsub
+
+    @patch('src.consumer.priority_lanes', 'high:4,bulk:1')
+    @patch('threading.Thread')
+    @patch('redis.Redis')
+    def test_lanes(self, mock_redis, mock_thread):
+        # Test high priority message doesn't wait behind bulk backlog and messages are counted by lane
+        consumer, pubsub = self.lane_consumer(mock_redis, 'simple')
+        with patch.object(consumer, 'handle_message', return_value=True) as mock_handle_message:
+            consumer.listen_and_process()
+
+        pubsub.subscribe.assert_called_once_with('messages:published:lane:high', 'messages:published:lane:bulk')
+        self.assertEqual([call.args[0]['message_id'] for call in mock_handle_message.call_args_list],
+                         ['h1', 'b0', 'b1', 'b2', 'b3', 'b4'])
+        self.assertEqual(mock_handle_message.call_args_list[0].args[2], 'high')
+        self.assertEqual(consumer.lane_served, {'high': 1, 'bulk': 5})
+
+        counters = Counter()
+        for call in mock_redis.return_value.pipeline.return_value.hincrby.call_args_list:
+            if call.args[0] == consumer.stats.key:
+                counters[call.args[1]] += call.args[2]
+        self.assertEqual(counters['lane:bulk:processed_messages'], 5)
+        self.assertEqual(counters['processed_messages'], 6)
+
+    @patch('src.consumer.priority_lanes', 'high:4,bulk:1')
+    @patch('threading.Thread')
+    @patch('redis.Redis')
+    def test_lane_batches(self, mock_redis, mock_thread):
+        # Test batch mode takes batch in the order of service and locks one batch per lane
+        consumer, _ = self.lane_consumer(mock_redis, 'batch')
+        with patch.object(consumer, 'handle_batch') as mock_handle_batch:
+            consumer.listen_and_process()
+        self.assertEqual([(call.kwargs['lane'], [data['message_id'] for data, _ in call.args[0]])
+                          for call in mock_handle_batch.call_args_list],
+                         [('high', ['h1']), ('bulk', ['b0', 'b1', 'b2', 'b3', 'b4'])])
+
+    @patch('src.consumer.priority_lanes', 'high:4,bulk:1')
+    @patch('threading.Thread')
+    @patch('redis.Redis')
+    def test_lanes_need_pubsub_modes(self, mock_redis, mock_thread):
+        with self.assertRaises(ValueError):
+            ConsumerEngine(consumer_id='test_consumer', redis_host='localhost', redis_port=6379, mode='pipeline')
+
+    @patch('src.consumer.priority_lanes', 'high:4,bulk:1')
+    @patch('src.consumer.write_behind_queue', 100)
+    @patch('src.consumer.WriteBehind')
+    @patch('threading.Thread')
+    @patch('redis.Redis')
+    def test_bad_config_starts_no_write_behind(self, mock_redis, mock_thread, mock_write_behind):
+        # Test config is checked before write-behind locks its spill directory and starts its thread
+        with self.assertRaises(ValueError):
+            ConsumerEngine(consumer_id='test_consumer', redis_host='localhost', redis_port=6379, mode='pipeline')
+        mock_write_behind.assert_not_called()
+
+    def test_report_write_behind(self):
+        # Test write-behind counters go to stats as increments and gauges are set as they are
+        self.consumer.write_behind = MagicMock()
+        pipe = MagicMock()
+        for written in (10, 25):
+            self.consumer.write_behind.snapshot.return_value = {'written': written, 'spilled': 3, 'queued': 7,
+                                                                'spill_pending': 3}
+            self.consumer.report_write_behind(pipe)
+        self.assertEqual(self.consumer.stats.counters['writebehind:written'], 25)
+        self.assertEqual(self.consumer.stats.counters['writebehind:spilled'], 3)
+        pipe.hset.assert_called_with(self.consumer.stats.key,
+                                     mapping={'writebehind:queued': 7, 'writebehind:spill_pending': 3})
+
+    def test_process_stream_entries(self):
+        # Test batch of input stream entries is streamed, counted and acknowledged in one pipeline
+        pipe = self.mock_redis.pipeline.return_value
+        self.consumer.stats.flush_count = 1
+        entries = [
+            (b'1-0', {b'data': b'{"message_id": "a"}'}),
+            (b'2-0', {b'data': b'{"message_id": "b"}'}),
+            (b'3-0', None),
+            (b'4-0', {b'data': b'not a json'}),
+        ]
+
+        self.assertEqual(self.consumer.process_stream_entries(entries), 2)
+
+        self.assertEqual(pipe.xadd.call_count, 2)
+        pipe.hincrby.assert_any_call(f'{self.consumer.stats_name}:test_consumer', 'processed_messages', 2)
+        pipe.hincrby.assert_any_call(f'{self.consumer.stats_name}:test_consumer', 'decode_errors', 1)
+        pipe.xack.assert_called_once_with(self.consumer.input_stream, self.consumer.input_group,
+                                          b'1-0', b'2-0', b'3-0', b'4-0')
+        pipe.execute.assert_called_once()
+
+    def test_empty_stream_batch_keeps_stats(self):
+        # Test due stats of an empty batch (empty XAUTOCLAIM page) are flushed, not dropped
+        pipe = self.mock_redis.pipeline.return_value
+        self.consumer.stats.flush_count = 1
+        self.consumer.stats.add(processed_messages=3)
+
+        self.assertEqual(self.consumer.process_stream_entries([]), 0)
+
+        pipe.hincrby.assert_has_calls([call(f'{self.consumer.stats_name}:test_consumer', 'processed_messages', 3),
+                                       call(f'{self.consumer.stats_name}:group', 'processed_messages', 3)])
+        pipe.execute.assert_called_once()
+        pipe.xack.assert_not_called()
+
+    def test_reclaim_pending_from_dead_consumer(self):
+        # Test pending entries are claimed only when some consumer is dead
+        self.mock_redis.xinfo_consumers.return_value = [
+            {'name': b'test_consumer', 'pending': 0},
+            {'name': b'alive', 'pending': 3},
+            {'name': b'dead', 'pending': 2},
+            {'name': b'dead_drained', 'pending': 0},
+        ]
+        self.mock_redis.zmscore.return_value = [time.time(), None, time.time() - 3600]
+        self.mock_redis.xautoclaim.return_value = [b'0-0', [(b'1-0', {b'data': b'{"message_id": "a"}'})], []]
+
+        self.assertEqual(self.consumer.reclaim_pending(), 1)
+
+        self.mock_redis.xautoclaim.assert_called_once()
+        self.mock_redis.xgroup_delconsumer.assert_called_once_with(
+            self.consumer.input_stream, self.consumer.input_group, 'dead_drained')
+
+    def test_reclaim_pending_nobody_dead(self):
+        # Test nothing is claimed while all consumers are alive
+        self.mock_redis.xinfo_consumers.return_value = [{'name': b'alive', 'pending': 3}]
+        self.mock_redis.zmscore.return_value = [time.time()]
+
+        self.assertEqual(self.consumer.reclaim_pending(), 0)
+        self.mock_redis.xautoclaim.assert_not_called()
+
+    @patch('src.consumer.batch_size', 2)
+    def test_collect_batch_flush_on_size(self):
+        # Test batch is flushed when it is full
+        pubsub_mock = MagicMock()
+        pubsub_mock.get_message.side_effect = [
+            None,
+            {'type': 'message', 'data': b'{"message_id": "a"}'},
+            {'type': 'message', 'data': b'{"message_id": "b"}'},
+            {'type': 'message', 'data': b'{"message_id": "c"}'},
+        ]
+        self.assertEqual(self.consumer.collect_batch(pubsub_mock), [({'message_id': 'a'}, b'{"message_id": "a"}'),
+                                                                    ({'message_id': 'b'}, b'{"message_id": "b"}')])
+
+    def test_collect_batch_flush_on_linger(self):
+        # Test batch is flushed when nothing more arrives during linger time
+        pubsub_mock = MagicMock()
+        pubsub_mock.get_message.side_effect = [
+            {'type': 'message', 'data': b'{"message_id": "a"}'},
+            {'type': 'message', 'data': b'broken'},
+            None,
+        ]
+        self.assertEqual(self.consumer.collect_batch(pubsub_mock), [({'message_id': 'a'}, b'{"message_id": "a"}')])
+        self.assertEqual(self.consumer.stats.counters['decode_errors'], 1)
+
+    def test_handle_batch(self):
+        # Test only messages with acquired lock are streamed and stats are updated once
+        lock_pipe, write_pipe = MagicMock(), MagicMock()
+        lock_pipe.execute.return_value = [True, None, True]
+        self.mock_redis.pipeline.side_effect = [lock_pipe, write_pipe]
+        self.consumer.stats.flush_count = 1
+
+        processed = self.consumer.handle_batch([({'message_id': m}, b'{"message_id": "%s"}' % m.encode())
+                                                for m in ('a', 'b', 'c')])
+
+        self.assertEqual(processed, 2)
+        self.assertEqual(lock_pipe.set.call_count, 3)
+        self.assertEqual([c.args[1]['message_id'] for c in write_pipe.xadd.call_args_list], ['a', 'c'])
+        key = f'{self.consumer.stats_name}:test_consumer'
+        write_pipe.hincrby.assert_any_call(key, 'processed_messages', 2)
+        write_pipe.hincrby.assert_any_call(key, 'lock_misses', 1)
+        write_pipe.hincrby.assert_any_call(key, 'bytes_processed', 38)
+        write_pipe.execute.assert_called_once()
+
+    @patch('time.time')
+    def test_handle_message_observes_latencies(self, mock_time):
+        # Test publish -> lock -> XADD latencies of stamped message are recorded
+        mock_time.side_effect = [100.5, 100.75, 100.75]
+        self.mock_redis.set.return_value = True
+
+        self.assertTrue(self.consumer.handle_message({'message_id': 'a', 'published_at': 100.0}))
+
+        latencies = self.consumer.stats.latency_sums
+        self.assertEqual(dict(latencies), {'publish_to_lock': 0.5, 'lock_to_xadd': 0.25, 'end_to_end': 0.75})
+
+    def test_handle_message_without_publish_time(self):
+        # Test messages of old publishers are processed without latencies
+        self.mock_redis.set.return_value = True
+        self.assertTrue(self.consumer.handle_message({'message_id': 'a'}))
+        self.assertEqual(self.consumer.stats.latencies, {})
+
+    def test_handle_batch_bucket_dedup(self):
+        # Test bucket dedup store claims by HSETNX and expires new bucket once, after the claims
+        self.consumer.dedup = BucketDedup('consumer:dedup', 5)
+        lock_pipe, write_pipe = MagicMock(), MagicMock()
+        lock_pipe.execute.return_value = [1, 0, 1]
+        self.mock_redis.pipeline.side_effect = [lock_pipe, write_pipe]
+
+        processed = self.consumer.handle_batch([({'message_id': m, 'published_at': 1000.0}, b'{}') for m in 'abc'])
+
+        self.assertEqual(processed, 2)
+        lock_pipe.hsetnx.assert_any_call('consumer:dedup:200', 'a', 'test_consumer')
+        lock_pipe.expireat.assert_called_once_with('consumer:dedup:200', unittest.mock.ANY)
+        self.assertEqual(lock_pipe.method_calls[-2][0], 'expireat')
+        lock_pipe.set.assert_not_called()
+
+    def test_batch_size_distribution(self):
+        # Test distribution of achieved batch sizes
+        self.consumer.batch_sizes.update({1: 50, 10: 40, 100: 10})
+        distribution = self.consumer.batch_size_distribution()
+        self.assertEqual(distribution['batches'], 100)
+        self.assertEqual(distribution['mean'], 14.5)
+        self.assertEqual((distribution['p50'], distribution['p90'], distribution['p99']), (1, 10, 100))
+        self.assertEqual(distribution['max'], 100)
+
+    def test_on_message_buffers_stats(self):
+        # Test stats are accumulated in memory and not written per message
+        self.mock_redis.set.side_effect = [True, None]
+        self.consumer.on_message(b'{"message_id": "a"}')
+        self.consumer.on_message(b'{"message_id": "b"}')
+        self.consumer.on_message(b'[1, 2]')
+
+        self.assertEqual(self.consumer.stats.counters, {'processed_messages': 1, 'bytes_processed': 19,
+                                                        'lock_misses': 1, 'decode_errors': 1})
+        self.mock_redis.pipeline.assert_not_called()
+        self.mock_redis.incr.assert_not_called()
+
+    def test_on_message_flushes_on_count(self):
+        # Test stats are flushed to consumer's hash by one pipeline when enough events are accumulated
+        self.mock_redis.set.return_value = True
+        self.consumer.stats.flush_count = 2
+        pipe = self.mock_redis.pipeline.return_value
+
+        self.consumer.on_message(b'{"message_id": "a"}')
+        pipe.execute.assert_not_called()
+        self.consumer.on_message(b'{"message_id": "b"}')
+
+        key = f'{self.consumer.stats_name}:test_consumer'
+        pipe.hincrby.assert_any_call(key, 'processed_messages', 2)
+        pipe.zadd.assert_not_called()
+        pipe.execute.assert_called_once()
+        self.assertEqual(self.consumer.stats.pending, 0)
+
+    def test_heartbeat(self):
+        # Test heartbeat refreshes my score in heartbeats sorted set by the same pipeline as stats
+        pipe = self.mock_redis.pipeline.return_value
+        self.consumer.flush_stats(heartbeat=True)
+        pipe.zadd.assert_called_once_with(self.consumer.heartbeats, {'test_consumer': unittest.mock.ANY})
+        pipe.execute.assert_called_once()
+
+    def test_instrumented_message(self):
+        # Test sampled message is timed by steps and timings are written to my instrumentation hash
+        self.mock_redis.set.return_value = True
+        self.consumer.instrument.sample_every = 1
+        self.consumer.on_message(b'{"message_id": "a"}')
+        self.assertEqual(sorted(self.consumer.instrument.timers), ['decode', 'lock', 'xadd'])
+
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.return_value = [{b'sample_every': b'0'}, 0]
+        self.consumer.poll_instrumentation()
+        self.assertEqual(self.consumer.instrument.sample_every, 0)
+        pipe.hdel.assert_called_once_with(self.consumer.instrument_name, 'profile:test_consumer')
+        pipe.hset.assert_called_once_with(f'{self.consumer.instrument_name}:test_consumer', mapping=unittest.mock.ANY)
+
+    def test_startup_events(self):
+        # Test consumer reports its confirmed subscription and its first message only once
+        self.consumer.startup = MagicMock()
+        pubsub = MagicMock()
+        pubsub.get_message.side_effect = [None, {'type': 'subscribe', 'channel': b'ch', 'data': 1}]
+        self.consumer.confirm_subscription(pubsub)
+        self.consumer.startup.report.assert_called_once_with("subscribed")
+
+        startup = self.consumer.startup
+        self.mock_redis.set.return_value = True
+        self.consumer.on_message(b'{"message_id": "a"}')
+        self.consumer.on_message(b'{"message_id": "b"}')
+        startup.report.assert_called_with("first_message")
+        self.assertEqual(startup.report.call_count, 2)
+        self.assertIsNone(self.consumer.startup)
 
     @patch('sys.exit')
     def test_shutdown(self, mock_exit):
         # Test graceful shutdown
+        self.consumer.stats.add(processed_messages=1)
         self.consumer.shutdown(signum=1, frame=None)
-        self.mock_redis.srem.assert_called_once_with("consumer:ids", self.consumer.consumer_id)
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.hincrby.assert_has_calls([call(f'{self.consumer.stats_name}:test_consumer', 'processed_messages', 1),
+                                       call(f'{self.consumer.stats_name}:group', 'processed_messages', 1)])
+        # My stats hash expires, the group hash has my counters
+        pipe.expire.assert_called_once_with(f'{self.consumer.stats_name}:test_consumer', stats_retention)
+        pipe.zrem.assert_called_once_with(self.consumer.heartbeats, self.consumer.consumer_id)
         self.mock_redis.close.assert_called_once()
         mock_exit.assert_called_once_with(0)
 
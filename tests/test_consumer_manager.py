@@ -14,6 +14,7 @@ sys.modules['config'].stats_name = 'test_stats'
 sys.modules['config'].consumer_manager_ttl = 60
 sys.modules['config'].consumer_manager_interval = 5
 sys.modules['config'].consumer_ids = 'test_consumers'
+sys.modules['config'].consumer_heartbeats = 'test_heartbeats'
 
 
 class TestConsumerManager(unittest.TestCase):
@@ -29,51 +30,74 @@ class TestConsumerManager(unittest.TestCase):
 
         self.manager.update_last_activity(consumer_id)
 
-        key = f"{self.manager.stats_name}:{consumer_id}:last_activity"
-        self.mock_redis.set.assert_called_once_with(key, current_time)
-        self.mock_redis.sadd.assert_called_once_with(self.manager.consumers_set, consumer_id)
+        self.mock_redis.zadd.assert_called_once_with(self.manager.heartbeats, {consumer_id: current_time})
 
     def test_is_active_consumer_active(self):
         consumer_id = "cnsmr_1"
         last_activity = int(time.time()) - (self.manager.ttl - 10)
 
-        self.mock_redis.get.return_value = str(last_activity).encode()
+        self.mock_redis.zscore.return_value = float(last_activity)
         self.assertTrue(self.manager.is_active(consumer_id))
 
     def test_is_active_consumer_inactive(self):
         consumer_id = "cnsmr_1"
         last_activity = int(time.time()) - (self.manager.ttl + 10)
 
-        self.mock_redis.get.return_value = str(last_activity).encode()
+        self.mock_redis.zscore.return_value = float(last_activity)
         self.assertFalse(self.manager.is_active(consumer_id))
 
     def test_is_active_consumer_nonexistent(self):
         consumer_id = "cnsmr_1"
-        self.mock_redis.get.return_value = None
+        self.mock_redis.zscore.return_value = None
         self.assertFalse(self.manager.is_active(consumer_id))
 
     def test_cleanup_inactive_consumers(self):
-        consumer_id_active = "cnsmr_1"
-        consumer_id_inactive = "cnsmr_2"
-        last_activity_active = int(time.time())
-        last_activity_inactive = int(time.time()) - (self.manager.ttl + 10)
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.return_value = [[b'cnsmr_2'], 1]
 
-        self.mock_redis.smembers.return_value = [consumer_id_active.encode(), consumer_id_inactive.encode()]
-        self.mock_redis.get.side_effect = [str(last_activity_active).encode(), str(last_activity_inactive).encode()]
+        self.assertEqual(self.manager.cleanup_inactive_consumers(), [b'cnsmr_2'])
 
-        self.manager.cleanup_inactive_consumers()
-
-        self.mock_redis.srem.assert_called_once_with(self.manager.consumers_set, consumer_id_inactive)
+        # One range of expired heartbeats is taken and removed, no per-consumer commands
+        deadline = float(pipe.zremrangebyscore.call_args.args[2].lstrip('('))
+        self.assertAlmostEqual(deadline, time.time() - self.manager.ttl, delta=5)
+        pipe.zrangebyscore.assert_called_once_with(self.manager.heartbeats, '-inf', f'({deadline}')
+        self.mock_redis.zscore.assert_not_called()
+        self.mock_redis.srem.assert_not_called()
+        # Stats hash of the removed consumer won't stay forever
+        pipe.expire.assert_called_once_with(f'{self.manager.stats_name}:cnsmr_2', self.manager.stats_retention)
 
     def test_get_active_consumers(self):
-        with patch.object(self.manager, 'cleanup_inactive_consumers', return_value=None) as mock_cleanup:
-            self.mock_redis.smembers.return_value = {b'consumer_1', b'consumer_2'}
+        now = time.time()
+        self.mock_redis.zrangebyscore.return_value = [(b'consumer_1', now - 5), (b'consumer_2', now)]
+
+        active_consumers = self.manager.get_active_consumers()
+
+        self.assertEqual(active_consumers, {b'consumer_1': now - 5, b'consumer_2': now})
+        self.mock_redis.zrangebyscore.assert_called_once()
+        self.assertAlmostEqual(self.mock_redis.zrangebyscore.call_args.args[1], now - self.manager.ttl, delta=5)
+
+    def test_migrate_legacy_registry(self):
+        self.mock_redis.smembers.return_value = {b'old'}
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.return_value = [b'100', b'200.5', b'42']
+
+        self.assertEqual(self.manager.migrate_legacy_registry(), 1)
+
+        pipe.zadd.assert_called_once_with(self.manager.heartbeats, {'old': 200.5}, gt=True)
+        pipe.srem.assert_called_once_with(self.manager.consumers_set, 'old')
+        # Old counter is folded into the stats hash (and the group one) and deleted with last_activity
+        pipe.hincrby.assert_any_call(f'{self.manager.stats_name}:old', 'processed_messages', 42)
+        pipe.hincrby.assert_any_call(f'{self.manager.stats_name}:group', 'processed_messages', 42)
+        pipe.delete.assert_called_once_with(f'{self.manager.stats_name}:old:last_activity',
+                                            f'{self.manager.stats_name}:old:processed_messages')
 
-            active_consumers = self.manager.get_active_consumers()
-            self.assertEqual(active_consumers, {b'consumer_1', b'consumer_2'})
-            mock_cleanup.assert_called_once()
+    def test_migrate_legacy_registry_nothing_to_migrate(self):
+        self.mock_redis.smembers.return_value = set()
+        self.assertEqual(self.manager.migrate_legacy_registry(), 0)
+        self.mock_redis.pipeline.assert_not_called()
 
     def test_start_stop_service(self):
+        self.mock_redis.smembers.return_value = set()
         with patch('threading.Thread') as mock_thread:
             self.manager.start_service()
             self.assertTrue(self.manager.running)
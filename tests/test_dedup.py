@@ -0,0 +1,95 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from src.dedup import KeyDedup, BucketDedup, get_dedup
+from src.shards import shard_names, shard_for
+
+
+class TestKeyDedup(unittest.TestCase):
+
+    def test_claim(self):
+        client = MagicMock()
+        dedup = KeyDedup('consumer:lock', 5)
+        self.assertIs(dedup.claim(client, 'c1', 'm1'), client.set.return_value)
+        client.set.assert_called_once_with('consumer:lock:m1', 'c1', nx=True, ex=5)
+        self.assertEqual(dedup.expire(client), [])
+        self.assertEqual(dedup.script_target('m1'), ('consumer:lock:m1', '', 5))
+
+
+class TestBucketDedup(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.dedup = BucketDedup('consumer:dedup', 10)
+
+    @patch('time.time', return_value=1005.0)
+    def test_claim_in_bucket_of_publish_time(self, mock_time):
+        # Test every consumer claims message in the same bucket - by its publish time, not by the local clock
+        self.dedup.claim(self.client, 'c1', 'm1', published_at=999.9)
+
+        self.client.hsetnx.assert_called_once_with('consumer:dedup:99', 'm1', 'c1')
+
+    def test_undated_message_is_claimed_by_its_key(self):
+        # Test consumers with clocks on both sides of a bucket boundary claim undated message in the same place
+        with patch('time.time', return_value=1009.99):
+            self.dedup.claim(self.client, 'c1', 'm2')
+            first = self.dedup.script_target('m2')
+        with patch('time.time', return_value=1010.01):
+            self.dedup.claim(self.client, 'c2', 'm2')
+            second = self.dedup.script_target('m2')
+
+        self.client.set.assert_any_call('consumer:dedup:id:m2', 'c1', nx=True, ex=10)
+        self.client.set.assert_any_call('consumer:dedup:id:m2', 'c2', nx=True, ex=10)
+        self.client.hsetnx.assert_not_called()
+        self.assertEqual(first, second)
+        self.assertEqual(first, ('consumer:dedup:id:m2', '', 10))
+        self.assertEqual(self.dedup.expire(self.client), [])
+
+    @patch('time.time', return_value=1005.0)
+    def test_one_expire_per_bucket(self, mock_time):
+        for message_id in ('m1', 'm2', 'm3'):
+            self.dedup.claim(self.client, 'c1', message_id, published_at=1001.0)
+            self.dedup.expire(self.client)
+
+        # Claims are remembered at least a window after the end of bucket
+        self.client.expireat.assert_called_once_with('consumer:dedup:100', 1020)
+
+    @patch('time.time', return_value=5000.0)
+    def test_old_message_bucket_is_not_expired_at_once(self, mock_time):
+        # Test bucket of late message lives a window from now, not from its publish time
+        self.dedup.claim(self.client, 'c1', 'm1', published_at=1001.0)
+        self.dedup.expire(self.client)
+        self.client.expireat.assert_called_once_with('consumer:dedup:100', 5010)
+
+    def test_recreated_bucket_is_expired_again(self):
+        # Test late message which recreates a bucket hash after it expired gets EXPIREAT again
+        with patch('time.time', return_value=1005.0):
+            self.dedup.claim(self.client, 'c1', 'm1', published_at=1001.0)
+            self.dedup.expire(self.client)
+        with patch('time.time', return_value=1025.0):
+            self.dedup.claim(self.client, 'c1', 'm2', published_at=1001.0)
+            self.dedup.expire(self.client)
+
+        self.client.expireat.assert_any_call('consumer:dedup:100', 1020)
+        self.client.expireat.assert_called_with('consumer:dedup:100', 1035)
+        self.assertEqual(self.client.expireat.call_count, 2)
+
+    @patch('time.time', return_value=1005.0)
+    def test_keys_in_slot_of_stream_shard(self, mock_time):
+        # Test dedup keys of a message have the hash tag of its stream shard (one slot for PROCESS_MESSAGE)
+        shard = shard_for(shard_names('messages:processed', 4), 'm1')
+        tag = shard[shard.index('{'):]
+        self.assertEqual(BucketDedup('consumer:dedup', 10, 4).script_target('m1', 1001.0)[0], f'consumer:dedup:{tag}:100')
+        self.assertEqual(BucketDedup('consumer:dedup', 10, 4).script_target('m1')[0], f'consumer:dedup:{tag}:id:m1')
+        self.assertEqual(KeyDedup('consumer:lock', 5, 4).script_target('m1')[0], f'consumer:lock:{tag}:m1')
+
+        dedup = BucketDedup('consumer:dedup', 10, 4)
+        dedup.claim(self.client, 'c1', 'm1', published_at=1001.0)
+        dedup.expire(self.client)
+        self.client.expireat.assert_called_once_with(f'consumer:dedup:{tag}:100', 1020)
+
+    def test_get_dedup(self):
+        self.assertIsInstance(get_dedup('bucket', 'lock', 'dedup', 5, 10), BucketDedup)
+        self.assertIsInstance(get_dedup('key', 'lock', 'dedup', 5, 10), KeyDedup)
+        with self.assertRaises(ValueError):
+            get_dedup('bloom', 'lock', 'dedup', 5, 10)
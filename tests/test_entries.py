@@ -0,0 +1,56 @@
+import json
+import unittest
+import zlib
+
+from src.entries import CompactLayout, decode_entry, entry_created_at, message_json, train_dictionary
+
+SAMPLES = [json.dumps({"message_id": f"id-{i}", "published_at": 1700000000.5 + i, "event": "click",
+                       "items": [{"sku": "sku-1", "qty": i}] * 3, "note": "hello " * 20}).encode() for i in range(50)]
+
+
+class TestEntries(unittest.TestCase):
+
+    def test_compact_fields_once(self):
+        layout = CompactLayout(compress_min=0)
+        fields = layout.build(b'{"message_id":"a"}', "c1", 0.5, 1700000000.1234)
+        self.assertEqual(fields, {"m": b'{"message_id":"a"}', "c": "c1", "r": 0.5, "t": 1700000000123})
+
+        entry = decode_entry(fields)
+        self.assertEqual(entry["message_id"], "a")
+        self.assertEqual(entry["processed_by"], "c1")
+        self.assertAlmostEqual(entry["created_at"], 1700000000.123)
+        self.assertEqual(entry["message"], {"message_id": "a", "processed_by": "c1", "random_property": 0.5})
+
+    def test_legacy_entry(self):
+        # Fields as they come from Redis
+        fields = {b"message_id": b"a", b"processed_by": b"c1", b"created_at": b"1700000000.5",
+                  b"processed_message": b'{"message_id": "a", "processed_by": "c1", "random_property": 0.5}'}
+        entry = decode_entry(fields)
+        self.assertEqual((entry["message_id"], entry["processed_by"], entry["created_at"]), ("a", "c1", 1700000000.5))
+        self.assertEqual(entry["message"]["random_property"], 0.5)
+
+    def test_compression_with_dictionary(self):
+        dictionary = train_dictionary(SAMPLES[:40])
+        self.assertIn(b'"message_id":', dictionary)
+        plain = CompactLayout(compress_min=64)
+        trained = CompactLayout(compress_min=64, dictionary=dictionary)
+        payload = SAMPLES[45]
+
+        without = plain.build(payload, "c1", 0.5, 1.0)
+        fields = trained.build(payload, "c1", 0.5, 1.0)
+        self.assertIn("z", fields)
+        self.assertNotIn("m", fields)
+        self.assertLess(len(fields["z"]), len(without["z"]))
+        self.assertEqual(message_json(fields, dictionary), payload)
+        # Without the dictionary it can't be read
+        with self.assertRaises(zlib.error):
+            message_json(fields)
+
+    def test_short_message_is_not_compressed(self):
+        fields = CompactLayout(compress_min=256).build(b'{"message_id":"a"}', "c1", 0.5, 1.0)
+        self.assertIn("m", fields)
+        self.assertEqual(entry_created_at(fields), 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
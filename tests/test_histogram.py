@@ -0,0 +1,52 @@
+import unittest
+
+from src.histogram import Histogram, BOUNDS, bucket_index, bucket_field, histograms_from_hash
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_bucket_index(self):
+        # Test latency goes to the first bucket whose upper bound is not less than it
+        self.assertEqual(bucket_index(0), 0)
+        self.assertEqual(BOUNDS[bucket_index(0.001)], 0.001)
+        self.assertEqual(BOUNDS[bucket_index(0.0011)], 0.00125)
+        self.assertEqual(bucket_index(1000), len(BOUNDS))
+
+    def test_relative_error(self):
+        # Test neighbour bounds are close enough to keep relative error small
+        for lower, upper in zip(BOUNDS, BOUNDS[1:]):
+            self.assertLess(upper / lower, 1.3)
+
+    def test_quantile(self):
+        histogram = Histogram()
+        for _ in range(98):
+            histogram.record(0.002)
+        histogram.record(0.5, count=2)
+
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.quantile(0.5), 0.002)
+        self.assertEqual(histogram.quantile(0.99), 0.5)
+        self.assertEqual(Histogram().quantile(0.99), 0.0)
+
+    def test_cumulative_and_since(self):
+        older = Histogram()
+        older.record(0.002)
+        newer = Histogram().merge(older)
+        newer.record(0.002)
+        newer.record(200)
+
+        buckets = newer.cumulative()
+        self.assertEqual(buckets[-1], ("+Inf", 3))
+        self.assertEqual(dict(buckets)["0.002"], 2)
+        self.assertEqual(newer.since(older).count, 2)
+
+    def test_histograms_from_hash(self):
+        index = bucket_index(0.01)
+        fields = {b'processed_messages': b'3', bucket_field('end_to_end', index).encode(): b'3',
+                  bucket_field('end_to_end', 'sum').encode(): b'0.03'}
+
+        histograms = histograms_from_hash(fields)
+
+        self.assertEqual(list(histograms), ['end_to_end'])
+        self.assertEqual(histograms['end_to_end'].counts[index], 3)
+        self.assertAlmostEqual(histograms['end_to_end'].sum, 0.03)
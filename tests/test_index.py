@@ -0,0 +1,67 @@
+import json
+import unittest
+from unittest.mock import MagicMock
+
+from src.index import MessageIndex
+from src.shards import shard_of
+
+
+class TestMessageIndex(unittest.TestCase):
+
+    def test_target(self):
+        index = MessageIndex('consumer:index', 600, 100)
+        self.assertEqual(index.target('m1', now=1050.0), ('consumer:index:10', 1700))
+
+        sharded = MessageIndex('consumer:index', 600, 100, shards=4)
+        key, _ = sharded.target('m1', now=1050.0)
+        # Bucket lives in the slot of the stream shard of the message
+        self.assertEqual(key, f"consumer:index:{{{shard_of('m1', 4)}}}:10")
+
+    def test_live_keys(self):
+        index = MessageIndex('consumer:index', 250, 100)
+        # The next bucket, the current one and every bucket the retention reaches, the newest first
+        self.assertEqual(index.keys(0, now=1050.0), ['consumer:index:11', 'consumer:index:10', 'consumer:index:9',
+                                                     'consumer:index:8'])
+
+    def test_lookup(self):
+        index = MessageIndex('consumer:index', 100, 100)
+        r = MagicMock()
+        hmget_pipe, xrange_pipe = MagicMock(), MagicMock()
+        r.pipeline.side_effect = [hmget_pipe, xrange_pipe]
+        # Buckets 11, 10, 9: m1 was redelivered - the newest bucket wins, m3 is not found
+        hmget_pipe.execute.return_value = [[None, None, None],
+                                           [b'1050000-1 c2', None, None],
+                                           [b'990000-0 c1', b'995000-0 c1', None]]
+        entry = {b'message_id': b'm2', b'processed_by': b'c1',
+                 b'processed_message': json.dumps({'message_id': 'm2', 'processed_by': 'c1'}).encode(),
+                 b'created_at': b'995.0'}
+        xrange_pipe.execute.return_value = [[], [(b'995000-0', entry)]]
+
+        result = index.lookup(r, ['m1', 'm2', 'm3'], ['messages:processed'], now=1050.0)
+
+        hmget_pipe.hmget.assert_any_call('consumer:index:10', ['m1', 'm2', 'm3'])
+        self.assertEqual(hmget_pipe.hmget.call_count, 3)
+        xrange_pipe.xrange.assert_any_call('messages:processed', min='1050000-1', max='1050000-1')
+        self.assertEqual(result['m1']['processed_by'], 'c2')
+        self.assertEqual(result['m1']['processed_at'], 1050.0)
+        # Entry of m1 is trimmed already
+        self.assertIsNone(result['m1']['entry'])
+        self.assertEqual(result['m2']['entry']['message_id'], 'm2')
+        self.assertIsNone(result['m3'])
+
+    def test_lookup_index_only(self):
+        index = MessageIndex('consumer:index', 0, 100)
+        r = MagicMock()
+        # Buckets 11 and 10, one ID per HMGET
+        r.pipeline.return_value.execute.return_value = [[None], [None], [b'1000000-0 c1'], [None]]
+
+        result = index.lookup(r, ['m1', 'm2'], ['messages:processed'], entries=False, chunk=1, now=1050.0)
+
+        # One HMGET per chunk of IDs and bucket, no point reads
+        self.assertEqual(r.pipeline.call_count, 1)
+        self.assertEqual(result['m1']['entry_id'], '1000000-0')
+        self.assertIsNone(result['m2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from src.instrument import Instrumentation
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_sampling(self):
+        instrument = Instrumentation("c1", sample_every=3)
+        sampled = [instrument.begin() for _ in range(9)]
+        self.assertEqual(sampled, [False, False, True] * 3)
+
+        instrument.sample_every = 0
+        self.assertFalse(instrument.begin())
+        self.assertEqual(instrument.clock(), 0.0)
+
+    def test_record_only_sampled(self):
+        instrument = Instrumentation("c1", sample_every=2)
+        for _ in range(4):
+            instrument.begin()
+            instrument.record("lock", instrument.clock())
+        summary = instrument.summary()
+        self.assertEqual(list(summary), ["lock"])
+        self.assertEqual(summary["lock"]["count"], 2)
+        self.assertIn("lock", instrument.report())
+
+    def test_write(self):
+        instrument = Instrumentation("c1", sample_every=1)
+        instrument.begin()
+        instrument.record("xadd", instrument.clock())
+        pipe = MagicMock()
+        instrument.write(pipe, "consumer:instrument:c1", ttl=60)
+        fields = pipe.hset.call_args.kwargs["mapping"]
+        self.assertEqual(fields["xadd:count"], 1)
+        self.assertEqual(fields["sample_every"], 1)
+        pipe.expire.assert_called_once_with("consumer:instrument:c1", 60)
+
+    def test_control(self):
+        instrument = Instrumentation("c1", sample_every=5)
+        instrument.control({b"sample_every": b"100", b"sample_every:c1": b"10", b"profile:c2": b"30"})
+        self.assertEqual(instrument.sample_every, 10)
+        self.assertIsNone(instrument.profile_request)
+
+        instrument.control({b"sample_every": b"100", b"profile:c1": b"0.5"})
+        self.assertEqual(instrument.sample_every, 100)
+        self.assertEqual(instrument.profile_request, 0.5)
+
+        # Nothing in the control hash - back to the setting of the process
+        instrument.control({})
+        self.assertEqual(instrument.sample_every, 5)
+
+    def test_profile_window(self):
+        with tempfile.TemporaryDirectory() as profile_dir:
+            instrument = Instrumentation("c1", profile_dir=profile_dir)
+            instrument.profile_request = 0.0
+            instrument.begin()
+            self.assertIsNotNone(instrument.profiler)
+            sum(range(1000))
+            # The window is over, the next message finishes it
+            instrument.begin()
+            self.assertIsNone(instrument.profiler)
+            self.assertTrue(os.path.exists(instrument.last_profile))
+            self.assertTrue(instrument.last_profile.startswith(profile_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+from collections import Counter
+
+from src.lanes import LaneScheduler, parse_lanes, lane_channel
+
+
+class TestLanes(unittest.TestCase):
+
+    def test_parse_lanes(self):
+        self.assertEqual(parse_lanes("high:8, bulk"), [("high", 8.0), ("bulk", 1.0)])
+        self.assertEqual(lane_channel("messages:published", "high"), "messages:published:lane:high")
+        for spec in ("high:0", "high,high", "a:b:1", ""):
+            with self.assertRaises(ValueError):
+                parse_lanes(spec)
+
+    def test_weighted_share(self):
+        # Test busy lanes are served in the ratio of their weights, in any window
+        scheduler = LaneScheduler(parse_lanes("high:3,bulk:1"))
+        for i in range(100):
+            scheduler.put("high", i, now=0.0)
+            scheduler.put("bulk", i, now=0.0)
+        served = [lane for lane, _, _ in scheduler.take(40, now=1.0)]
+        self.assertEqual(Counter(served[:8]), {"high": 6, "bulk": 2})
+        self.assertEqual(Counter(served), {"high": 30, "bulk": 10})
+        self.assertEqual(len(scheduler), 160)
+
+    def test_idle_lane_saves_no_credit(self):
+        # Test lane which was idle doesn't take everything when it comes back
+        scheduler = LaneScheduler(parse_lanes("high:1,bulk:1"))
+        for i in range(50):
+            scheduler.put("bulk", i, now=0.0)
+        scheduler.take(40, now=0.0)
+        for i in range(10):
+            scheduler.put("high", i, now=0.0)
+        served = [lane for lane, _, _ in scheduler.take(6, now=0.0)]
+        self.assertEqual(Counter(served), {"high": 3, "bulk": 3})
+
+    def test_priority_with_starvation(self):
+        # Test the higher lane goes first until a lower one waits too long, a late higher lane still wins
+        scheduler = LaneScheduler(parse_lanes("high,bulk"), policy="priority", starvation=0.2)
+        scheduler.put("bulk", "b1", now=0.0)
+        scheduler.put("high", "h1", now=0.0)
+        scheduler.put("high", "h2", now=0.15)
+        self.assertEqual(scheduler.next(now=0.1), ("high", "h1", 0.1))
+        # b1 waits 0.2 s, h2 only 0.05 s
+        self.assertEqual(scheduler.next(now=0.2)[:2], ("bulk", "b1"))
+        scheduler.put("bulk", "b2", now=0.2)
+        # Both are late, high wins
+        self.assertEqual(scheduler.next(now=0.5)[:2], ("high", "h2"))
+        self.assertEqual(scheduler.next(now=0.5)[:2], ("bulk", "b2"))
+        self.assertIsNone(scheduler.next())
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            LaneScheduler(parse_lanes("high"), policy="fifo")
+
+
+if __name__ == '__main__':
+    unittest.main()
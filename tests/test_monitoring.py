@@ -0,0 +1,115 @@
+import unittest
+import os
+import sys
+import redis
+from unittest.mock import MagicMock, patch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from monitoring import render_metrics, consumers_totals, processed_total
+from histogram import bucket_field, bucket_index
+
+
+class TestMonitoring(unittest.TestCase):
+
+    def setUp(self):
+        for name, value in (('processed_stream_shards', 1), ('stream_name', 'messages:processed')):
+            patcher = patch(f'monitoring.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.mock_redis = MagicMock()
+        self.mock_redis.zrange.return_value = [b'c1', b'c2']
+        self.mock_redis.xlen.return_value = 7
+        self.mock_redis.xinfo_stream.return_value = {'length': 7, 'entries-added': 12}
+        index = bucket_index(0.004)
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            {b'processed_messages': b'5', bucket_field('end_to_end', index).encode(): b'5',
+             bucket_field('end_to_end', 'sum').encode(): b'0.02'},
+            {b'processed_messages': b'2', b'lock_misses': b'5', bucket_field('end_to_end', index).encode(): b'2'},
+        ]
+        # Group hash has all of them (and of consumers which are gone)
+        self.mock_redis.hgetall.return_value = {
+            b'processed_messages': b'7', b'lock_misses': b'5', bucket_field('end_to_end', index).encode(): b'7',
+            bucket_field('end_to_end', 'sum').encode(): b'0.02'}
+
+    def test_render_metrics(self):
+        # Test per consumer counters and merged latency histogram are exposed in Prometheus format
+        text = render_metrics(self.mock_redis)
+
+        self.assertIn('processed_stream_length 7\n', text)
+        self.assertIn('processed_stream_entries_added_total 12\n', text)
+        self.assertIn('active_consumers 2\n', text)
+        self.assertIn('consumer_processed_messages_total{consumer="c1"} 5\n', text)
+        self.assertIn('consumer_lock_misses_total{consumer="c2"} 5\n', text)
+        self.assertIn('consumer_message_latency_seconds_bucket{stage="end_to_end",le="0.004"} 7\n', text)
+        self.assertIn('consumer_message_latency_seconds_bucket{stage="end_to_end",le="+Inf"} 7\n', text)
+        self.assertIn('consumer_message_latency_seconds_count{stage="publish_to_lock"} 0\n', text)
+        self.assertIn('consumer_group_processed_messages_total 7\n', text)
+        self.assertTrue(self.mock_redis.hgetall.call_args.args[0].endswith(':group'))
+
+    def test_counters_survive_consumer_leaving(self):
+        # Test group counters and latency buckets don't go down when a consumer leaves (no false counter reset)
+        self.mock_redis.zrange.return_value = [b'c1']
+        self.mock_redis.pipeline.return_value.execute.return_value = [self.mock_redis.pipeline.return_value.execute.return_value[0]]
+        text = render_metrics(self.mock_redis)
+        self.assertIn('active_consumers 1\n', text)
+        self.assertNotIn('consumer="c2"', text)
+        self.assertIn('consumer_group_processed_messages_total 7\n', text)
+        self.assertIn('consumer_message_latency_seconds_bucket{stage="end_to_end",le="+Inf"} 7\n', text)
+
+    def test_write_behind_metrics(self):
+        # Test queue depth and spill of consumers with write-behind are exposed
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            {b'processed_messages': b'5', b'writebehind:queued': b'40', b'writebehind:spilled': b'12',
+             b'writebehind:spilled_bytes': b'1200'},
+            {b'processed_messages': b'2'},
+        ]
+        text = render_metrics(self.mock_redis)
+        self.assertIn('consumer_writebehind_queued{consumer="c1"} 40\n', text)
+        self.assertIn('consumer_writebehind_entries_total{consumer="c1",event="spilled"} 12\n', text)
+        self.assertIn('consumer_writebehind_spilled_bytes_total{consumer="c1"} 1200\n', text)
+        self.assertNotIn('consumer_writebehind_queued{consumer="c2"}', text)
+
+    def test_lane_metrics(self):
+        # Test lane latencies are exposed by lane, not as stages of the message latency
+        index = bucket_index(0.004)
+        self.mock_redis.pipeline.return_value.execute.return_value = [
+            {b'processed_messages': b'5', b'lane:high:processed_messages': b'3', b'lane:bulk:lock_misses': b'1',
+             bucket_field('end_to_end@high', index).encode(): b'3'},
+            {b'lane:high:processed_messages': b'2', bucket_field('end_to_end@high', index).encode(): b'2'},
+        ]
+        self.mock_redis.hgetall.return_value = {
+            b'processed_messages': b'5', b'lane:high:processed_messages': b'5', b'lane:bulk:lock_misses': b'1',
+            bucket_field('end_to_end@high', index).encode(): b'5'}
+        text = render_metrics(self.mock_redis)
+        self.assertIn('consumer_lane_latency_seconds_bucket{lane="high",le="0.004"} 5\n', text)
+        self.assertIn('consumer_lane_messages_total{lane="high",event="processed_messages"} 5\n', text)
+        self.assertIn('consumer_lane_messages_total{lane="bulk",event="lock_misses"} 1\n', text)
+        self.assertNotIn('stage="end_to_end@high"', text)
+
+    @patch('time.time', return_value=1700000010.0)
+    def test_last_entry_age(self, mock_time):
+        # Test age of the newest entry is taken from both entry layouts
+        self.mock_redis.xrevrange.return_value = [(b'1-0', {b'm': b'{}', b'c': b'c1', b'r': b'0.5', b't': b'1700000007500'})]
+        self.assertIn('processed_stream_last_entry_age_seconds 2.500\n', render_metrics(self.mock_redis))
+        self.mock_redis.xrevrange.return_value = [(b'1-0', {b'created_at': b'1700000009.0'})]
+        self.assertIn('processed_stream_last_entry_age_seconds 1.000\n', render_metrics(self.mock_redis))
+
+    def test_consumers_totals(self):
+        totals = consumers_totals({'c1': {b'processed_messages': b'5'}, 'c2': {b'processed_messages': b'2'}})
+        self.assertEqual(totals['processed_messages'], 7)
+        self.assertEqual(totals['decode_errors'], 0)
+
+    def test_processed_total_survives_trimming(self):
+        # Test rate is based on entries ever added, not on length of trimmed stream
+        self.assertEqual(processed_total(self.mock_redis), 12)
+        self.mock_redis.xinfo_stream.return_value = {'length': 7}
+        self.assertEqual(processed_total(self.mock_redis), 7)
+
+    @patch('monitoring.processed_stream_shards', 3)
+    def test_processed_total_of_shards(self):
+        # Test shards are summed up, shard which got nothing yet doesn't break the rate
+        self.mock_redis.xinfo_stream.side_effect = [{'length': 1, 'entries-added': 4}, redis.ResponseError('no such key'),
+                                                    {'length': 2, 'entries-added': 5}]
+        self.assertEqual(processed_total(self.mock_redis), 9)
+        self.assertEqual([c.args[0] for c in self.mock_redis.xinfo_stream.call_args_list],
+                         ['messages:processed:{0}', 'messages:processed:{1}', 'messages:processed:{2}'])
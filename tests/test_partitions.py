@@ -0,0 +1,46 @@
+import unittest
+
+from src.partitions import assign, PartitionSubscription
+
+
+class TestAssign(unittest.TestCase):
+
+    def test_every_partition_has_one_owner(self):
+        assignment = assign(['c1', 'c2', 'c3'], 12)
+        self.assertEqual(sorted(p for partitions in assignment.values() for p in partitions), list(range(12)))
+        self.assertEqual(assignment, assign(['c3', 'c1', 'c2', 'c1'], 12))
+        self.assertEqual(assign([], 4), {})
+
+    def test_balanced(self):
+        for members in (['c1', 'c2', 'c3'], [f'consumer-{i}' for i in range(7)]):
+            sizes = [len(partitions) for partitions in assign(members, 8).values()]
+            self.assertLessEqual(max(sizes) - min(sizes), 1)
+            self.assertEqual(sum(sizes), 8)
+
+    def test_few_partitions_move(self):
+        # Test rendezvous hashing keeps most of partitions of the others in place
+        members = [f'consumer-{i}' for i in range(10)]
+        before = assign(members, 100)
+        after = assign(members[1:], 100)
+        moved = sum(len(set(before[m]) - set(after[m])) for m in members[1:])
+        self.assertLess(moved, 20)
+
+
+class TestPartitionSubscription(unittest.TestCase):
+
+    def test_new_at_once_lost_after_grace(self):
+        subscription = PartitionSubscription(['ch:{0}', 'ch:{1}', 'ch:{2}'], grace=10)
+        self.assertEqual(subscription.update({0, 1}, now=100), (['ch:{0}', 'ch:{1}'], []))
+        # Partition 1 moved away, partition 2 came
+        self.assertEqual(subscription.update({0, 2}, now=105), (['ch:{2}'], []))
+        self.assertEqual(subscription.owned, {0, 1, 2})
+        self.assertEqual(subscription.update({0, 2}, now=114), ([], []))
+        self.assertEqual(subscription.update({0, 2}, now=115), ([], ['ch:{1}']))
+        self.assertEqual(subscription.owned, {0, 2})
+
+    def test_partition_coming_back_is_kept(self):
+        subscription = PartitionSubscription(['ch:{0}', 'ch:{1}'], grace=10)
+        subscription.update({0, 1}, now=100)
+        subscription.update({0}, now=101)
+        self.assertEqual(subscription.update({0, 1}, now=102), ([], []))
+        self.assertEqual(subscription.update({0, 1}, now=200), ([], []))
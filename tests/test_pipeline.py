@@ -0,0 +1,66 @@
+import queue
+import threading
+import unittest
+
+from src.pipeline import Stage, StagePipeline, load_function
+from src.transforms import checksum, has_published_at
+
+
+def double(item):
+    return item * 2
+
+
+class TestStagePipeline(unittest.TestCase):
+
+    def run_pipeline(self, stages, items, batch_size=10):
+        batches = []
+        pipeline = StagePipeline(stages, batches.append, batch_size=batch_size, linger=0.001, queue_size=5)
+        pipeline.start()
+        for item in items:
+            pipeline.put(item)
+        pipeline.close()
+        return batches, pipeline.snapshot()
+
+    def test_stages_filter_and_errors(self):
+        stages = [Stage("odd", lambda n: n if n % 2 else None), Stage("invert", lambda n: 10 // (n - 5), workers=3)]
+        batches, counters = self.run_pipeline(stages, range(10))
+
+        self.assertEqual(sorted(n for batch in batches for n in batch), [-5, -3, 2, 5])
+        self.assertTrue(all(len(batch) <= 10 for batch in batches))
+        self.assertEqual((counters["odd"]["in"], counters["odd"]["out"], counters["odd"]["dropped"]), (10, 5, 5))
+        self.assertEqual(counters["invert"]["errors"], 1)
+        self.assertEqual(counters["sink"]["in"], 4)
+
+    def test_process_stage_keeps_order(self):
+        batches, counters = self.run_pipeline([Stage("double", double, executor="process", workers=2)], range(50))
+        self.assertEqual([n for batch in batches for n in batch], [n * 2 for n in range(50)])
+        self.assertEqual(counters["double"]["out"], 50)
+
+    def test_backpressure(self):
+        # Test full queues block the intake instead of growing
+        release = threading.Event()
+        pipeline = StagePipeline([Stage("slow", lambda n: release.wait() and n, queue_size=2)], lambda batch: None,
+                                 queue_size=2)
+        pipeline.start()
+        pipeline.put(1)
+        pipeline.put(2)
+        pipeline.put(3)
+        with self.assertRaises(queue.Full):
+            pipeline.stages[0].queue.put(4, timeout=0.05)
+        release.set()
+        pipeline.close()
+
+    def test_unknown_executor(self):
+        with self.assertRaises(ValueError):
+            Stage("x", double, executor="gpu")
+
+    def test_load_function(self):
+        self.assertIs(load_function("src.transforms:checksum"), checksum)
+        with self.assertRaises(ValueError):
+            load_function("src.transforms")
+
+    def test_example_stages(self):
+        self.assertFalse(has_published_at({'message_id': '1'}))
+        message = checksum({'message_id': '1'}, rounds=2)
+        self.assertEqual(len(message['checksum']), 64)
+        self.assertEqual(message, checksum({'message_id': '1'}, rounds=2))
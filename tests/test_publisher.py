@@ -0,0 +1,106 @@
+import json
+import os
+import sys
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from publisher import LoadProfile, message_factory, generate_load, publish, check_lane
+
+
+class TestLoadProfile(unittest.TestCase):
+
+    def test_rates(self):
+        self.assertEqual(LoadProfile("constant", 100, 10).rate_at(7), 100)
+        step = LoadProfile("step", 100, 60, max_rate=250, step_rate=100, step_seconds=10)
+        self.assertEqual([step.rate_at(t) for t in (0, 9.9, 10, 25, 50)], [100, 100, 200, 250, 250])
+        ramp = LoadProfile("ramp", 100, 10, max_rate=1100)
+        self.assertEqual([ramp.rate_at(t) for t in (0, 5, 10, 20)], [100, 600, 1100, 1100])
+
+    def test_bad_profiles(self):
+        # Test ramp and step which would divide by zero are refused
+        with self.assertRaises(ValueError):
+            LoadProfile("ramp", 100, 0, max_rate=1000)
+        with self.assertRaises(ValueError):
+            LoadProfile("step", 100, 60, step_rate=100, step_seconds=0)
+
+    def test_schedule_is_open_loop(self):
+        # Test intended send times depend only on the profile
+        times = list(LoadProfile("constant", 10, 1).schedule())
+        self.assertEqual(len(times), 10)
+        self.assertAlmostEqual(times[1] - times[0], 0.1)
+
+    def test_schedule_share_and_phase(self):
+        # Test workers get their part of the rate and interleave
+        profile = LoadProfile("constant", 100, 1)
+        first, second = list(profile.schedule(0.5, 0)), list(profile.schedule(0.5, 0.5))
+        self.assertEqual((len(first), len(second)), (50, 50))
+        self.assertAlmostEqual(second[0] - first[0], 0.01)
+
+
+class TestMessageFactory(unittest.TestCase):
+
+    def test_payload_size(self):
+        make = message_factory("flat", 512)
+        message = make(time.time())
+        self.assertIn("event", message)
+        self.assertAlmostEqual(len(json.dumps(message, separators=(",", ":"))), 512, delta=4)
+        self.assertNotEqual(make(time.time())["message_id"], message["message_id"])
+
+    def test_unknown_shape(self):
+        with self.assertRaises(ValueError):
+            message_factory("huge", 0)
+
+
+class TestPublish(unittest.TestCase):
+
+    @patch('publisher.ingest_backend', 'pubsub')
+    @patch('publisher.pubsub_channel', 'messages:published')
+    @patch('publisher.pubsub_partitions', 3)
+    def test_partition_channel(self):
+        # Test message goes only to the partition of its message_id
+        pipe = MagicMock()
+        publish(pipe, b'{}', 'm4')
+        pipe.publish.assert_called_once_with('messages:published:{2}', b'{}')
+
+    @patch('publisher.ingest_backend', 'pubsub')
+    @patch('publisher.pubsub_channel', 'messages:published')
+    @patch('publisher.pubsub_partitions', 1)
+    @patch('publisher.priority_lanes', 'high:8,bulk:1')
+    def test_lane_channel(self):
+        # Test message of a lane goes to the lane channel, unknown lane is refused
+        pipe = MagicMock()
+        publish(pipe, b'{}', 'm4', 'bulk')
+        pipe.publish.assert_called_once_with('messages:published:lane:bulk', b'{}')
+        check_lane('high')
+        with self.assertRaises(ValueError):
+            check_lane('low')
+
+    @patch('publisher.ingest_backend', 'pubsub')
+    @patch('publisher.pubsub_channel', 'messages:published')
+    @patch('publisher.pubsub_partitions', 1)
+    @patch('publisher.priority_lanes', 'high:8,bulk:1')
+    def test_default_lane(self):
+        # Test message without lane goes to the lowest lane, consumers don't listen to the base channel with LANES
+        pipe = MagicMock()
+        publish(pipe, b'{}', 'm4')
+        pipe.publish.assert_called_once_with('messages:published:lane:bulk', b'{}')
+
+
+class TestGenerateLoad(unittest.TestCase):
+
+    @patch('publisher.pubsub_partitions', 1)
+    @patch('publisher.message_codec', 'json')
+    @patch('publisher.redis.Redis')
+    def test_generate_load(self, mock_redis):
+        # Test every scheduled message is published and its latency is recorded
+        pipe = mock_redis.return_value.pipeline.return_value
+
+        result = generate_load(LoadProfile("constant", 200, 0.1), 1.0, 0.0, "id", 0, max_batch=5,
+                               report_interval=1)
+
+        self.assertEqual(result["sent"], 20)
+        self.assertEqual(result["latency"].count, 20)
+        self.assertEqual(pipe.publish.call_count + pipe.xadd.call_count, 20)
+        self.assertEqual(sum(sent for sent, _ in result["intervals"].values()), 20)
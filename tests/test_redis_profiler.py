@@ -0,0 +1,102 @@
+import unittest
+import os
+import sys
+from unittest.mock import MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+from redis_profiler import family_of, command_costs, family_memory, slowlog_since, cost_report, OwnCalls, FAMILIES
+
+
+def snapshot(at, processed, attempts, calls, usec, cpu_usec, used_memory):
+    commands = {family: {"calls": 0, "usec": 0} for family in FAMILIES}
+    for family in calls:
+        commands[family] = {"calls": calls[family], "usec": usec[family]}
+    return {"time": at, "commands": commands, "cpu_usec": cpu_usec, "used_memory": used_memory, "clients": 3,
+            "pubsub_buffer": 0, "processed": processed, "attempts": attempts}
+
+
+class TestRedisProfiler(unittest.TestCase):
+
+    def test_family_of(self):
+        self.assertEqual(family_of("set"), "locks")
+        self.assertEqual(family_of("HSETNX"), "locks")
+        self.assertEqual(family_of("evalsha"), "script")
+        self.assertEqual(family_of("hincrby"), "stats")
+        self.assertEqual(family_of("zadd"), "ids")
+        self.assertEqual(family_of("xinfo|stream"), "stream")
+        self.assertEqual(family_of("publish"), "pubsub")
+        self.assertEqual(family_of("client|list"), "other")
+
+    def test_command_costs(self):
+        costs = command_costs({"cmdstat_set": {"calls": 10, "usec": 30}, "cmdstat_expire": {"calls": 2, "usec": 2},
+                               "cmdstat_xadd": {"calls": 5, "usec": 40}, "cmdstat_info": {"calls": 1, "usec": 9}})
+        self.assertEqual(costs["locks"], {"calls": 12, "usec": 32})
+        self.assertEqual(costs["stream"], {"calls": 5, "usec": 40})
+        self.assertEqual(costs["other"], {"calls": 1, "usec": 9})
+        self.assertEqual(costs["stats"], {"calls": 0, "usec": 0})
+
+    def test_own_calls_go_to_other(self):
+        r = MagicMock()
+        pipe = r.pipeline.return_value
+        pipe.command_stack = [(("HGETALL", "stats:c1"), {}), (("HGETALL", "stats:c2"), {})]
+        pipe.transaction = True
+        own = OwnCalls(r)
+        r.execute_command("XINFO STREAM", "messages:processed")
+        r.execute_command("EXISTS", "ids")
+        r.pipeline().execute()
+        self.assertEqual(own.calls, {"xinfo|stream": 1, "exists": 1, "hgetall": 2, "multi": 1, "exec": 1})
+
+        costs = command_costs({"cmdstat_hgetall": {"calls": 2, "usec": 10},
+                               "cmdstat_xinfo|stream": {"calls": 1, "usec": 4},
+                               "cmdstat_hincrby": {"calls": 10, "usec": 20},
+                               "cmdstat_xadd": {"calls": 10, "usec": 50}}, own.calls)
+        # Consumers wrote stats and the stream, i only read them
+        self.assertEqual(costs["stats"], {"calls": 10, "usec": 20})
+        self.assertEqual(costs["stream"], {"calls": 10, "usec": 50})
+        self.assertEqual(costs["other"], {"calls": 3, "usec": 14})
+
+    def test_family_memory(self):
+        r = MagicMock()
+        r.scan_iter.return_value = iter([b"lock:1", b"lock:2", b"lock:3", b"lock:4"])
+        r.exists.side_effect = lambda name: name == "ids"
+        r.pipeline.return_value.execute.side_effect = [[100, 60], [500]]
+        memory = family_memory(r, {"locks": ["lock:*"], "ids": ["ids", "legacy"]}, sample=2)
+        # 2 of 4 keys are measured, the rest is estimated
+        self.assertEqual(memory["locks"], {"keys": 4, "bytes": 320})
+        self.assertEqual(memory["ids"], {"keys": 1, "bytes": 500})
+
+    def test_slowlog_since(self):
+        r = MagicMock()
+        r.slowlog_get.return_value = [
+            {"id": 7, "duration": 900, "command": b"XRANGE messages:processed - +"},
+            {"id": 6, "duration": 300, "command": b"SET consumer:lock:a c1 NX EX 5"},
+            {"id": 5, "duration": 5000, "command": b"KEYS *"},
+        ]
+        slowlog = slowlog_since(r, last_id=5)
+        self.assertEqual(set(slowlog), {"stream", "locks"})
+        self.assertEqual(slowlog["stream"]["slowest_usec"], 900)
+
+    def test_cost_report(self):
+        first = snapshot(0, 100, 300, {"locks": 100, "stream": 50}, {"locks": 100, "stream": 200}, 1000, 5000)
+        last = snapshot(10, 200, 600, {"locks": 400, "stream": 150}, {"locks": 400, "stream": 600}, 3000, 7000)
+        report = cost_report(first, last, {"locks": {"keys": 0, "bytes": 0}},
+                             {"locks": {"keys": 100, "bytes": 8000}}, {})
+        self.assertIn("Processed 100 messages (300 lock attempts)", report)
+        locks = next(line for line in report.splitlines() if line.startswith("locks"))
+        # 300 calls, 300 usec and 8000 bytes for 100 messages
+        self.assertEqual(locks.split()[1:8], ["300", "3.00", "300", "3.00", "100", "8000", "80.0"])
+        self.assertIn("20.0 usec/msg", report)
+
+    def test_script_is_not_counted_twice(self):
+        # Test SET and XADD run by EVALSHA are in their families, EVALSHA is not added to the total
+        first = snapshot(0, 0, 0, {}, {}, 0, 0)
+        last = snapshot(10, 100, 100, {"locks": 100, "stream": 100, "script": 100},
+                        {"locks": 100, "stream": 200, "script": 500}, 1000, 0)
+        report = cost_report(first, last, {}, {}, {})
+        total = next(line for line in report.splitlines() if line.startswith("total"))
+        self.assertEqual(total.split()[1:5], ["200", "2.00", "300", "3.00"])
+        self.assertEqual(family_of("script|load"), "other")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+
+from src.segments import SegmentWriter, segment_paths, iter_segment, iter_records, record_offsets, HEADER
+
+
+class TestSegments(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def write(self, records, segment_bytes=1024 * 1024):
+        writer = SegmentWriter(self.directory, segment_bytes)
+        for arrived, payload in records:
+            writer.write(arrived, payload)
+        writer.close()
+        return writer
+
+    def test_roundtrip_and_roll(self):
+        records = [(1000 + i, b'{"message_id": "%d"}' % i * (i + 1)) for i in range(20)]
+        writer = self.write(records, segment_bytes=200)
+        self.assertEqual(writer.records, 20)
+
+        paths = segment_paths(self.directory)
+        self.assertGreater(len(paths), 1)
+        # Segments are named by arrival of their first record
+        self.assertEqual(os.path.basename(paths[0]), f"{1000:020d}.seg")
+        read = [(arrived, bytes(payload)) for arrived, payload in iter_records(paths)]
+        self.assertEqual(read, records)
+
+    def test_payload_is_view_of_map(self):
+        self.write([(1, b"abc")])
+        (_, payload), = iter_segment(segment_paths(self.directory)[0])
+        self.assertIsInstance(payload, memoryview)
+        self.assertEqual(payload.tobytes(), b"abc")
+
+    def test_torn_tail(self):
+        self.write([(1, b"first"), (2, b"second")])
+        path = segment_paths(self.directory)[0]
+        with open(path, "ab") as file:
+            file.write(HEADER.pack(3, 100) + b"torn")
+        self.assertEqual([bytes(payload) for _, payload in iter_segment(path)], [b"first", b"second"])
+
+    def test_read_by_ranges(self):
+        # Test ranges between record boundaries read every whole record once, the torn tail is not in any range
+        records = [(i, b"x" * i) for i in range(1, 11)]
+        self.write(records)
+        path = segment_paths(self.directory)[0]
+        with open(path, "ab") as file:
+            file.write(HEADER.pack(11, 100) + b"torn")
+        offsets = record_offsets(path, 30)
+        self.assertGreater(len(offsets), 2)
+        read = [(arrived, bytes(payload)) for start, stop in zip(offsets, offsets[1:])
+                for arrived, payload in iter_segment(path, start, stop)]
+        self.assertEqual(read, records)
+
+    def test_not_a_segment(self):
+        with open(os.path.join(self.directory, "x.seg"), "wb") as file:
+            file.write(b"something else")
+        with self.assertRaises(ValueError):
+            list(iter_records(segment_paths(self.directory)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+from unittest.mock import MagicMock
+
+from src.shards import shard_names, shard_of, shard_for, entry_key, iter_merged, MergedReader
+
+
+def fake_xrange(streams):
+    # XRANGE of in-memory streams: {name: [(id, fields)]}, min may be exclusive "(id"
+    def xrange(name, min='-', max='+', count=None):
+        entries = streams.get(name, [])
+        if min.startswith('('):
+            entries = [e for e in entries if entry_key(e[0]) > entry_key(min[1:])]
+        elif min != '-':
+            entries = [e for e in entries if entry_key(e[0]) >= entry_key(min)]
+        return entries[:count]
+    return xrange
+
+
+class TestShards(unittest.TestCase):
+
+    def test_shard_names(self):
+        self.assertEqual(shard_names('messages:processed', 1), ['messages:processed'])
+        self.assertEqual(shard_names('messages:processed', 2), ['messages:processed:{0}', 'messages:processed:{1}'])
+
+    def test_shard_of_is_stable(self):
+        # Test every process puts the same message to the same shard (CRC32, not randomized hash())
+        self.assertEqual(shard_of('abc', 8), shard_of(b'abc', 8))
+        self.assertEqual(shard_of('abc', 8), 2)
+        self.assertEqual(shard_of('abc', 1), 0)
+        self.assertEqual(shard_of(None, 8), 0)
+        names = shard_names('s', 4)
+        self.assertEqual(len({shard_for(names, str(i)) for i in range(100)}), 4)
+
+    def test_iter_merged(self):
+        r = MagicMock()
+        r.xrange.side_effect = fake_xrange({
+            'a': [(b'1-0', {'n': 1}), (b'3-0', {'n': 3}), (b'5-0', {'n': 5})],
+            'b': [(b'2-0', {'n': 2}), (b'3-1', {'n': 4})],
+        })
+        merged = list(iter_merged(r, ['a', 'b'], count=2))
+        self.assertEqual([fields['n'] for _, _, fields in merged], [1, 2, 3, 4, 5])
+        self.assertEqual(merged[1][:2], ('b', b'2-0'))
+
+    def fake_pipeline(self, streams, now):
+        # Pipeline of TIME (seconds of `now`, one by one) and XRANGE of in-memory streams
+        calls = []
+        r = MagicMock()
+        pipe = r.pipeline.return_value
+        pipe.time.side_effect = lambda: calls.append(None)
+        pipe.xrange.side_effect = lambda *args, **kwargs: calls.append((args, kwargs))
+
+        def execute():
+            results = [(now.pop(0), 0) if call is None else fake_xrange(streams)(*call[0], **call[1])
+                       for call in calls]
+            calls.clear()
+            return results
+        pipe.execute.side_effect = execute
+        return r
+
+    def test_merged_reader_holds_back_entries_of_full_page(self):
+        # Test entry of caught up shard is not returned before older entries of shard with more pages
+        streams = {'a': [(b'1-0', {}), (b'2-0', {}), (b'5-0', {})], 'b': [(b'3-0', {})]}
+        reader = MergedReader(self.fake_pipeline(streams, now=[100] * 3), ['a', 'b'], count=2)
+
+        self.assertEqual([entry_id for _, entry_id, _ in reader.read()], [b'1-0', b'2-0'])
+        self.assertEqual([entry_id for _, entry_id, _ in reader.read()], [b'3-0', b'5-0'])
+        self.assertEqual(reader.read(), [])
+
+    def test_merged_reader_holds_back_entries_newer_than_read(self):
+        # Test entry added to a shard after it was read doesn't come after newer entries of other shards
+        streams = {'a': [(b'1000-0', {})], 'b': [(b'2000-0', {}), (b'4500-0', {})]}
+        reader = MergedReader(self.fake_pipeline(streams, now=[4, 6]), ['a', 'b'], count=10)
+
+        self.assertEqual([entry_id for _, entry_id, _ in reader.read()], [b'1000-0', b'2000-0'])
+        # XADD to `a` between the reads of `a` and `b`
+        streams['a'].append((b'4000-0', {}))
+        self.assertEqual([entry_id for _, entry_id, _ in reader.read()], [b'4000-0', b'4500-0'])
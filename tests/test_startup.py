@@ -0,0 +1,39 @@
+import queue
+import time
+import unittest
+
+from src.startup import StartupReporter, GroupStartup, stagger
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_stagger(self):
+        self.assertEqual([stagger(i, 10) for i in range(3)], [0.0, 0.1, 0.2])
+        self.assertEqual(stagger(5, 0), 0.0)
+
+    def test_reporter_reports_once(self):
+        events = queue.Queue()
+        reporter = StartupReporter(events, ["a", "b"])
+        reporter.report("subscribed")
+        reporter.report("subscribed")
+        self.assertEqual(events.qsize(), 1)
+        event, consumer_ids, _ = events.get()
+        self.assertEqual((event, consumer_ids), ("subscribed", ["a", "b"]))
+
+    def test_readiness_barrier(self):
+        events = queue.Queue()
+        startup = GroupStartup(events, expected=3, started_at=time.time() - 1)
+        StartupReporter(events, ["a", "b"]).report("subscribed")
+        StartupReporter(events, ["c"]).report("first_message")
+        # Not everybody is subscribed yet
+        self.assertFalse(startup.wait_ready(timeout=1.2))
+        self.assertEqual(set(startup.subscribed), {"a", "b"})
+        self.assertEqual(set(startup.first_message), {"c"})
+        self.assertTrue(all(seconds >= 1 for seconds in startup.subscribed.values()))
+
+        StartupReporter(events, ["c"]).report("subscribed")
+        self.assertTrue(startup.wait_ready(timeout=60))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+from unittest.mock import MagicMock
+
+from src.histogram import bucket_field, bucket_index
+from src.stats import StatsAccumulator, stats_key, group_stats_key
+
+
+class TestStatsAccumulator(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = StatsAccumulator(stats_key('consumer:stats', 'c1'), flush_interval=60, flush_count=3)
+
+    def test_due_by_count(self):
+        # Test flush is due when enough events are accumulated
+        self.assertFalse(self.stats.due())
+        self.stats.add(processed_messages=1)
+        self.stats.add(lock_misses=1)
+        self.assertFalse(self.stats.due())
+        self.stats.add(processed_messages=1)
+        self.assertTrue(self.stats.due())
+
+    def test_due_by_interval(self):
+        # Test flush is due when flush_interval passed, but only if there is something to flush
+        self.stats.flush_interval = 0
+        self.assertFalse(self.stats.due())
+        self.stats.add(decode_errors=1)
+        self.assertTrue(self.stats.due())
+
+    def test_flush(self):
+        # Test nonzero counters are queued into pipeline and reset
+        pipe = MagicMock()
+        self.stats.add(processed_messages=2, bytes_processed=40, lock_misses=0)
+
+        self.stats.flush(pipe)
+
+        pipe.hincrby.assert_any_call('consumer:stats:c1', 'processed_messages', 2)
+        pipe.hincrby.assert_any_call('consumer:stats:c1', 'bytes_processed', 40)
+        self.assertEqual(pipe.hincrby.call_count, 2)
+        pipe.hset.assert_not_called()
+        self.assertEqual((self.stats.counters, self.stats.pending), ({}, 0))
+
+    def test_flush_to_group(self):
+        # Test the same counters and buckets go to the group hash too
+        pipe = MagicMock()
+        stats = StatsAccumulator(stats_key('consumer:stats', 'c1'), 60, 3, group_stats_key('consumer:stats'))
+        stats.add(processed_messages=2)
+        stats.observe(end_to_end=0.01)
+
+        stats.flush(pipe)
+
+        field = bucket_field('end_to_end', bucket_index(0.01))
+        for key in ('consumer:stats:c1', 'consumer:stats:group'):
+            pipe.hincrby.assert_any_call(key, 'processed_messages', 2)
+            pipe.hincrby.assert_any_call(key, field, 1)
+        self.assertEqual(pipe.hincrby.call_count, 4)
+
+    def test_observe(self):
+        # Test latencies are flushed as bucket counts and sums of stages
+        pipe = MagicMock()
+        self.stats.observe(end_to_end=0.01, lock_to_xadd=-0.5)
+        self.stats.observe(end_to_end=0.01)
+
+        self.stats.flush(pipe)
+
+        pipe.hincrby.assert_any_call('consumer:stats:c1', bucket_field('end_to_end', bucket_index(0.01)), 2)
+        pipe.hincrby.assert_any_call('consumer:stats:c1', bucket_field('lock_to_xadd', 0), 1)
+        pipe.hincrbyfloat.assert_any_call('consumer:stats:c1', 'latency:end_to_end:sum', 0.02)
+        self.assertEqual(self.stats.latencies, {})
@@ -0,0 +1,98 @@
+import unittest
+import signal
+from unittest.mock import patch, MagicMock
+from src.supervisor import ScalingPolicy, ConsumerSupervisor
+
+
+class TestScalingPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = ScalingPolicy(min_size=1, max_size=4, step=1, up_backlog=1000, down_backlog=10,
+                                    down_checks=2, cooldown=30)
+
+    def test_grow_on_backlog(self):
+        self.assertEqual(self.policy.decide(2, 5000, now=100), 3)
+
+    def test_cooldown(self):
+        self.assertEqual(self.policy.decide(2, 5000, now=100), 3)
+        self.assertEqual(self.policy.decide(3, 5000, now=110), 3)
+        self.assertEqual(self.policy.decide(3, 5000, now=131), 4)
+
+    def test_max_size(self):
+        self.assertEqual(self.policy.decide(4, 5000, now=100), 4)
+
+    def test_shrink_after_calm_checks(self):
+        # Hysteresis: one calm check is not enough, backlog between thresholds resets the counter
+        self.assertEqual(self.policy.decide(3, 0, now=100), 3)
+        self.assertEqual(self.policy.decide(3, 500, now=105), 3)
+        self.assertEqual(self.policy.decide(3, 0, now=110), 3)
+        self.assertEqual(self.policy.decide(3, 0, now=115), 2)
+
+    def test_min_size(self):
+        self.assertEqual(self.policy.decide(1, 0, now=100), 1)
+        self.assertEqual(self.policy.decide(1, 0, now=105), 1)
+
+    def test_out_of_bounds_ignores_cooldown(self):
+        self.assertEqual(self.policy.decide(2, 5000, now=100), 3)
+        self.assertEqual(self.policy.decide(0, 500, now=101), 1)
+
+
+class TestConsumerSupervisor(unittest.TestCase):
+
+    @patch('src.supervisor.redis.Redis')
+    def setUp(self, mock_redis):
+        self.mock_redis = mock_redis.return_value
+        self.spawned = []
+
+        def spawn():
+            worker = MagicMock(pid=1000 + len(self.spawned))
+            worker.is_alive.return_value = True
+            self.spawned.append(worker)
+            return worker
+
+        self.supervisor = ConsumerSupervisor('localhost', 6379, spawn=spawn, interval=0)
+
+    def test_respawn_crashed_worker(self):
+        self.supervisor.scale_to(2)
+        self.spawned[0].is_alive.return_value = False
+
+        self.supervisor.reap()
+
+        self.assertEqual(len(self.spawned), 3)
+        self.assertEqual(self.supervisor.workers, [self.spawned[2], self.spawned[1]])
+
+    @patch('src.supervisor.os.kill')
+    def test_retired_worker_drains(self, mock_kill):
+        self.supervisor.scale_to(2)
+        self.supervisor.scale_to(1)
+
+        mock_kill.assert_called_once_with(1001, signal.SIGUSR2)
+        self.assertIn(self.spawned[1], self.supervisor.retiring)
+
+        self.spawned[1].is_alive.return_value = False
+        self.supervisor.reap()
+        self.assertEqual(self.supervisor.retiring, {})
+        self.spawned[1].terminate.assert_not_called()
+
+    @patch('src.supervisor.os.kill')
+    def test_retired_worker_terminated_after_timeout(self, mock_kill):
+        self.supervisor.scale_to(2)
+        self.supervisor.scale_to(1)
+        self.supervisor.retiring[self.spawned[1]] = 0
+
+        self.supervisor.reap()
+
+        self.spawned[1].terminate.assert_called_once()
+
+    def test_measure_pubsub_backlog(self):
+        # Trimming keeps XLEN flat, entries-added grows
+        self.mock_redis.xlen.return_value = 100
+        self.mock_redis.xinfo_stream.side_effect = [{'length': 100, 'entries-added': 100},
+                                                    {'length': 100, 'entries-added': 400}]
+        self.mock_redis.client_list.return_value = [{'omem': '0'}, {'omem': '2048'}]
+
+        self.supervisor.measure()
+        metrics = self.supervisor.measure()
+
+        self.assertEqual(metrics['backlog'], 2048)
+        self.assertGreater(metrics['rate'], 0)
@@ -0,0 +1,64 @@
+import unittest
+from unittest.mock import patch
+
+import redis
+import redis.asyncio
+
+from src import transport
+from src.transport import connect, connection_kwargs, parser_name
+
+
+class TestTransport(unittest.TestCase):
+
+    def test_parser_name(self):
+        with patch.object(transport, 'HIREDIS_AVAILABLE', False):
+            self.assertEqual(parser_name('auto'), 'python')
+            with self.assertRaises(ValueError):
+                parser_name('hiredis')
+        with patch.object(transport, 'HIREDIS_AVAILABLE', True):
+            self.assertEqual(parser_name('auto'), 'hiredis')
+        with self.assertRaises(ValueError):
+            parser_name('fast')
+
+    def test_parsers_missing_in_redis_py(self):
+        # Test redis-py without the parser classes i know chooses its parser itself
+        with patch.object(transport, 'PARSERS', {}):
+            self.assertIsNone(parser_name('auto'))
+            self.assertNotIn('parser_class', connection_kwargs('redis', 6379))
+            with self.assertRaises(ValueError):
+                parser_name('python')
+
+    def test_tcp_connection(self):
+        kwargs = connection_kwargs('redis', '6379', parser='python', connect_timeout=2)
+        self.assertIs(kwargs['connection_class'], redis.connection.Connection)
+        self.assertEqual((kwargs['host'], kwargs['port']), ('redis', 6379))
+        self.assertTrue(kwargs['socket_keepalive'])
+        self.assertEqual(kwargs['socket_connect_timeout'], 2)
+        self.assertIs(kwargs['parser_class'], transport.PARSERS['python'][0])
+
+    def test_unix_socket_connection(self):
+        # Test socket path wins over host and port, keepalive is only for TCP
+        kwargs = connection_kwargs('redis', 6379, socket_path='/run/redis.sock', asyncio=True)
+        self.assertIs(kwargs['connection_class'], redis.asyncio.connection.UnixDomainSocketConnection)
+        self.assertEqual(kwargs['path'], '/run/redis.sock')
+        self.assertNotIn('host', kwargs)
+        self.assertNotIn('socket_keepalive', kwargs)
+
+    def test_connect_sized_blocking_pool(self):
+        client = connect('localhost', 6379, max_connections=3, pool_timeout=1.5)
+        pool = client.connection_pool
+        self.assertIsInstance(pool, redis.BlockingConnectionPool)
+        self.assertEqual((pool.max_connections, pool.timeout), (3, 1.5))
+        self.assertEqual(pool.connection_kwargs['health_check_interval'], 30)
+        self.assertTrue(client.auto_close_connection_pool)
+        client.close()
+
+    def test_connect_asyncio(self):
+        client = connect('localhost', 6379, asyncio=True, max_connections=5)
+        self.assertIsInstance(client, redis.asyncio.Redis)
+        self.assertIsInstance(client.connection_pool, redis.asyncio.BlockingConnectionPool)
+        self.assertEqual(client.connection_pool.max_connections, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from src.segments import segment_paths, iter_records
+from src.writebehind import WriteBehind, pack_entry, unpack_entry
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestWriteBehind(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.written = []
+        # Writes wait while Redis "stalls"
+        self.redis_up = threading.Event()
+        self.redis_up.set()
+
+    def write(self, entries):
+        self.redis_up.wait()
+        self.written.extend(message_id for message_id, _, _ in entries)
+
+    def test_pack_entry(self):
+        fields = {"message_id": "m1", "processed_message": b'{"a": 1}', "created_at": 1.5}
+        self.assertEqual(unpack_entry(memoryview(pack_entry("m1", fields, {"claimed": True}))),
+                         ("m1", {b"message_id": b"m1", b"processed_message": b'{"a": 1}', b"created_at": b"1.5"},
+                          {"claimed": True}))
+        self.assertEqual(unpack_entry(pack_entry(None, {})), (None, {}, {}))
+
+    def test_write_in_batches(self):
+        batches = []
+        write_behind = WriteBehind(batches.append, self.directory, "c1", batch=3)
+        write_behind.start()
+        for i in range(7):
+            write_behind.put(str(i), {"n": i})
+        write_behind.close()
+
+        self.assertEqual([message_id for batch in batches for message_id, _, _ in batch], [str(i) for i in range(7)])
+        self.assertLessEqual(max(len(batch) for batch in batches), 3)
+        self.assertEqual(write_behind.snapshot()["written"], 7)
+
+    def test_spill_and_replay_in_order(self):
+        # Test full queue spills while Redis stalls, spill is replayed after the queue and removed
+        self.redis_up.clear()
+        write_behind = WriteBehind(self.write, self.directory, "c1", max_queue=5, batch=2)
+        write_behind.start()
+        for i in range(20):
+            write_behind.put(str(i), {"n": i})
+
+        snapshot = write_behind.snapshot()
+        self.assertGreater(snapshot["spilled"], 0)
+        self.assertEqual(snapshot["spill_pending"], snapshot["spilled"])
+        # Spilled entries are on disk at once (a killed process doesn't lose them), not in the file buffer
+        self.assertEqual(sum(1 for _ in iter_records(segment_paths(os.path.join(self.directory, "c1")))),
+                         snapshot["spilled"])
+
+        self.redis_up.set()
+        self.assertTrue(wait_for(lambda: len(self.written) == 20))
+        write_behind.close()
+        self.assertEqual(self.written, [str(i) for i in range(20)])
+        self.assertEqual(write_behind.snapshot()["spill_pending"], 0)
+        # Nothing is left on disk
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "c1")))
+
+    def test_retry_failed_write(self):
+        calls = []
+
+        def flaky(entries):
+            calls.append(entries)
+            if len(calls) == 1:
+                raise ConnectionError("Redis is gone")
+            self.write(entries)
+
+        write_behind = WriteBehind(flaky, self.directory, "c1")
+        write_behind.start()
+        write_behind.put("m1", {"n": 1})
+        self.assertTrue(wait_for(lambda: self.written == ["m1"]))
+        write_behind.close()
+        self.assertEqual(write_behind.snapshot()["errors"], 1)
+
+    def test_retry_keeps_notes_of_write(self):
+        # Test what the write noted in meta before it failed is there for the retry and in the spill
+        notes = []
+
+        def claim_then_fail(entries):
+            for _, _, meta in entries:
+                notes.append(meta.get("claimed"))
+                meta["claimed"] = True
+            raise ConnectionError("Redis is gone")
+
+        write_behind = WriteBehind(claim_then_fail, self.directory, "c1", retry_max=0.01)
+        write_behind.start()
+        write_behind.put("m1", {"n": 1}, {"bytes": 2})
+        self.assertTrue(wait_for(lambda: len(notes) >= 2))
+        write_behind.close(timeout=0.1)
+        self.assertEqual(notes[:2], [None, True])
+
+        records = list(iter_records(segment_paths(os.path.join(self.directory, "c1"))))
+        self.assertEqual([unpack_entry(record)[2] for _, record in records], [{"bytes": 2, "claimed": True}])
+
+    def test_spill_on_close_is_adopted(self):
+        # Test what is not written on close stays on disk and the next consumer on the host replays it
+        def down(entries):
+            raise ConnectionError("Redis is gone")
+
+        write_behind = WriteBehind(down, self.directory, "c1", retry_max=0.01)
+        write_behind.start()
+        for i in range(3):
+            write_behind.put(str(i), {"n": i})
+        write_behind.close(timeout=0.2)
+        self.assertEqual(write_behind.snapshot()["spill_pending"], 3)
+
+        successor = WriteBehind(self.write, self.directory, "c2")
+        successor.start()
+        self.assertTrue(wait_for(lambda: len(self.written) == 3))
+        successor.close()
+        self.assertEqual(sorted(self.written), ["0", "1", "2"])
+        self.assertEqual(successor.snapshot()["adopted"], 3)
+        # Directories of both are gone, nothing is left to adopt
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()